@@ -1,52 +1,190 @@
 import numpy as np
 import os
+import re
 import csv
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 import matplotlib.pyplot as plt
 from new_optimization import *
 from basic_optimization import error_hdi
 from time_tree import TimeTree
+from segment_table import SegmentTable
+from newick import read_newick
 from arviz import hdi
 
-def calculate_all_sim_trees():
+# Hardcoded time of I for every simulated tree
+SIM_I = 2*(365/1.5)
+SUMMARY_FIELDNAMES = ['file', 'line', 'real_a', 'real_k', 'real_b', 'mle_b', 'success', 'model', 'I']
+SIM_DIRNAME = re.compile(r"a[^_]+_k[^_]+_b[^_]+") # Like "a5_k100_b4", see sim_work_units
+
+def sim_work_units(dirname, max_trees=100):
+    """
+    Read the trees of one erik-sim directory and turn the valid ones into work units.
+
+    Parameters:
+      dirname (str): Name of a directory in erik-sim, like "a5_k100_b4"
+      max_trees (int): Only the first max_trees valid trees are used
+
+    Returns:
+      units (list): Tuples of (file, line, real_a, real_k, real_b, table), where
+        table is the SegmentTable of the tree so workers never see ete3 objects.
+    """
+    real_a, real_k, real_b = [float(term[1:]) for term in dirname.split("_")] # "a5_k100_b4" -> [5.0, 100.0, 4.0]
+    treefile = ("erik-sim/" + dirname + "/trees.tre")
+    units = []
+    print(f"Reading trees from {treefile}...")
+    # Filter trees by those that do not have invalid root times.
+    # Will introduce bias in the data, especially for higher b.
+    for i, arrays in enumerate(read_newick(treefile)):
+        table = SegmentTable.from_arrays(arrays)
+        if table.time <= SIM_I:
+            units.append((treefile, i+1, real_a, real_k, real_b, table))
+        if len(units) == max_trees:
+            break
+    return units
+
+def fit_work_unit(unit):
+    """
+    Find the MLE of b for a single work unit and return its row of summary.csv.
+    Lives at module level so it can be sent to worker processes.
+    """
+    treefile, line, real_a, real_k, real_b, table = unit
+    res = optimize_b(table, real_a, SIM_I)
+    return {'file': treefile,
+            'line': line,
+            'real_a': real_a,
+            'real_k': real_k,
+            'real_b': real_b,
+            'mle_b': res.x,
+            'success': res.success,
+            'model': "lin",
+            'I': SIM_I}
+
+def summary_key(row):
+    """
+    Return the key that identifies a work unit in summary.csv:
+    (file, line, model, fixed a, fixed I). Rows written before the model
+    and I columns existed are treated as linear fits at SIM_I.
+    """
+    return (row['file'], int(row['line']), row.get('model') or "lin",
+            float(row['real_a']), float(row.get('I') or SIM_I))
+
+def unit_key(unit):
+    """
+    Return the summary.csv key of a work unit from sim_work_units.
+    """
+    treefile, line, real_a, real_k, real_b, table = unit
+    return (treefile, line, "lin", real_a, SIM_I)
+
+def open_summary_checkpoint(filename):
+    """
+    Open a summary csv file for appending, creating it if it does not exist.
+
+    Any partial line left behind by a crash is dropped, and files written
+    with an older set of columns are rewritten with the current ones. The
+    file is only rewritten when one of those is needed, and then through a
+    temporary file that replaces it in one step, so a crash during the
+    rewrite cannot lose the rows already there.
+
+    Parameters:
+      filename (str): Path to the summary csv file
+
+    Returns:
+      outfile (file): File object open for appending
+      finished (set): Keys (see summary_key) of every row already in the file
+    """
+    rows = []
+    rewrite = True
+    if os.path.exists(filename):
+        with open(filename) as infile:
+            lines = infile.readlines()
+        rewrite = not lines or lines[0].rstrip("\r\n") != ",".join(SUMMARY_FIELDNAMES)
+        if lines and not lines[-1].endswith("\n"):
+            lines = lines[:-1] # Interrupted in the middle of a row
+            rewrite = True
+        for row in csv.DictReader(lines):
+            try:
+                summary_key(row)
+            except (TypeError, ValueError):
+                rewrite = True
+                continue # Row is too damaged to use, so it will be recalculated
+            rows.append(row)
+
+    if rewrite:
+        # Write the cleaned rows next to the file, then swap it in. The name ends
+        # in .csv so a copy left by a crash is not taken for a tree directory.
+        fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)),
+                                       prefix=os.path.basename(filename) + ".", suffix=".tmp.csv")
+        try:
+            # mkstemp makes the file readable only by its owner, so give it the mode it would have had
+            if os.path.exists(filename):
+                shutil.copymode(filename, tmpname)
+            else:
+                umask = os.umask(0)
+                os.umask(umask)
+                os.chmod(tmpname, 0o666 & ~umask)
+            with os.fdopen(fd, "w") as outfile:
+                writer = csv.DictWriter(outfile, delimiter=',', fieldnames=SUMMARY_FIELDNAMES)
+                writer.writeheader()
+                for row in rows:
+                    row['model'] = row.get('model') or "lin"
+                    row['I'] = row.get('I') or SIM_I
+                    writer.writerow({name: row.get(name) for name in SUMMARY_FIELDNAMES})
+                outfile.flush()
+                os.fsync(outfile.fileno())
+            os.replace(tmpname, filename)
+        except BaseException:
+            os.remove(tmpname)
+            raise
+
+    finished = {summary_key(row) for row in rows}
+    return open(filename, "a"), finished
+
+def calculate_all_sim_trees(workers=None, chunksize=16, filename="erik-sim/summary.csv", restart=False):
     """
     For every tree in erik-sim, calculate the MLE and compare it to the actual value.
     
-    Write these results to a csv file.
+    Write these results to a csv file. Each row is written as soon as it is
+    done, and trees already in the file are skipped, so an interrupted sweep
+    can be continued (or new aX_kY_bZ directories added) by running this again.
+    Trees are fit in parallel, but rows are written in the same order as a
+    serial run.
+
+    Parameters:
+      workers (int, optional): Number of worker processes. Defaults to one per core.
+        With workers=1 everything runs in this process.
+      chunksize (int): Number of work units sent to a worker at a time
+      filename (str): Where to write the results
+      restart (bool): If True, overwrite any previous data instead of continuing
     """
-    with open("erik-sim/summary.csv", "w") as outfile:
-        # Initialize CSV file overwriting any previous data
-        fieldnames = ['file', 'line', 'real_a', 'real_k', 'real_b', 'mle_b', 'success']
-        writer = csv.DictWriter(outfile, delimiter=',', fieldnames=fieldnames)
-        writer.writeheader()
-
-        # Read trees within each directory
-        to_read = sorted([s for s in os.listdir("erik-sim") if s[-4:] != ".csv"]) # Do not read csv files. Very bootleg.
-        for dirname in to_read: 
-            real_a, real_k, real_b = [float(term[1:]) for term in dirname.split("_")] # "a5_k100_b4" -> [5.0, 100.0, 4.0]
-            treefile = ("erik-sim/" + dirname + "/trees.tre")
-            with open(treefile) as f:
-                print(f"Calculating trees from {treefile}...")
-                # Filter trees by those that do not have invalid root times.
-                # Will introduce bias in the data, especially for higher b.
-                all_data = [TimeTree(l) for l in f.readlines()]
-                valid_lines, valid_data = [], []
-                for i, t in enumerate(all_data):
-                    if t.time <= 2*(365/1.5): # Hardcoded time of I
-                        valid_lines.append(i)
-                        valid_data.append(t)
-                valid_lines = valid_lines[:100]
-                valid_data = valid_data[:100]
-
-                # For each valid tree, record it into the data file.
-                for line, tree in zip(valid_lines, valid_data):
-                    res = optimize_b(tree, real_a, 2*(365/1.5))
-                    writer.writerow({'file': treefile,
-                                     'line': line+1,
-                                     'real_a': real_a, 
-                                     'real_k': real_k, 
-                                     'real_b': real_b, 
-                                     'mle_b': res.x,
-                                     'success': res.success})
+    if restart and os.path.exists(filename):
+        os.remove(filename)
+    outfile, finished = open_summary_checkpoint(filename)
+
+    # Read trees within each directory
+    to_read = sorted([s for s in os.listdir("erik-sim")
+                      if SIM_DIRNAME.fullmatch(s) and os.path.isdir(os.path.join("erik-sim", s))])
+    units = []
+    for dirname in to_read:
+        units += [unit for unit in sim_work_units(dirname) if unit_key(unit) not in finished]
+
+    with outfile:
+        writer = csv.DictWriter(outfile, delimiter=',', fieldnames=SUMMARY_FIELDNAMES)
+
+        def write_row(row):
+            writer.writerow(row)
+            outfile.flush() # Keep the checkpoint current in case we crash
+
+        print(f"Calculating {len(units)} trees ({len(finished)} already done)...")
+        if workers == 1:
+            for row in map(fit_work_unit, units):
+                write_row(row)
+        else:
+            # map keeps the order of the inputs no matter which worker finishes first
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                for row in executor.map(fit_work_unit, units, chunksize=chunksize):
+                    write_row(row)
 
 def plot_from_summary_csv():
     # Read the summary csv file into two dicts to be plotted
@@ -114,7 +252,7 @@ def plot_from_summary_csv():
 
 
 def main():
-    #calculate_all_sim_trees() # To write data to the file. Only do this once, it won't change
+    #calculate_all_sim_trees() # To write data to the file. Safe to rerun, it skips trees already done
     plot_from_summary_csv()
 
 if __name__ == '__main__':
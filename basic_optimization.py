@@ -3,107 +3,113 @@
 import numpy as np
 import csv
 from time_tree import TimeTree
-from tree_likelihood import tree_likelihood
-from tree_generation import generate_tree
-from scipy.optimize import minimize_scalar, brentq, minimize
+from tree_generation import generate_trees
+from segment_table import Forest, as_segment_table
+from new_optimization import con_confidence_intervals, lin_confidence_intervals, optimize_a_forest, optimize_b_forest, \
+        max_likelihood_forest, con_mle, con_exact_intervals, optimize_a_b
 from arviz import hdi
 from population_models import * 
+from models import MODELS
 
 #
 # Optimize one parameter of a tree
 #
 
+def find_model(target_param, fixed_params):
+    """
+    Find the registered model (see models.py) that a target parameter and the
+    names of the fixed parameters belong to. "N0" is the population at the time
+    of infection, which is N for the constant model and a for the others.
+
+    Parameters:
+      target_param (str): "N0", "b", or "r" (or the model's own names)
+      fixed_params (dict): Fixed parameters, including "I" for "lin" and "exp"
+
+    Returns:
+      model (PopulationModel): The model
+      target (str): Name of the target in the model
+      fixed (dict): Fixed parameters, using the model's names
+    """
+    names = {target_param} | set(fixed_params) - {"I"}
+    for model in MODELS.values():
+        legacy = ("N0",) + model.fitted[1:]
+        if names == set(legacy) or names == set(model.fitted):
+            rename = dict(zip(legacy, model.fitted))
+            fixed = {rename.get(name, name): value for name, value in fixed_params.items()}
+            return model, rename.get(target_param, target_param), fixed
+    raise Exception(f"Could not find the correct function for target {target_param} and fixed {list(fixed_params)}.")
+
 def generate_likelihood_function(tree, target_param, fixed_params):
     """
     Based on the name of the target parameter and the name and value of
-    any fixed parameters, return a lambda function that takes the target_param
-    as input and outputs the corresponding likelihood.
+    any fixed parameters, return a function that takes the target_param
+    as input and outputs the corresponding log likelihood.
 
     Parameters:
       target_param (str): "N0", "b", or "r"
-      fixed_params (dict): Dictionary with one item,
-        giving the name and value of the fixed parameter.
+      fixed_params (dict): Dictionary giving the name and value of the other
+        parameter of the model, if any, and the time of infection "I".
 
     Returns:
-      func (function): Single-parameter function returning the probability of a tree at
-        a certain parameter value.
+      func (function): Single-parameter function returning the log likelihood of
+        a tree at a certain parameter value.
+      model (str): "con", "lin", or "exp"
     """
-    fixed_names = [name for name in fixed_params.keys()]
-    # Constant - N0
-    if target_param == "N0" and not fixed_names:
-        func = lambda x: tree_likelihood(tree, con_population, con_probability, {"N0": x})
-        model = "con"
-    # Linear - N0
-    elif target_param == "N0" and "b" in fixed_names:
-        func = lambda x: tree_likelihood(tree, lin_population, lin_probability, {"N0": x, "b": fixed_params["b"]})
-        model = "lin"
-    # Exponential - N0
-    elif target_param == "N0" and "r" in fixed_names:
-        func = lambda x: tree_likelihood(tree, exp_population, exp_probability, {"N0": x, "r": fixed_params["r"]})
-        model = "exp"
-    # Linear - b
-    elif target_param == "b" and "N0" in fixed_names:
-        func = lambda x: tree_likelihood(tree, lin_population, lin_probability, {"b": x, "N0": fixed_params["N0"]})
-        model = "lin"
-    # Exponential - r
-    elif target_param == "r" and "N0" in fixed_names:
-        func = lambda x: tree_likelihood(tree, exp_population, exp_probability, {"r": x, "N0": fixed_params["N0"]})
-        model = "exp"
-    else:
-        raise Exception(f"Could not find the correct function for target {target_param} and fixed {fixed_names}. Maybe Ray forgot to add them?")
-    return func, model
-
-def max_likelihood(tree, target_param, fixed_params={}):
+    model, target, fixed = find_model(target_param, fixed_params)
+    table = as_segment_table(tree)
+    # One parameter array, with the target written into its place on each call
+    theta = model.vector({**fixed, target: np.nan})
+    position = model.params.index(target)
+    def func(x):
+        theta[position] = x
+        return model.log_likelihood(table, theta)
+    return func, model.name
+
+def max_likelihood(tree, target_param, fixed_params={}, start=None):
     """
-    Use single-parameter optimization to find the most likely value of a target param
-    with relation to a tree.
+    Find the most likely value of a target param with relation to a tree,
+    using max_likelihood_forest for the constant and linear models.
 
     Parameters:
       tree (TimeTree): Representation of the tree in memory
       target_param (str): The parameter you want to optimize. Can be "N0", "b", or "r".
       fixed_params (dict): Optional dict of fixed values. Each entry should contain
         the name of a fixed param as the key and its value. If no fixed_params is
-        provided, a constant model will be assumed.
+        provided, a constant model will be assumed. The linear and exponential
+        models also need the time of infection as "I".
+      start (float, optional): Where to start searching, e.g. the peak of the
+        previous tree in a sweep
 
     Returns:
       peak_pos (float): Optimal value of the target param
     """
-    lk_func, model = generate_likelihood_function(tree, target_param, fixed_params)
-    fm = lambda x: -lk_func(x)
-
-    if model == "lin":
-        pass
-    elif model == "exp":
-        pass
-    elif model == "con":
-        pass
-    else:
-        raise Exception("Can only take model of lin, exp, or con")
-    res = minimize_scalar(fm, bracket=(100, 101), method="brent")
-    return res.x
-
-def optimize_linear(tree):
+    model, target, fixed = find_model(target_param, fixed_params)
+    if model.name != "exp":
+        return max_likelihood_forest(Forest.from_trees([tree]), target, fixed, start=start)[0]
+
+    # No estimator of its own yet, so start from the best of a wide grid
+    if start is None:
+        func, _ = generate_likelihood_function(tree, target_param, fixed_params)
+        grid = 2.**np.arange(-20, 21)
+        start = grid[np.argmax([func(x) for x in grid])]
+    return model.fit(tree, {**fixed, target: start}, fixed=fixed.keys()).params[target]
+
+def optimize_linear(tree, I, start=(100, 1)):
     """
-    Attempt to use multi-parameter optimization to find the best N0 and b
-    for a linear tree.
+    Use multi-parameter optimization to find the best N0 and b for a linear
+    tree, given the time of infection I. Uses optimize_a_b, which has the
+    exact gradient and Hessian of the linear log likelihood.
     """
-    fm = lambda x: -tree_likelihood(tree, lin_population, lin_probability, {"N0": x[0], "b": x[1]})
-    res = minimize(fm, (100, 1), method="BFGS")
-    return res.x
+    return optimize_a_b(tree, start, I).x
 
 def confidence_width(tree, peak_pos):
     """
     Return the width of the 95% confidence interval of a tree,
     given the value of the peak likelihood.
     """
-    peak_val = tree_likelihood(tree, con_population, con_probability, {"N0": peak_pos})
-                            
-    # A function that has its roots at peak - 2 so I can find the roots
-    fm = lambda x: tree_likelihood(tree, con_population, con_probability, {"N0": x}) - peak_val + 2
-
-    low_ci = brentq(fm, 1e-10, peak_pos)
-    high_ci = brentq(fm, peak_pos, 100*peak_pos)
-    return high_ci, low_ci
+    # The roots are at peak - 2
+    low_ci, high_ci = con_confidence_intervals(Forest.from_trees([tree]), peak_pos, drop=2)
+    return high_ci[0], low_ci[0]
 
 def confidence_bounds(tree, target_param, fixed_params={}):
     """
@@ -114,22 +120,30 @@ def confidence_bounds(tree, target_param, fixed_params={}):
       target_param(str): The parameter to optimize. Can be "N0", "b", or "r".
       fixed_params (dict): Optional dict of fixed values. Each entry should contain
         the name of a fixed param as the key and its value. If no fixed_params is
-        provided, a constant model will be assumed.
+        provided, a constant model will be assumed. The linear model also needs
+        the time of infection as "I".
 
     Returns:
       low_ci (float): Lower bound of confidence interval
       high_ci (float): Higher bound of confidence interval
     """
-    lk_func = generate_likelihood_function(tree, target_param, fixed_params)
-    
+    forest = Forest.from_trees([tree])
+    model, target, fixed = find_model(target_param, fixed_params)
+    if model.name == "exp":
+        raise Exception(f"Could not find intervals for target {target_param} and fixed {list(fixed_params)}.")
+    if target == "N":
+        # Closed form, see con_confidence_intervals for the same thing found numerically
+        _, low_ci, high_ci = con_exact_intervals(forest)
+        return low_ci[0], high_ci[0]
+
+    # Intercepts at peak - 1.92, found with the exact derivative of the likelihood
     peak_pos = max_likelihood(tree, target_param, fixed_params=fixed_params)
-    peak_val = lk_func(peak_pos)
-
-    fm = lambda x: lk_func(x) - peak_val + 1.92 # Has intercepts at peak - 1.92
-    low_ci = brentq(fm, 1e-10, peak_pos)
-    high_ci = brentq(fm, peak_pos, 10*peak_pos)
+    if target == "a":
+        low_ci, high_ci = lin_confidence_intervals(forest, "a", peak_pos, fixed["b"], fixed["I"])
+    else:
+        low_ci, high_ci = lin_confidence_intervals(forest, "b", fixed["a"], peak_pos, fixed["I"])
 
-    return low_ci, high_ci
+    return low_ci[0], high_ci[0]
 
 #
 # Input and output data files since these models can take a while to run
@@ -141,12 +155,9 @@ def alt_datafile_write(N0_range, k, peak_outfile=None):
     for N0 in N0_range:
         print(f"\n\nNEW N0 SELECTED: {N0}")
         run_params = {"N0": N0, "k": k}
-        peaks_out[N0] = []
-        for _ in range(1000):
-            print(f"  replicate {_}")
-            t = TimeTree(generate_tree(run_params))
-            peak_pos = max_likelihood(t, "N0")
-            peaks_out[N0].append(peak_pos)
+        trees = generate_trees(run_params, 1000)
+        # Every replicate's peak at once, in closed form
+        peaks_out[N0] = con_mle(trees).tolist()
 
     # Write to the file they provide 
     for outfile, dictionary, data_title in zip([peak_outfile], 
@@ -186,15 +197,11 @@ def write_con_datafiles(k_range, replicates=100, peak_outfile=None, width_outfil
     for k in k_range:
         print(f"\n\nNEW K SELECTED: {k}")
         run_params = {"N0": 1000, "k": k}
-        peaks_out[k] = []
-        widths_out[k] = []
-        for _ in range(replicates):
-            print(f"  replicate {_}")
-            t = TimeTree(generate_tree(run_params))
-            peak_pos = max_likelihood(t, "N0")
-            peaks_out[k].append(peak_pos)
-            low_ci, high_ci = confidence_bounds(t, "N0")
-            widths_out[k].append(high_ci - low_ci)
+        trees = generate_trees(run_params, replicates)
+        # Every replicate's peak and interval at once, in closed form
+        peaks, low_ci, high_ci = con_exact_intervals(trees)
+        peaks_out[k] = peaks.tolist()
+        widths_out[k] = (high_ci - low_ci).tolist()
 
     # Write to either or both of the outfiles 
     for outfile, dictionary, data_title in zip([peak_outfile, width_outfile], 
@@ -299,21 +306,19 @@ def calculate_error(data, error_fun):
 def test_trees_within_95_ci(trees, actual_params):
     # TESTING ONLY WORKS ON LINEAR TREES
     # HARDCODED. BEWARE.
-    within_range_b = 0 
-    within_range_N0 = 0 
+    # Every tree is fit and given its intervals at once
     actual_b = actual_params["b"]
     actual_N0 = actual_params["N0"]
-    for tmp_i, tree in enumerate(trees):
-        print(f"doing tree {tmp_i}")
-        low_N0, high_N0 = confidence_bounds(tree, "N0", fixed_params={"b": actual_b})
-        print(f"  N0 bounds {low_N0} to {high_N0}, actual {actual_N0}")
-        low_b, high_b = confidence_bounds(tree, "b", fixed_params={"N0": actual_N0})
-        print(f"  b bounds {low_b} to {high_b}, actual {actual_b}")
-        if low_N0 <= actual_N0 <= high_N0:
-            within_range_N0 += 1
-        if low_b <= actual_b <= high_b:
-            within_range_b += 1
-        tmp_i += 1
+    I = actual_params["I"]
+    forest = Forest.from_trees(trees)
+
+    peak_N0 = optimize_a_forest(forest, actual_b, I)
+    low_N0, high_N0 = lin_confidence_intervals(forest, "a", peak_N0, actual_b, I)
+    peak_b = optimize_b_forest(forest, actual_N0, I)
+    low_b, high_b = lin_confidence_intervals(forest, "b", actual_N0, peak_b, I)
+
+    within_range_N0 = np.count_nonzero((low_N0 <= actual_N0) & (actual_N0 <= high_N0))
+    within_range_b = np.count_nonzero((low_b <= actual_b) & (actual_b <= high_b))
     total = len(trees)
     return within_range_b / total, within_range_N0 / total
 
@@ -328,5 +333,5 @@ if __name__ == '__main__':
     treefile = open("linear-latest.tre")
     t = TimeTree(treefile.readline())
     treefile.close()
-    best_params = optimize_linear(t)
+    best_params = optimize_linear(t, I=1.01)
     print(best_params)
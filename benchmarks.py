@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+import timeit
+import itertools
+import numpy as np
+from scipy.optimize import minimize_scalar
+from time_tree import TimeTree
+from newick import read_newick
+from segment_table import Forest
+from new_optimization import max_likelihood_forest
+
+#
+# Trees to benchmark on
+#
+
+def caterpillar_newick(k):
+    """
+    Newick string for a caterpillar (ladder) tree with k tips. Every coalescence
+    adds one tip to the clade below it, so the tree is as deep as possible.
+    """
+    newick = "0:1"
+    for i in range(1, k):
+        newick = f"({newick},{i}:{i}):1"
+    return newick[:-2] + ";"
+
+def balanced_newick(k):
+    """
+    Newick string for a tree with k tips that is split as evenly as possible.
+    """
+    def clade(low, high):
+        if high - low == 1:
+            return f"{low}:1"
+        mid = (low + high) // 2
+        return f"({clade(low, mid)},{clade(mid, high)}):1"
+    return clade(0, k)[:-2] + ";"
+
+def time_call(func, repeat=5):
+    """
+    Return the best time out of several runs of func, in seconds.
+    """
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+#
+# populate_times
+#
+
+def populate_times_per_node(tree):
+    """
+    The previous populate_times, which finds the distance to every node
+    separately. Kept here to compare against.
+    """
+    tree_max = tree.get_farthest_node()[1]
+    for node in tree.traverse():
+        node_dist = tree.get_distance(node)
+        node.add_feature("time", tree_max - node_dist)
+
+def benchmark_populate_times(k_range=(20, 100, 1000)):
+    """
+    Compare the single-pass populate_times against the per-node version on
+    caterpillar and balanced trees of increasing size.
+    """
+    print("populate_times (seconds per call)")
+    print(f"{'shape':>12} {'k':>6} {'per node':>10} {'one pass':>10}")
+    for shape, make_newick in [("caterpillar", caterpillar_newick), ("balanced", balanced_newick)]:
+        for k in k_range:
+            tree = TimeTree(make_newick(k), lazy_times=True)
+            old = time_call(lambda: populate_times_per_node(tree), repeat=3 if k < 1000 else 1)
+            new = time_call(tree.populate_times)
+            print(f"{shape:>12} {k:>6} {old:>10.5f} {new:>10.5f}")
+
+#
+# max_likelihood
+#
+
+class CountingForest(Forest):
+    """
+    Forest that counts how many times its likelihood and derivatives are found.
+    """
+    calls = 0
+
+    def con_log_likelihood(self, N):
+        self.calls += 1
+        return super().con_log_likelihood(N)
+
+    def lin_log_likelihood(self, a, b, I):
+        self.calls += 1
+        return super().lin_log_likelihood(a, b, I)
+
+    def lin_log_likelihood_gradient(self, a, b, I):
+        self.calls += 1
+        return super().lin_log_likelihood_gradient(a, b, I)
+
+    def lin_log_likelihood_hessian(self, a, b, I):
+        self.calls += 1
+        return super().lin_log_likelihood_hessian(a, b, I)
+
+def brent_max_likelihood(forest, target_param, fixed_params):
+    """
+    The previous max_likelihood search, Brent's method started from the
+    bracket (100, 101), on the log likelihood of a single tree.
+    """
+    if target_param == "N":
+        fun = lambda x: -forest.con_log_likelihood(x)[0]
+    elif target_param == "a":
+        fun = lambda x: -forest.lin_log_likelihood(x, fixed_params["b"], fixed_params["I"])[0]
+    else:
+        fun = lambda x: -forest.lin_log_likelihood(fixed_params["a"], x, fixed_params["I"])[0]
+    return minimize_scalar(fun, bracket=(100, 101), method="brent").x
+
+def benchmark_max_likelihood(filename="tree_files/linear-latest.tre", I=1.01, trees=100):
+    """
+    Count the likelihood (and derivative) evaluations needed to fit one tree
+    with the Brent search against max_likelihood_forest. The linear fits are
+    done along a sweep of the fixed parameter, both cold and warm-started
+    from the previous point of the sweep. Also print the largest amount by
+    which each method falls short of the best log likelihood found. The best
+    a is mostly 0 in the first a sweep, where a warm start is no help.
+    """
+    tables = [Forest.from_trees([tree]).table(0) for tree in itertools.islice(read_newick(filename), trees)]
+    tables = [table for table in tables if table.time <= I]
+    print(f"max_likelihood on {filename} ({len(tables)} trees, evaluations per fit)")
+    print(f"{'target':>8} {'sweep':>18} {'brent':>8} {'cold':>8} {'warm':>8} {'brent short':>12} {'new short':>10}")
+    for target, fixed_name, sweep in [("N", None, [None]), ("a", "b", [1.5, 1.75, 2, 2.25, 2.5]),
+                                      ("a", "b", [0.3, 0.4, 0.5, 0.6, 0.7]),
+                                      ("b", "a", [0.3, 0.4, 0.5, 0.6, 0.7])]:
+        counts = {"brent": 0, "cold": 0, "warm": 0}
+        shortfall = {"brent": 0., "new": 0.}
+        for table in tables:
+            forest = CountingForest([table])
+            previous = None
+            for value in sweep:
+                fixed = {fixed_name: value, "I": I} if fixed_name else {}
+                forest.calls = 0
+                with np.errstate(all="ignore"):
+                    old = brent_max_likelihood(forest, target, fixed)
+                counts["brent"] += forest.calls
+                forest.calls = 0
+                new = max_likelihood_forest(forest, target, fixed)[0]
+                counts["cold"] += forest.calls
+                forest.calls = 0
+                previous = max_likelihood_forest(forest, target, fixed, start=previous)[0]
+                counts["warm"] += forest.calls
+                if target == "N":
+                    values = [forest.con_log_likelihood(x)[0] for x in (old, new)]
+                elif target == "a":
+                    values = [forest.lin_log_likelihood(x, value, I)[0] for x in (old, new)]
+                else:
+                    values = [forest.lin_log_likelihood(value, x, I)[0] for x in (old, new)]
+                values = np.nan_to_num(values, nan=-np.inf)
+                shortfall["brent"] = max(shortfall["brent"], values.max() - values[0])
+                shortfall["new"] = max(shortfall["new"], values.max() - values[1])
+        fits = len(tables)*len(sweep)
+        label = f"{fixed_name}={sweep[0]}..{sweep[-1]}" if fixed_name else "-"
+        print(f"{target:>8} {label:>18} " + " ".join(f"{counts[name]/fits:>8.1f}" for name in counts)
+              + f" {shortfall['brent']:>12.3g} {shortfall['new']:>10.3g}")
+
+if __name__ == "__main__":
+    benchmark_populate_times()
+    benchmark_max_likelihood()
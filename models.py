@@ -0,0 +1,261 @@
+import numpy as np
+import warnings
+from scipy.optimize import minimize, Bounds
+from segment_table import Forest, as_segment_table
+from tree_generation import generate_trees
+from population_models import con_population, lin_population, exp_population, \
+        con_log_probability, lin_log_probability, exp_log_probability, \
+        con_log_probability_derivatives, lin_log_probability_gradient, exp_log_probability_gradient, \
+        lin_log_probability_hessian
+
+class PopulationModel:
+    """
+    Everything the optimizers and the simulator need to know about one
+    population model, so they can treat every model the same way. Parameter
+    values are passed as one array in the order of params instead of a dict,
+    so an optimizer can write into the same array on every call.
+
+    Attributes:
+      name (str): "con", "lin", or "exp"
+      params (tuple): Names of the parameters, in the order every method uses
+      fitted (tuple): Parameters the gradient is taken with respect to. The
+        rest (the time of infection) are always fixed.
+      bounds (tuple): (low, high) of each fitted parameter
+      population (function): Population function from population_models
+      has_hessian (bool): Whether the model declares its Hessian
+    """
+    def __init__(self, name, params, fitted, bounds, population, log_probability, log_probability_gradient, sampler,
+                 log_probability_hessian=None):
+        self.name = name
+        self.params = params
+        self.fitted = fitted
+        self.bounds = bounds
+        self.population = population
+        self._log_probability = log_probability
+        self._log_probability_gradient = log_probability_gradient
+        self._log_probability_hessian = log_probability_hessian
+        self._sampler = sampler
+
+    @property
+    def has_hessian(self):
+        return self._log_probability_hessian is not None
+
+    def __repr__(self):
+        return f"PopulationModel({self.name!r}, params={self.params})"
+
+    def vector(self, values):
+        """
+        Return the parameters in a dict as an array in the order of params.
+        """
+        missing = [name for name in self.params if name not in values]
+        if missing:
+            raise Exception(f"Please check params. Expected {list(self.params)}, given {list(values.keys())}")
+        return np.array([values[name] for name in self.params], dtype=float)
+
+    def as_dict(self, theta):
+        """
+        Return an array of parameters in the order of params as a dict.
+        """
+        return dict(zip(self.params, theta))
+
+    def _segments(self, tree, theta):
+        """
+        Segments of a tree (or every tree of a forest) and each parameter
+        spread over them. For a forest, theta is either shared by every tree
+        or has one row per tree.
+        """
+        theta = np.asarray(theta, dtype=float)
+        if isinstance(tree, Forest):
+            columns = [tree._per_segment(theta[..., i]) for i in range(len(self.params))]
+        else:
+            tree = as_segment_table(tree)
+            columns = [theta[..., i, np.newaxis] for i in range(len(self.params))]
+        return tree, columns
+
+    def _sum(self, tree, segment_values):
+        if isinstance(tree, Forest):
+            return tree._sum_trees(segment_values)
+        return np.sum(segment_values, axis=-1)
+
+    def log_likelihood(self, tree, theta):
+        """
+        Log likelihood of a tree under this model.
+
+        Parameters:
+          tree (TimeTree, TreeArrays, SegmentTable, or Forest): The tree, or many
+            trees at once
+          theta (ndarray): Parameters in the order of params. For a single tree
+            any leading axes are broadcast over, for a forest theta is either
+            shared or has one row per tree.
+
+        Returns:
+          log_likelihood (float or ndarray): Log likelihood for each tree or
+          each set of parameters. -inf where the parameters are invalid.
+        """
+        tree, columns = self._segments(tree, theta)
+        return self._sum(tree, self._log_probability(tree.start, tree.dist, tree.k, *columns))
+
+    def gradient(self, tree, theta):
+        """
+        Gradient of log_likelihood with respect to the fitted parameters.
+
+        Returns:
+          gradient (ndarray): Array with a last axis holding the derivative
+          with respect to each of fitted
+        """
+        tree, columns = self._segments(tree, theta)
+        parts = self._log_probability_gradient(tree.start, tree.dist, tree.k, *columns)
+        return np.stack([self._sum(tree, part) for part in parts[:len(self.fitted)]], axis=-1)
+
+    def hessian(self, tree, theta):
+        """
+        Hessian of log_likelihood with respect to the fitted parameters. The
+        model's Hessian kernel gives the upper triangle, row by row.
+
+        Returns:
+          hessian (ndarray): Array with two last axes, each the length of fitted
+        """
+        tree, columns = self._segments(tree, theta)
+        parts = [self._sum(tree, part) for part in
+                 self._log_probability_hessian(tree.start, tree.dist, tree.k, *columns)]
+        n = len(self.fitted)
+        hessian = np.empty(np.shape(parts[0]) + (n, n))
+        for part, i, j in zip(parts, *np.triu_indices(n)):
+            hessian[..., i, j] = hessian[..., j, i] = part
+        return hessian
+
+    def converged(self, tree, theta, free=None, tol=1e-4):
+        """
+        Check that theta is a maximum of the log likelihood of a tree, up to
+        tol: the gradient of every free parameter must be close to 0, unless
+        the parameter is on a bound and the gradient points out of it.
+
+        Parameters:
+          tree (TimeTree, TreeArrays, or SegmentTable): The tree
+          theta (ndarray): Parameters in the order of params
+          free (list, optional): Indices of the parameters to check, all of fitted by default
+          tol (float): Largest gradient allowed, scaled by the size of each parameter
+
+        Returns:
+          converged (bool): Whether theta is a maximum
+        """
+        free = list(range(len(self.fitted))) if free is None else free
+        x = np.asarray(theta, dtype=float)[free]
+        gradient = self.gradient(tree, theta)[free]
+        scale = np.maximum(np.abs(x), 1)
+        low = np.array([self.bounds[i][0] for i in free])
+        high = np.array([self.bounds[i][1] for i in free])
+        outward = (((x - low <= tol*scale) & (gradient < 0))
+                   | ((high - x <= tol*scale) & (gradient > 0)))
+        return bool(np.all(outward | (np.abs(gradient)*scale <= tol*np.maximum(1, len(tree)))))
+
+    def sample(self, theta, k, replicates=1, generator=None):
+        """
+        Simulate trees with k tips under this model.
+
+        Parameters:
+          theta (ndarray): Parameters in the order of params
+          k (int): Number of tips
+          replicates (int): Number of trees
+          generator (Generator, optional): Random number generator, see tree_generation
+
+        Returns:
+          trees (Forest): Segments of every simulated tree
+        """
+        return self._sampler(theta, k, replicates, generator)
+
+    def fit(self, tree, start, fixed=()):
+        """
+        Maximum likelihood estimate of every fitted parameter that is not fixed,
+        inside the model's bounds. Models with a Hessian use trust-constr with
+        the exact gradient and Hessian, the others L-BFGS-B with the exact
+        gradient, restarted from where it stopped until it converges. If the
+        result is not a maximum (see converged), res.success is set to False
+        and a warning is given.
+
+        Parameters:
+          tree (TimeTree, TreeArrays, or SegmentTable): Tree to fit
+          start (dict): Starting value of every parameter, including the fixed ones
+          fixed (iterable): Names of fitted parameters to hold at their start value
+
+        Returns:
+          res (OptimizeResult): Result of the optimization, with the best
+          parameters of every kind in res.params
+        """
+        table = as_segment_table(tree)
+        theta = self.vector(start)
+        free = [i for i, name in enumerate(self.fitted) if name not in fixed]
+
+        def fun(x):
+            theta[free] = x
+            with np.errstate(invalid="ignore"):
+                return -self.log_likelihood(table, theta)
+        def jac(x):
+            theta[free] = x
+            return -self.gradient(table, theta)[free]
+
+        if self.has_hessian:
+            def hess(x):
+                theta[free] = x
+                return -self.hessian(table, theta)[np.ix_(free, free)]
+            bounds = Bounds([self.bounds[i][0] for i in free], [self.bounds[i][1] for i in free])
+            # Best values are often on a bound, so start the barrier small to get close to it
+            res = minimize(fun, theta[free], method="trust-constr", jac=jac, hess=hess, bounds=bounds,
+                           options={"initial_barrier_parameter": 1e-6, "gtol": 1e-10, "xtol": 1e-10,
+                                    "barrier_tol": 1e-10})
+        else:
+            bounds = [self.bounds[i] for i in free]
+            x = theta[free]
+            for _ in range(5):
+                # L-BFGS-B can stop early where its curvature estimate is poor, so start it again
+                res = minimize(fun, x, jac=jac, method="L-BFGS-B", bounds=bounds,
+                               options={"ftol": 1e-14, "gtol": 1e-12})
+                theta[free] = x = res.x
+                if self.converged(table, theta, free):
+                    break
+        theta[free] = res.x
+        res.params = self.as_dict(theta)
+        if not self.converged(table, theta, free):
+            res.success = False
+            warnings.warn(f"{self.name} fit stopped at {res.params} without reaching a maximum")
+        return res
+
+def _con_gradient(start, z, k, N):
+    return con_log_probability_derivatives(start, z, k, N)[:1]
+
+def _con_hessian(start, z, k, N):
+    return con_log_probability_derivatives(start, z, k, N)[1:]
+
+MODELS = {
+    "con": PopulationModel(
+        "con", params=("N",), fitted=("N",), bounds=((1e-10, np.inf),),
+        population=con_population,
+        log_probability=con_log_probability,
+        log_probability_gradient=_con_gradient,
+        log_probability_hessian=_con_hessian,
+        sampler=lambda theta, k, replicates, generator:
+            generate_trees({"N0": theta[0], "k": k}, replicates, con_population, generator)),
+    "lin": PopulationModel(
+        "lin", params=("a", "b", "I"), fitted=("a", "b"), bounds=((0, np.inf), (1e-10, np.inf)),
+        population=lin_population,
+        log_probability=lin_log_probability,
+        log_probability_gradient=lin_log_probability_gradient,
+        log_probability_hessian=lin_log_probability_hessian,
+        sampler=lambda theta, k, replicates, generator:
+            generate_trees({"a": theta[0], "b": theta[1], "I": theta[2], "k": k}, replicates, lin_population, generator)),
+    "exp": PopulationModel(
+        "exp", params=("a", "r", "I"), fitted=("a", "r"), bounds=((1e-10, np.inf), (1e-10, np.inf)),
+        population=exp_population,
+        log_probability=exp_log_probability,
+        log_probability_gradient=exp_log_probability_gradient,
+        sampler=lambda theta, k, replicates, generator:
+            generate_trees({"a": theta[0], "r": theta[1], "I": theta[2], "k": k}, replicates, exp_population, generator)),
+}
+
+def get_model(name):
+    """
+    Return the registered PopulationModel called name ("con", "lin", or "exp").
+    """
+    if name not in MODELS:
+        raise Exception(f"Can only take model of {', '.join(MODELS)}, not {name}")
+    return MODELS[name]
@@ -1,25 +1,588 @@
-from scipy.optimize import minimize, minimize_scalar
-from tree_likelihood import tree_likelihood
+from scipy.optimize import minimize, minimize_scalar, Bounds
+from scipy.special import lambertw
+from tree_likelihood import tree_likelihood, grid_likelihood
 from time_tree import TimeTree
+from segment_table import as_segment_table
+from models import MODELS
 from population_models import *
 import numpy as np
+import warnings
 
 def optimize_b(tree, a, I):
-    fun = lambda x: -tree_likelihood(tree, lin_population, lin_probability, {"a": a, "b": x, "I": I})
+    table = as_segment_table(tree) # Compile once instead of on every call
+    fun = lambda x: -tree_likelihood(table, lin_population, lin_probability, {"a": a, "b": x, "I": I})
     res = minimize_scalar(fun, method="brent") # TODO is brent any good at this or should I look back at BFGS and Nelder-Mead
     return res
 
 def optimize_a_b(tree, x0, I): # Possibly less useful for now, it always wants a as low as possible
-    fun = lambda x: -tree_likelihood(tree, lin_population, lin_probability, {"a": x[0], "b": x[1], "I": I})
-    res = minimize(fun, x0, method="Nelder-Mead")
+    """
+    Find the best a and b for a tree with the "lin" model of the registry,
+    which uses a trust-region method with the exact gradient and Hessian of
+    the linear log likelihood.
+
+    Parameters:
+      tree (TimeTree, TreeArrays, or SegmentTable): Tree to fit
+      x0 (tuple): Starting (a, b)
+      I (float): Time of infection
+
+    Returns:
+      res (OptimizeResult): Result of the optimization, with res.x = (a, b) and
+      res.stderr the standard errors of a and b from the observed information
+    """
+    table = as_segment_table(tree)
+    if I < table.time:
+        warnings.warn(f"Tree time {table.time} was further back than transmission time {I}")
+    res = MODELS["lin"].fit(table, {"a": x0[0], "b": x0[1], "I": I})
+    res.stderr = lin_standard_errors(table, res.x[0], res.x[1], I)
     return res
 
-def simple_gridsearch(tree, a_range, b_range, I):
-    values = np.zeros((len(a_range), len(b_range)))
+def lin_standard_errors(tree, a, b, I):
+    """
+    Standard errors of a and b from the observed information (the negative
+    Hessian of the log likelihood) at (a, b), usually the MLE.
+
+    Returns:
+      stderr (ndarray): Standard errors of (a, b). nan if the information is
+      not positive definite there, e.g. when a is on its bound of 0.
+    """
+    table = as_segment_table(tree)
+    information = -lin_log_likelihood_hessian(table.start, table.dist, table.k, a, b, I)
+    try:
+        covariance = np.linalg.inv(information)
+    except np.linalg.LinAlgError:
+        return np.full(2, np.nan)
+    variance = np.diag(covariance)
+    with np.errstate(invalid="ignore"):
+        return np.where(variance > 0, np.sqrt(variance), np.nan)
+
+def simple_gridsearch(tree, a_range, b_range, I, chunk_size=None):
     # b along rows, N0 down columns
-    for i, b in enumerate(b_range):
-        for j, N0 in enumerate(a_range):
-            val = tree_likelihood(tree, lin_population, lin_probability, {"a": N0, "b": b, "I": I})
-            values[j][i] = val
-    return values
+    return grid_likelihood(tree, a_range, b_range, I, chunk_size=chunk_size)
+
+def golden_section_max(fun, low, high, xtol=1e-8):
+    """
+    Maximize many independent one-dimensional functions at once with a
+    golden-section search. fun takes an array of x values (one per problem)
+    and returns an array of the same shape.
+
+    Parameters:
+      fun (function): Vectorized function to maximize
+      low (ndarray): Lower bound for each problem
+      high (ndarray): Upper bound for each problem
+      xtol (float): Stop once every bracket is narrower than this
+
+    Returns:
+      x (ndarray): Position of the maximum for each problem
+    """
+    ratio = (np.sqrt(5) - 1) / 2
+    low, high = np.broadcast_arrays(np.asarray(low, dtype=float), np.asarray(high, dtype=float))
+    low, high = low.copy(), high.copy()
+    x1 = high - ratio*(high - low)
+    x2 = low + ratio*(high - low)
+    f1, f2 = fun(x1), fun(x2)
+    while np.max(high - low) > xtol:
+        go_left = f1 >= f2
+        # Maximum is in [low, x2]: x2 -> high, x1 -> x2
+        high = np.where(go_left, x2, high)
+        low = np.where(go_left, low, x1)
+        x2_new = np.where(go_left, x1, low + ratio*(high - low))
+        x1_new = np.where(go_left, high - ratio*(high - low), x2)
+        f_new = fun(np.where(go_left, x1_new, x2_new))
+        f1, f2 = np.where(go_left, f_new, f2), np.where(go_left, f1, f_new)
+        x1, x2 = x1_new, x2_new
+    return (low + high) / 2
+
+def optimize_b_forest(forest, a, I, pooled=False, bounds=(1e-4, 1e4), xtol=1e-8):
+    """
+    Find the best b for every tree in a forest at once, or a single pooled b
+    shared by all of them. The search is done on log(b).
+
+    Parameters:
+      forest (Forest): Trees to fit
+      a (float or ndarray): Population at time of infection, shared or one per tree
+      I (float or ndarray): Time of infection, shared or one per tree
+      pooled (bool): If True, return the b that maximizes the summed log likelihood
+      bounds (tuple): Lowest and highest b to consider
+      xtol (float): Tolerance on log(b)
+
+    Returns:
+      b (ndarray or float): Best b for each tree, or the pooled estimate
+    """
+    low, high = np.log(bounds)
+    if pooled:
+        fun = lambda x: np.array([np.sum(forest.lin_log_likelihood(a, np.exp(x[0]), I))])
+        return float(np.exp(golden_section_max(fun, [low], [high], xtol=xtol))[0])
+    fun = lambda x: forest.lin_log_likelihood(a, np.exp(x), I)
+    n = len(forest)
+    return np.exp(golden_section_max(fun, np.full(n, low), np.full(n, high), xtol=xtol))
+
+def optimize_a_forest(forest, b, I, bounds=(0, 1e4), xtol=1e-8):
+    """
+    Find the best a for every tree in a forest at once, with b fixed.
+
+    Parameters:
+      forest (Forest): Trees to fit
+      b (float or ndarray): Linear rate of population increase, shared or one per tree
+      I (float or ndarray): Time of infection, shared or one per tree
+      bounds (tuple): Lowest and highest a to consider
+      xtol (float): Tolerance on a
+
+    Returns:
+      a (ndarray): Best a for each tree
+    """
+    fun = lambda x: forest.lin_log_likelihood(x, b, I)
+    n = len(forest)
+    return golden_section_max(fun, np.full(n, float(bounds[0])), np.full(n, float(bounds[1])), xtol=xtol)
+
+#
+# Likelihood intervals
+#
+
+def drop_roots(fun, grad, peak, drop=1.92, step=1., bounds=(-np.inf, np.inf), xtol=1e-10, max_iter=100):
+    """
+    Find where many one-dimensional log likelihoods fall drop below their
+    peaks, on both sides of each peak at once. Each root is bracketed first
+    (stepping away from the peak and doubling the step until the likelihood
+    is low enough), then found with Newton's method using the exact
+    derivative, falling back to bisection whenever a Newton step would leave
+    the bracket.
+
+    Parameters:
+      fun (function): Vectorized log likelihood, taking one x per problem
+      grad (function): Derivative of fun, taking one x per problem
+      peak (ndarray): Position of the maximum of each problem
+      drop (float): How far below the peak the roots are. 1.92 gives 95% intervals.
+      step (float or ndarray): First step away from the peak when bracketing
+      bounds (tuple): Lowest and highest x allowed. If the likelihood never
+        falls far enough before a bound, the bound is returned.
+      xtol (float): Relative tolerance on each root
+      max_iter (int): Most bracketing or Newton steps on each side
+
+    Returns:
+      low (ndarray): Lower root for each problem
+      high (ndarray): Upper root for each problem
+    """
+    peak = np.asarray(peak, dtype=float)
+    target = fun(peak) - drop
+    g = lambda x: fun(x) - target
+    roots = []
+    for direction, bound in [(-1, bounds[0]), (1, bounds[1])]:
+        # Bracket the root between inside (g >= 0) and outside (g < 0)
+        inside = peak.copy()
+        outside = np.clip(peak + direction*step, *bounds)
+        g_out = g(outside)
+        for _ in range(max_iter):
+            expand = (g_out >= 0) & (outside != bound)
+            if not np.any(expand):
+                break
+            outside = np.where(expand, np.clip(peak + 2*(outside - peak), *bounds), outside)
+            g_out = np.where(expand, g(outside), g_out)
+        no_root = g_out >= 0
+        at_bound = outside.copy()
+
+        # Start from the secant through the bracket, or its middle if g is -inf outside
+        with np.errstate(all="ignore"):
+            x = inside - drop*(outside - inside)/(g_out - drop)
+        x = np.where(np.isfinite(x), x, (inside + outside)/2)
+        for _ in range(max_iter):
+            gx = g(x)
+            above = gx >= 0
+            inside = np.where(above, x, inside)
+            outside = np.where(above, outside, x)
+            with np.errstate(all="ignore"):
+                newton = x - gx/grad(x)
+            in_bracket = np.isfinite(newton) & ((newton - inside)*(newton - outside) < 0)
+            x_new = np.where(in_bracket, newton, (inside + outside)/2)
+            done = np.abs(x_new - x) <= xtol*(1 + np.abs(x))
+            x = x_new
+            if np.all(done | no_root):
+                break
+        roots.append(np.where(no_root, at_bound, x))
+    return roots[0], roots[1]
+
+def con_confidence_intervals(forest, N, drop=1.92):
+    """
+    Likelihood intervals for N of every tree in a forest under the constant
+    model. The roots are found on log(N).
+
+    Parameters:
+      forest (Forest): Trees to find intervals for
+      N (ndarray): Best N of each tree
+      drop (float): Drop from the peak log likelihood, 1.92 for 95% intervals
+
+    Returns:
+      low (ndarray): Lower bound of each interval
+      high (ndarray): Upper bound of each interval
+    """
+    fun = lambda x: forest.con_log_likelihood(np.exp(x))
+    grad = lambda x: np.exp(x)*forest.con_log_likelihood_derivatives(np.exp(x))[0]
+    low, high = drop_roots(fun, grad, np.log(N), drop=drop)
+    return np.exp(low), np.exp(high)
+
+def lin_confidence_intervals(forest, target_param, a, b, I, drop=1.92):
+    """
+    Likelihood intervals for a or b of every tree in a forest under the linear
+    model, with the other parameter fixed. b is searched on log(b), and a is
+    searched directly since its best value is often its bound of 0.
+
+    Parameters:
+      forest (Forest): Trees to find intervals for
+      target_param (str): "a" or "b"
+      a (float or ndarray): Best a of each tree if target_param is "a", otherwise the fixed a
+      b (float or ndarray): Best b of each tree if target_param is "b", otherwise the fixed b
+      I (float or ndarray): Time of infection, shared or one per tree
+      drop (float): Drop from the peak log likelihood, 1.92 for 95% intervals
+
+    Returns:
+      low (ndarray): Lower bound of each interval
+      high (ndarray): Upper bound of each interval
+    """
+    n = len(forest)
+    if target_param == "a":
+        fun = lambda x: forest.lin_log_likelihood(x, b, I)
+        grad = lambda x: forest.lin_log_likelihood_gradient(x, b, I)[:, 0]
+        peak = np.broadcast_to(np.asarray(a, dtype=float), (n,))
+        return drop_roots(fun, grad, peak, drop=drop, step=np.maximum(peak, 1.), bounds=(0, np.inf))
+    elif target_param == "b":
+        fun = lambda x: forest.lin_log_likelihood(a, np.exp(x), I)
+        grad = lambda x: np.exp(x)*forest.lin_log_likelihood_gradient(a, np.exp(x), I)[:, 1]
+        peak = np.broadcast_to(np.log(np.asarray(b, dtype=float)), (n,))
+        low, high = drop_roots(fun, grad, peak, drop=drop)
+        return np.exp(low), np.exp(high)
+    raise Exception(f"Can only find intervals for a or b, not {target_param}")
+
+#
+# Profile likelihoods
+#
+
+def newton_max(fun, derivatives, x0, bounds=(-np.inf, np.inf), step_size=1., xtol=1e-10, max_iter=50):
+    """
+    Maximize many independent one-dimensional functions at once with Newton's
+    method. Where a function is not concave the step follows the slope
+    instead, and any step that does not improve the value is halved until it
+    does, so each problem only ever goes uphill.
+
+    Parameters:
+      fun (function): Vectorized function to maximize, taking one x per problem
+      derivatives (function): Returns the first and second derivative of fun at x
+      x0 (ndarray): Starting point of each problem
+      bounds (tuple): Lowest and highest x allowed, shared or one per problem
+      step_size (float): Shortest step where the function is not concave. Steps
+        there are as long as |x| if that is longer.
+      xtol (float): Relative tolerance on x
+      max_iter (int): Most Newton steps
+
+    Returns:
+      x (ndarray): Position of the maximum of each problem
+      f (ndarray): Value of each function there
+      iterations (int): Number of Newton steps taken
+    """
+    x = np.clip(np.asarray(x0, dtype=float), *bounds)
+    f = fun(x)
+    for iteration in range(1, max_iter + 1):
+        g, h = derivatives(x)
+        with np.errstate(all="ignore"):
+            step = np.where(h < 0, -g/h, np.sign(g)*np.maximum(step_size, np.abs(x)))
+        step = np.where(np.isfinite(step), step, 0.)
+        new = np.clip(x + step, *bounds)
+        f_new = fun(new)
+        for _ in range(30):
+            worse = ~(f_new >= f)
+            if not np.any(worse):
+                break
+            step = np.where(worse, step/2, step)
+            new = np.where(worse, np.clip(x + step, *bounds), new)
+            f_new = np.where(worse, fun(new), f_new)
+        improved = f_new >= f
+        moved = np.abs(np.where(improved, new, x) - x)
+        x, f = np.where(improved, new, x), np.where(improved, f_new, f)
+        if np.all(moved <= xtol*(1 + np.abs(x))):
+            break
+    return x, f, iteration
+
+def profile_likelihood(forest, target_param, grid, I, start=None, xtol=1e-10):
+    """
+    Profile log likelihood of a or b under the linear model for every tree in
+    a forest. At each grid value of the target parameter, the other (nuisance)
+    parameter is maximized for all trees at once with newton_max, starting
+    from its best value at the previous grid point. Neighbouring grid points
+    have nearly the same optimum, so after the first point each one only
+    takes a few Newton steps.
+
+    Parameters:
+      forest (Forest): Trees to profile
+      target_param (str): "a" or "b"
+      grid (ndarray): Values of the target parameter, best given in order
+      I (float or ndarray): Time of infection, shared or one per tree
+      start (float or ndarray, optional): Starting nuisance value for the first
+        grid point. 1 by default.
+      xtol (float): Relative tolerance of each inner optimization
+
+    Returns:
+      profile (ndarray): (len(grid), trees) array of profile log likelihoods
+      nuisance (ndarray): (len(grid), trees) array of the best nuisance values
+    """
+    n = len(forest)
+    nuisance = np.broadcast_to(np.asarray(1. if start is None else start, dtype=float), (n,)).copy()
+    profile = np.empty((len(grid), n))
+    best = np.empty((len(grid), n))
+    for j, value in enumerate(grid):
+        if target_param == "b":
+            # Maximize over a >= 0 directly
+            fun = lambda a: forest.lin_log_likelihood(a, value, I)
+            derivatives = lambda a: (forest.lin_log_likelihood_gradient(a, value, I)[:, 0],
+                                     forest.lin_log_likelihood_hessian(a, value, I)[:, 0, 0])
+            nuisance, profile[j], _ = newton_max(fun, derivatives, nuisance, bounds=(0, np.inf), xtol=xtol)
+            # The likelihood in a can have a second peak at a = 0, which a warm
+            # start would never leave, so check it too
+            at_zero = fun(np.zeros(n)) > profile[j]
+            if np.any(at_zero):
+                nuisance, profile[j], _ = newton_max(fun, derivatives, np.where(at_zero, 0., nuisance),
+                                                     bounds=(0, np.inf), xtol=xtol)
+        elif target_param == "a":
+            # Maximize over log(b)
+            fun = lambda u: forest.lin_log_likelihood(value, np.exp(u), I)
+            def derivatives(u):
+                b = np.exp(u)
+                d_b = forest.lin_log_likelihood_gradient(value, b, I)[:, 1]
+                d_bb = forest.lin_log_likelihood_hessian(value, b, I)[:, 1, 1]
+                return b*d_b, b**2*d_bb + b*d_b
+            log_b, profile[j], _ = newton_max(fun, derivatives, np.log(nuisance), xtol=xtol)
+            nuisance = np.exp(log_b)
+        else:
+            raise Exception(f"Can only profile a or b, not {target_param}")
+        best[j] = nuisance
+    return profile, best
+
+def profile_interval(grid, profile, drop=1.92, peak=None):
+    """
+    Read likelihood intervals off profile log likelihoods, interpolating
+    linearly between grid points. Where the profile has not dropped far
+    enough by the end of the grid, that end of the grid is returned.
+
+    Parameters:
+      grid (ndarray): Values of the target parameter, in increasing order
+      profile (ndarray): (len(grid), trees) array from profile_likelihood
+      drop (float): Drop from the peak log likelihood, 1.92 for 95% intervals
+      peak (ndarray, optional): Highest log likelihood of each tree. The
+        highest value on the grid by default.
+
+    Returns:
+      low (ndarray): Lower bound of each interval
+      high (ndarray): Upper bound of each interval
+    """
+    grid = np.asarray(grid, dtype=float)
+    if peak is None:
+        peak = np.max(profile, axis=0)
+    above = profile - (peak - drop) # >= 0 inside the interval
+    top = np.argmax(profile, axis=0)
+    low, high = np.empty(profile.shape[1]), np.empty(profile.shape[1])
+    for i in range(profile.shape[1]):
+        outside = np.flatnonzero(above[:, i] < 0)
+        left, right = outside[outside < top[i]], outside[outside > top[i]]
+        low[i] = _crossing(grid, above[:, i], left[-1]) if len(left) else grid[0]
+        high[i] = _crossing(grid, above[:, i], right[0] - 1) if len(right) else grid[-1]
+    return low, high
+
+def _crossing(grid, above, j):
+    """
+    Where a straight line between grid points j and j+1 crosses zero.
+    """
+    if not np.isfinite(above[j]):
+        return grid[j + 1] if above[j] < 0 else grid[j]
+    if not np.isfinite(above[j + 1]):
+        return grid[j]
+    return grid[j] + (grid[j + 1] - grid[j]) * above[j] / (above[j] - above[j + 1])
+
+#
+# Single-parameter maximum likelihood
+#
+
+def con_mle(forest):
+    """
+    Exact maximum likelihood N of every tree under the constant model. The
+    log likelihood is sum(log(lmd_i/N) - lmd_i*z_i/N), which peaks at
+    N = sum(lmd_i*z_i) / (number of segments).
+
+    Returns:
+      N (ndarray): Best N for each tree
+    """
+    lmd = forest.k*(forest.k - 1)/2
+    return forest._sum_trees(lmd*forest.dist) / np.bincount(forest.tree_index, minlength=len(forest))
+
+def con_standard_errors(forest, N=None):
+    """
+    Standard error of N for every tree under the constant model, from the
+    observed information at the MLE. With S segments this is S/N^2, so the
+    standard error is N/sqrt(S).
+
+    Parameters:
+      forest (Forest): Trees to fit
+      N (ndarray, optional): Best N of each tree, found with con_mle if not given
+
+    Returns:
+      stderr (ndarray): Standard error of N for each tree
+    """
+    N = con_mle(forest) if N is None else N
+    return N / np.sqrt(np.bincount(forest.tree_index, minlength=len(forest)))
+
+def con_exact_intervals(forest, drop=1.92):
+    """
+    Closed-form likelihood intervals for N of every tree under the constant
+    model, the same as con_confidence_intervals at con_mle without a search.
+    With S segments, the log likelihood falls from its peak by
+    S*(x - 1 - log(x)) at N = N_max/x, which is solved with both branches of
+    the Lambert W function. For many segments the interval approaches the
+    Fisher interval N_max*exp(+-sqrt(2*drop/S)).
+
+    Parameters:
+      forest (Forest): Trees to find intervals for
+      drop (float): Drop from the peak log likelihood, 1.92 for 95% intervals
+
+    Returns:
+      N (ndarray): Best N of each tree
+      low (ndarray): Lower bound of each interval
+      high (ndarray): Upper bound of each interval
+    """
+    N = con_mle(forest)
+    segments = np.bincount(forest.tree_index, minlength=len(forest))
+    y = -np.exp(-1 - drop/segments)
+    below = -lambertw(y, 0).real
+    above = -lambertw(y, -1).real
+    return N, N / above, N / below
+
+def lin_seed(forest, target_param, a=None, b=None, I=None):
+    """
+    A moment-based starting point for a or b under the linear model. The
+    constant model's exact N is taken as the population at the average
+    coalescence time of each tree, and the linear model is solved for the
+    missing parameter there.
+
+    Parameters:
+      forest (Forest): Trees to fit
+      target_param (str): "a" or "b"
+      a, b (float or ndarray): The fixed parameter
+      I (float or ndarray): Time of infection
+
+    Returns:
+      seed (ndarray): Starting value for each tree
+    """
+    lmd = forest.k*(forest.k - 1)/2
+    weight = lmd*forest.dist
+    mean_time = forest._sum_trees(weight*(forest.start + forest.dist/2)) / forest._sum_trees(weight)
+    N = con_mle(forest)
+    before_I = np.maximum(I - mean_time, 1e-10)
+    if target_param == "b":
+        return np.maximum(N - a, 0.1*N) / before_I
+    return np.maximum(N - b*before_I, 0.)
+
+def bracket_max(fun, center, factors=2.**np.arange(-6, 7)):
+    """
+    Bracket the maximum of many one-dimensional functions of a positive
+    parameter by trying a geometric grid of values around a center for each.
+
+    Parameters:
+      fun (function): Vectorized function, taking one value per problem
+      center (ndarray): Middle of the grid for each problem
+      factors (ndarray): Multiples of the center to try, in increasing order
+
+    Returns:
+      best (ndarray): Best value tried for each problem
+      low (ndarray): Next lower value tried (0 if nothing is lower)
+      high (ndarray): Next higher value tried (inf if nothing is higher)
+      value (ndarray): Value of fun at best
+    """
+    center = np.asarray(center, dtype=float)
+    candidates = center[np.newaxis, :] * np.asarray(factors)[:, np.newaxis]
+    values = np.array([fun(x) for x in candidates])
+    top = np.argmax(np.where(np.isnan(values), -np.inf, values), axis=0)
+    columns = np.arange(len(center))
+    padded = np.concatenate((np.zeros((1, len(center))), candidates, np.full((1, len(center)), np.inf)))
+    return candidates[top, columns], padded[top, columns], padded[top + 2, columns], values[top, columns]
+
+def warm_bracket(fun, start, seed, factors, warm_factors):
+    """
+    Like bracket_max, but around a warm start (e.g. the previous optimum in a
+    sweep) with the narrower warm_factors grid. Wherever the start is not
+    positive, or nothing on that grid has a finite value, the wider factors
+    grid around seed is used instead.
+
+    Returns:
+      best, low, high (ndarray): As for bracket_max
+    """
+    start = np.asarray(start, dtype=float)
+    best, low, high, value = bracket_max(fun, np.where(start > 0, start, seed), warm_factors)
+    cold = ~((start > 0) & np.isfinite(value))
+    if np.any(cold):
+        cold_bracket = bracket_max(fun, seed, factors)[:3]
+        best, low, high = [np.where(cold, c, w) for c, w in zip(cold_bracket, (best, low, high))]
+    return best, low, high
+
+def max_likelihood_forest(forest, target_param, fixed_params={}, start=None, xtol=1e-10):
+    """
+    Maximum likelihood estimate of one parameter for every tree in a forest
+    at once. Each search starts from a closed-form or moment-based estimate
+    (see con_mle and lin_seed), or from start if given. The maximum is first
+    bracketed on a coarse geometric grid around that point (see bracket_max),
+    or a narrower one around a usable warm start (see warm_bracket), then
+    found with newton_max using the exact derivatives, without leaving the
+    bracket. b is searched on a log scale. a is searched directly, since
+    its best value is often its bound of 0.
+
+    Parameters:
+      forest (Forest): Trees to fit
+      target_param (str): "N" for the constant model, "a" or "b" for the linear model
+      fixed_params (dict): The other linear parameter and I, e.g. {"b": 2, "I": 500}
+      start (float or ndarray, optional): Starting value for each tree, e.g. the
+        previous tree's optimum in a sweep. Ignored for "N", whose estimate is exact.
+      xtol (float): Relative tolerance
+
+    Returns:
+      peak (ndarray): Best value of the target parameter for each tree
+    """
+    n = len(forest)
+    if target_param == "N":
+        return con_mle(forest)
 
+    I = fixed_params["I"]
+    if target_param == "b":
+        a = fixed_params["a"]
+        seed = lin_seed(forest, "b", a=a, I=I)
+        # The likelihood has one peak in log b, so a few points are enough,
+        # and a warm start with a finite likelihood only needs to be checked
+        factors = 4.**np.arange(-1, 2)
+        fun = lambda b: forest.lin_log_likelihood(a, b, I)
+        if start is None:
+            best, low, high, _ = bracket_max(fun, seed, factors)
+        else:
+            start = np.broadcast_to(np.asarray(start, dtype=float), (n,))
+            best, low, high = warm_bracket(fun, start, seed, factors, np.ones(1))
+        fun = lambda u: forest.lin_log_likelihood(a, np.exp(u), I)
+        def derivatives(u):
+            b = np.exp(u)
+            d_b = forest.lin_log_likelihood_gradient(a, b, I)[:, 1]
+            d_bb = forest.lin_log_likelihood_hessian(a, b, I)[:, 1, 1]
+            return b*d_b, b**2*d_bb + b*d_b
+        with np.errstate(divide="ignore"):
+            bounds = (np.log(low), np.log(high))
+        return np.exp(newton_max(fun, derivatives, np.log(best), bounds=bounds, xtol=xtol)[0])
+    elif target_param == "a":
+        b = fixed_params["b"]
+        seed = lin_seed(forest, "a", b=b, I=I)
+        fun = lambda a: forest.lin_log_likelihood(a, b, I)
+        center = np.where(seed > 0, seed, con_mle(forest))
+        factors = 2.**np.arange(-6, 7)
+        if start is None:
+            best, low, high, _ = bracket_max(fun, center, factors)
+        else:
+            # A warm start of 0 says nothing about where an interior peak might
+            # be, so those trees still get the full grid
+            start = np.broadcast_to(np.asarray(start, dtype=float), (n,))
+            best, low, high = warm_bracket(fun, start, center, factors, 2.**np.arange(-1, 2))
+        derivatives = lambda a: (forest.lin_log_likelihood_gradient(a, b, I)[:, 0],
+                                 forest.lin_log_likelihood_hessian(a, b, I)[:, 0, 0])
+        peak, value, _ = newton_max(fun, derivatives, best, bounds=(low, high), xtol=xtol)
+        # a can have a second peak at its bound of 0, so always check it
+        at_zero = fun(np.zeros(n)) > np.nan_to_num(value, nan=-np.inf)
+        return np.where(at_zero, 0., peak)
+    raise Exception(f"Can only find the best N, a, or b, not {target_param}")
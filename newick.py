@@ -0,0 +1,73 @@
+import re
+from tree_arrays import TreeArrays
+
+# Punctuation, or a run of anything else (a name, a ":length", or both)
+_TOKEN = re.compile(r"[(),;]|[^(),;]+")
+
+def parse_newick(line):
+    """
+    Parse one Newick string straight into TreeArrays, without building any
+    ete3 objects. Nodes are numbered in preorder, so every parent comes
+    before its children.
+
+    Parameters:
+      line (str): Newick representation of a tree
+
+    Returns:
+      tree (TreeArrays): Parent, branch length, and name of every node
+    """
+    newick = line.strip()
+    parent, dist, names = [], [], []
+
+    def new_node(up):
+        parent.append(up)
+        dist.append(0.)
+        names.append("")
+        return len(parent) - 1
+
+    current = -1 # Node whose children we are reading
+    last = None # Node that a following label belongs to
+    previous = None
+    for token in _TOKEN.findall(newick):
+        if token.isspace():
+            continue
+        elif token == "(":
+            current = new_node(current)
+            last = None
+        elif token in ",)":
+            if previous in ("(", ","):
+                new_node(current) # Unnamed leaf like "(,A)"
+            if token == ")":
+                last = current
+                current = parent[current]
+            else:
+                last = None
+        elif token == ";":
+            break
+        else:
+            if last is None: # A label after "(" or "," starts a new leaf
+                last = new_node(current)
+            name, _, length = token.partition(":")
+            names[last] = name.strip()
+            if length.strip():
+                dist[last] = float(length)
+        previous = token
+
+    if not parent:
+        raise Exception(f"Could not find a tree in {line!r}")
+    return TreeArrays(parent, dist, names, newick=newick)
+
+def read_newick(filename):
+    """
+    Stream the trees in a file with one Newick tree per line, skipping blank lines.
+
+    Parameters:
+      filename (str): Path to the tree file
+
+    Yields:
+      tree (TreeArrays): Arrays for each tree in the file, in order
+    """
+    with open(filename) as treefile:
+        for line in treefile:
+            if line.strip():
+                yield parse_newick(line)
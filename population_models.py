@@ -1,3 +1,4 @@
+import numpy as np
 from numpy import exp
 from scipy.stats import expon
 
@@ -116,6 +117,17 @@ def con_nocoal_probability(params, start, z):
     """
     k, N, I = validate_params(params, ['k', 'N', 'I'])
 
+    lmd = k*(k - 1)/(2*N)
+    return exp(-lmd*z)
+
+def con_nocoal_probability_reference(params, start, z):
+    """
+    Reference version of con_nocoal_probability using scipy's exponential
+    distribution. Much slower, only kept to check the closed form against.
+    Takes the same parameters as con_nocoal_probability.
+    """
+    k, N, I = validate_params(params, ['k', 'N', 'I'])
+
     scale = (2*N) / (k*(k-1))
     dist = expon(scale=scale)
 
@@ -146,3 +158,434 @@ def lin_nocoal_probability(params, start, z):
     end_pop = a + (b * (I-start))
 
     return (end_pop ** -lmb) * (start_pop ** lmb)
+
+def exp_population(params, t):
+    """
+    Return the effective population T time units after infection
+    using an exponential model.
+
+    Parameters:
+      params (dict): Parameters describing the population dynamics
+        a (float): Population at the time of infection
+        r (float): Exponential rate of population growth (per generation)
+        I (float): Time of infection
+      t (float): Time since infection
+
+    Returns:
+      population (float): Effective population size at specified time
+    """
+    a, r, I = validate_params(params, ['a', 'r', 'I'])
+    return a*exp(r*(I-t))
+
+def exp_probability(params, start, z):
+    """
+    The proabaility of a coalescence at time z with exponential population
+
+    Parameters:
+      params (dict): Parameters specifying the state of the tree at a certain point in time.
+        k (int): Number of sequences
+        a (float): Population at time of infection
+        r (float): Exponential rate of effective population growth (per generation)
+        I (float): Time of infection
+      start (float): Start of the window for the coalescence event (where the previous event ended)
+      z (float): Time until the coalescence event (from start)
+
+    Returns:
+      probability (float): Probability of a coalescence event happening
+      exactly at the specified time
+    """
+    k, a, r, I = validate_params(params, ['k', 'a', 'r', 'I'])
+
+    lmd = k*(k-1)/2
+    start_pop = a*exp(r*(I-start-z))
+    return lmd * (1 / start_pop) * exp(-lmd * (1 - exp(-r*z)) / (r*start_pop))
+
+def exp_nocoal_probability(params, start, z):
+    """
+    The probability of no coalescence happening from start for z time
+    with exponential population.
+
+    Parameters:
+      params (dict): Parameters specifying the state of the tree at a certain point in time.
+        k (int): Number of sequences
+        a (float): Population at time of infection
+        r (float): Exponential rate of effective population growth (per generation)
+        I (float): Time of infection
+      start (float): Start of the window for the coalescence event (where the previous event ended)
+      z (float): Time until the coalescence event (from start)
+
+    Returns:
+      probability (float): Probability of no coalescence happening across the
+      specified time.
+    """
+    k, a, r, I = validate_params(params, ['k', 'a', 'r', 'I'])
+
+    lmd = k*(k-1)/2
+    start_pop = a*exp(r*(I-start-z))
+    return exp(-lmd * (1 - exp(-r*z)) / (r*start_pop))
+
+#
+# Log-space kernels. These take every segment of a tree at once and return the
+# summed log likelihood, so they can sit inside an optimizer without per-segment
+# Python calls. Parameters can be arrays, in which case they are broadcast
+# against each other and one log likelihood is returned per parameter value.
+#
+
+def con_log_probability(start, z, k, N):
+    """
+    The log probability of a coalescence at time z with constant population,
+    for each segment separately. All arguments are broadcast against each other.
+
+    Parameters:
+      start (ndarray): Start of the window for the coalescence event (unused,
+        kept to match lin_log_probability)
+      z (ndarray): Time until the coalescence event (from start)
+      k (ndarray): Number of sequences
+      N (float or ndarray): Population size
+
+    Returns:
+      log_probability (ndarray): Log probability of each coalescence event.
+      -inf where N is not positive.
+    """
+    lmd = k*(k - 1)/2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        log_p = np.log(lmd) - np.log(N) - lmd*z/N
+    return np.where(np.asarray(N) > 0, log_p, -np.inf)
+
+def lin_log_probability(start, z, k, a, b, I):
+    """
+    The log probability of a coalescence at time z with linear population,
+    for each segment separately. All arguments are broadcast against each other.
+
+    Parameters:
+      start (ndarray): Start of the window for the coalescence event
+      z (ndarray): Time until the coalescence event (from start)
+      k (ndarray): Number of sequences
+      a (float or ndarray): Population at time of infection
+      b (float or ndarray): Linear rate of effective population increase (per generation)
+      I (float or ndarray): Time of infection
+
+    Returns:
+      log_probability (ndarray): Log probability of each coalescence event.
+      -inf where the parameters are invalid or the population is not positive.
+    """
+    lmd = k*(k - 1)/2
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        start_pop = a + b*(I - start - z)
+        # log(end_pop/start_pop), written with log1p so short segments stay accurate
+        log_ratio = np.log1p(b*z / start_pop)
+        log_p = np.log(lmd) - np.log(start_pop) - (lmd/b)*log_ratio
+    valid = (np.asarray(b) > 0) & (np.asarray(a) >= 0) & (start_pop > 0)
+    return np.where(valid, log_p, -np.inf)
+
+def con_log_nocoal_probability(start, z, k, N):
+    """
+    The log probability of no coalescence happening from start for z time
+    with constant population, for each segment separately. Closed form of
+    log(con_nocoal_probability).
+
+    Parameters:
+      start (ndarray): Start of the window (unused, kept to match lin_log_nocoal_probability)
+      z (ndarray): Length of the window without a coalescence
+      k (ndarray): Number of sequences
+      N (float or ndarray): Population size
+
+    Returns:
+      log_probability (ndarray): Log probability of no coalescence in each window.
+      -inf where N is not positive.
+    """
+    lmd = k*(k - 1)/2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        log_p = -lmd*z/N
+    return np.where(np.asarray(N) > 0, log_p, -np.inf)
+
+def lin_log_nocoal_probability(start, z, k, a, b, I):
+    """
+    The log probability of no coalescence happening from start for z time
+    with linear population, for each segment separately. Closed form of
+    log(lin_nocoal_probability).
+
+    Parameters:
+      start (ndarray): Start of the window
+      z (ndarray): Length of the window without a coalescence
+      k (ndarray): Number of sequences
+      a (float or ndarray): Population at time of infection
+      b (float or ndarray): Linear rate of effective population increase (per generation)
+      I (float or ndarray): Time of infection
+
+    Returns:
+      log_probability (ndarray): Log probability of no coalescence in each window.
+      -inf where the parameters are invalid or the population is not positive.
+    """
+    lmd = k*(k - 1)/2
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        start_pop = a + b*(I - start - z)
+        log_p = -(lmd/b)*np.log1p(b*z / start_pop)
+    valid = (np.asarray(b) > 0) & (np.asarray(a) >= 0) & (start_pop > 0)
+    return np.where(valid, log_p, -np.inf)
+
+def exp_log_probability(start, z, k, a, r, I):
+    """
+    The log probability of a coalescence at time z with exponential population,
+    for each segment separately. All arguments are broadcast against each other.
+
+    Parameters:
+      start (ndarray): Start of the window for the coalescence event
+      z (ndarray): Time until the coalescence event (from start)
+      k (ndarray): Number of sequences
+      a (float or ndarray): Population at time of infection
+      r (float or ndarray): Exponential rate of effective population growth (per generation)
+      I (float or ndarray): Time of infection
+
+    Returns:
+      log_probability (ndarray): Log probability of each coalescence event.
+      -inf where the parameters are invalid.
+    """
+    lmd = k*(k - 1)/2
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        log_start_pop = np.log(a) + r*(I - start - z)
+        # The integral of 1/population over the segment is -expm1(-r*z)/(r*start_pop)
+        log_p = np.log(lmd) - log_start_pop + (lmd/r)*np.expm1(-r*z)*np.exp(-log_start_pop)
+    valid = (np.asarray(r) > 0) & (np.asarray(a) > 0)
+    return np.where(valid, log_p, -np.inf)
+
+def exp_log_nocoal_probability(start, z, k, a, r, I):
+    """
+    The log probability of no coalescence happening from start for z time
+    with exponential population, for each segment separately. Closed form of
+    log(exp_nocoal_probability).
+
+    Parameters:
+      start (ndarray): Start of the window
+      z (ndarray): Length of the window without a coalescence
+      k (ndarray): Number of sequences
+      a (float or ndarray): Population at time of infection
+      r (float or ndarray): Exponential rate of effective population growth (per generation)
+      I (float or ndarray): Time of infection
+
+    Returns:
+      log_probability (ndarray): Log probability of no coalescence in each window.
+      -inf where the parameters are invalid.
+    """
+    lmd = k*(k - 1)/2
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        log_p = (lmd/r)*np.expm1(-r*z)*np.exp(-r*(I - start - z))/a
+    valid = (np.asarray(r) > 0) & (np.asarray(a) > 0)
+    return np.where(valid, log_p, -np.inf)
+
+def con_log_likelihood(start, z, k, N):
+    """
+    The summed log probability of coalescences at the end of each segment
+    with constant population.
+
+    Parameters:
+      start (ndarray): Start of each segment (unused, kept to match lin_log_likelihood)
+      z (ndarray): Time until the coalescence event for each segment
+      k (ndarray): Number of sequences during each segment
+      N (float or ndarray): Population size
+
+    Returns:
+      log_likelihood (float or ndarray): Log likelihood for each value of N.
+      -inf where N is not positive.
+    """
+    N = np.asarray(N, dtype=float)
+    lmd = k*(k - 1)/2
+    # sum(log(lmd/N) - lmd*z/N) only depends on N through two sums
+    log_lmd_sum = np.sum(np.log(lmd))
+    rate_sum = np.sum(lmd*z)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        log_lk = log_lmd_sum - len(lmd)*np.log(N) - rate_sum/N
+    return np.where(N > 0, log_lk, -np.inf)
+
+def lin_log_likelihood(start, z, k, a, b, I):
+    """
+    The summed log probability of coalescences at the end of each segment
+    with linear population.
+
+    Parameters:
+      start (ndarray): Start of the window for each coalescence event
+      z (ndarray): Time until the coalescence event for each segment
+      k (ndarray): Number of sequences during each segment
+      a (float or ndarray): Population at time of infection
+      b (float or ndarray): Linear rate of effective population increase (per generation)
+      I (float or ndarray): Time of infection
+
+    Returns:
+      log_likelihood (float or ndarray): Log likelihood for each combination of
+      a, b, and I. -inf where the parameters are invalid or the population is not
+      positive for the whole tree.
+    """
+    a, b, I = np.broadcast_arrays(*[np.asarray(p, dtype=float) for p in (a, b, I)])
+    a, b, I = a[..., np.newaxis], b[..., np.newaxis], I[..., np.newaxis]
+    return np.sum(lin_log_probability(start, z, k, a, b, I), axis=-1)
+
+def exp_log_likelihood(start, z, k, a, r, I):
+    """
+    The summed log probability of coalescences at the end of each segment
+    with exponential population.
+
+    Parameters:
+      start (ndarray): Start of the window for each coalescence event
+      z (ndarray): Time until the coalescence event for each segment
+      k (ndarray): Number of sequences during each segment
+      a (float or ndarray): Population at time of infection
+      r (float or ndarray): Exponential rate of effective population growth (per generation)
+      I (float or ndarray): Time of infection
+
+    Returns:
+      log_likelihood (float or ndarray): Log likelihood for each combination of
+      a, r, and I. -inf where the parameters are invalid.
+    """
+    a, r, I = np.broadcast_arrays(*[np.asarray(p, dtype=float) for p in (a, r, I)])
+    a, r, I = a[..., np.newaxis], r[..., np.newaxis], I[..., np.newaxis]
+    return np.sum(exp_log_probability(start, z, k, a, r, I), axis=-1)
+
+#
+# Derivatives of the log likelihoods, for optimizers and standard errors.
+# The *_probability_* versions give the derivative for each segment separately
+# (so Forest can add them up per tree), and the *_likelihood_* versions sum
+# them and broadcast over the parameters like the log likelihoods above.
+#
+
+def con_log_probability_derivatives(start, z, k, N):
+    """
+    The first and second derivative of con_log_probability with respect to N,
+    for each segment separately. All arguments are broadcast against each other.
+
+    Returns:
+      gradient (ndarray): d log_probability / dN
+      hessian (ndarray): d^2 log_probability / dN^2
+    """
+    lmd = k*(k - 1)/2
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        return -1/N + lmd*z/N**2, 1/N**2 - 2*lmd*z/N**3
+
+def con_log_likelihood_derivatives(start, z, k, N):
+    """
+    The first and second derivative of con_log_likelihood with respect to N.
+
+    Parameters:
+      start (ndarray): Start of each segment (unused, kept to match lin_log_likelihood)
+      z (ndarray): Time until the coalescence event for each segment
+      k (ndarray): Number of sequences during each segment
+      N (float or ndarray): Population size
+
+    Returns:
+      gradient (float or ndarray): d log_likelihood / dN for each value of N
+      hessian (float or ndarray): d^2 log_likelihood / dN^2 for each value of N
+    """
+    N = np.asarray(N, dtype=float)
+    lmd = k*(k - 1)/2
+    segments, rate_sum = len(lmd), np.sum(lmd*z)
+    gradient = -segments/N + rate_sum/N**2
+    hessian = segments/N**2 - 2*rate_sum/N**3
+    return gradient, hessian
+
+def _lin_terms(start, z, k, a, b, I):
+    lmd = k*(k - 1)/2
+    u, w = I - start, I - start - z # Time before I at the start and end of each segment
+    end_pop, start_pop = a + b*u, a + b*w
+    log_ratio = np.log1p(b*z / start_pop)
+    return lmd, u, w, end_pop, start_pop, log_ratio
+
+def lin_log_probability_gradient(start, z, k, a, b, I):
+    """
+    The gradient of lin_log_probability with respect to (a, b), for each
+    segment separately. All arguments are broadcast against each other.
+
+    Returns:
+      d_a (ndarray): d log_probability / da
+      d_b (ndarray): d log_probability / db
+    """
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        lmd, u, w, end_pop, start_pop, log_ratio = _lin_terms(start, z, k, a, b, I)
+        d_a = -1/start_pop - (lmd/b)*(1/end_pop - 1/start_pop)
+        d_b = -w/start_pop + (lmd/b**2)*log_ratio - (lmd/b)*(u/end_pop - w/start_pop)
+    return d_a, d_b
+
+def lin_log_probability_hessian(start, z, k, a, b, I):
+    """
+    The Hessian of lin_log_probability with respect to (a, b), for each
+    segment separately. All arguments are broadcast against each other.
+
+    Returns:
+      d_aa, d_ab, d_bb (ndarray): Second derivatives of log_probability
+    """
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        lmd, u, w, end_pop, start_pop, log_ratio = _lin_terms(start, z, k, a, b, I)
+        d_aa = 1/start_pop**2 - (lmd/b)*(1/start_pop**2 - 1/end_pop**2)
+        d_ab = (w/start_pop**2 - (lmd/b)*(w/start_pop**2 - u/end_pop**2)
+                + (lmd/b**2)*(1/end_pop - 1/start_pop))
+        d_bb = (w**2/start_pop**2 - 2*(lmd/b**3)*log_ratio + 2*(lmd/b**2)*(u/end_pop - w/start_pop)
+                - (lmd/b)*(w**2/start_pop**2 - u**2/end_pop**2))
+    return d_aa, d_ab, d_bb
+
+def lin_log_likelihood_gradient(start, z, k, a, b, I):
+    """
+    The gradient of lin_log_likelihood with respect to (a, b).
+
+    Parameters:
+      start, z, k (ndarray): Segments, as for lin_log_likelihood
+      a, b, I (float or ndarray): Linear population parameters, broadcast against each other
+
+    Returns:
+      gradient (ndarray): Array with a last axis of length 2 holding
+      d/da and d/db for each combination of a, b, and I
+    """
+    a, b, I = np.broadcast_arrays(*[np.asarray(p, dtype=float) for p in (a, b, I)])
+    a, b, I = a[..., np.newaxis], b[..., np.newaxis], I[..., np.newaxis]
+    d_a, d_b = lin_log_probability_gradient(start, z, k, a, b, I)
+    return np.stack((np.sum(d_a, axis=-1), np.sum(d_b, axis=-1)), axis=-1)
+
+def lin_log_likelihood_hessian(start, z, k, a, b, I):
+    """
+    The Hessian of lin_log_likelihood with respect to (a, b).
+
+    Parameters:
+      start, z, k (ndarray): Segments, as for lin_log_likelihood
+      a, b, I (float or ndarray): Linear population parameters, broadcast against each other
+
+    Returns:
+      hessian (ndarray): Array with two last axes of length 2, ordered (a, b),
+      for each combination of a, b, and I
+    """
+    a, b, I = np.broadcast_arrays(*[np.asarray(p, dtype=float) for p in (a, b, I)])
+    a, b, I = a[..., np.newaxis], b[..., np.newaxis], I[..., np.newaxis]
+    d_aa, d_ab, d_bb = [np.sum(d, axis=-1) for d in lin_log_probability_hessian(start, z, k, a, b, I)]
+    return np.stack((np.stack((d_aa, d_ab), axis=-1), np.stack((d_ab, d_bb), axis=-1)), axis=-2)
+
+def exp_log_probability_gradient(start, z, k, a, r, I):
+    """
+    The gradient of exp_log_probability with respect to (a, r), for each
+    segment separately. All arguments are broadcast against each other.
+
+    Returns:
+      d_a (ndarray): d log_probability / da
+      d_r (ndarray): d log_probability / dr
+    """
+    lmd = k*(k - 1)/2
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        w = I - start - z # Time before I at the end of each segment
+        start_pop = a*np.exp(r*w)
+        area = -np.expm1(-r*z)/r # Integral of exp(-r*(t - start)) over the segment
+        d_area = (z*np.exp(-r*z) - area)/r
+        d_a = -1/a + lmd*area/(a*start_pop)
+        d_r = -w - lmd*(d_area - w*area)/start_pop
+    return d_a, d_r
+
+def exp_log_likelihood_gradient(start, z, k, a, r, I):
+    """
+    The gradient of exp_log_likelihood with respect to (a, r).
+
+    Parameters:
+      start, z, k (ndarray): Segments, as for exp_log_likelihood
+      a, r, I (float or ndarray): Exponential population parameters, broadcast against each other
+
+    Returns:
+      gradient (ndarray): Array with a last axis of length 2 holding
+      d/da and d/dr for each combination of a, r, and I
+    """
+    a, r, I = np.broadcast_arrays(*[np.asarray(p, dtype=float) for p in (a, r, I)])
+    a, r, I = a[..., np.newaxis], r[..., np.newaxis], I[..., np.newaxis]
+    d_a, d_r = exp_log_probability_gradient(start, z, k, a, r, I)
+    return np.stack((np.sum(d_a, axis=-1), np.sum(d_r, axis=-1)), axis=-1)
@@ -0,0 +1,350 @@
+import numpy as np
+from tree_arrays import TreeArrays
+from population_models import con_log_probability, lin_log_probability, exp_log_probability, \
+        con_log_nocoal_probability, lin_log_nocoal_probability, exp_log_nocoal_probability, \
+        con_log_probability_derivatives, lin_log_probability_gradient, lin_log_probability_hessian, \
+        exp_log_probability_gradient
+
+class SegmentTable:
+    """
+    Compiled version of the segments of a single-host tree. Each segment
+    is the time between two coalescence events, stored as NumPy arrays so
+    a likelihood can be found with a few vector operations instead of a
+    traversal of the tree.
+
+    Attributes:
+      start (ndarray): Start time of each segment
+      end (ndarray): End time of each segment
+      dist (ndarray): Length of each segment, rounded the same way as tree_segments
+      k (ndarray): Number of lineages present during each segment
+      time (float): Time of the root of the tree
+    """
+    def __init__(self, start, end, dist, k, time):
+        self.start = start
+        self.end = end
+        self.dist = dist
+        self.k = k
+        self.time = time
+
+    def __len__(self):
+        return len(self.start)
+
+    @classmethod
+    def from_times(cls, node_times, leaves, start=0):
+        """
+        Build a segment table from the times of the parent nodes of a tree.
+
+        Parameters:
+          node_times (iterable): Time of every node with children
+          leaves (int): Number of tips in the tree, all at the same time
+          start (float, default 0): Initial time value
+
+        Returns:
+          table (SegmentTable): Segments of the tree
+        """
+        node_times = np.sort(np.asarray(node_times, dtype=float))
+        times = np.concatenate(([start], node_times))
+        seg_start = times[:-1]
+        seg_end = times[1:]
+        dist = np.round(seg_end - seg_start, 5)
+        k = leaves - np.arange(len(seg_start))
+        root_time = times[-1] if len(node_times) else start
+        return cls(seg_start, seg_end, dist, k, root_time)
+
+    @classmethod
+    def from_tree(cls, tree, start=0):
+        """
+        Compile a TimeTree into a segment table. The result matches
+        tree_segments, with k added for each segment.
+
+        Parameters:
+          tree (TimeTree): Tree with a single host and tips at the same time
+          start (float, default 0): Initial time value
+
+        Returns:
+          table (SegmentTable): Segments of the tree
+        """
+        node_times = []
+        leaves = 0
+        for node in tree.traverse():
+            if node.children:
+                node_times.append(node.time)
+            else:
+                leaves += 1
+        table = cls.from_times(node_times, leaves, start=start)
+        table.time = tree.time
+        return table
+
+    @classmethod
+    def from_arrays(cls, tree, start=0):
+        """
+        Compile TreeArrays (e.g. from newick.read_newick) into a segment table
+        without building a TimeTree.
+
+        Parameters:
+          tree (TreeArrays): Tree with a single host and tips at the same time
+          start (float, default 0): Initial time value
+
+        Returns:
+          table (SegmentTable): Segments of the tree
+        """
+        is_leaf = tree.is_leaf
+        time = tree.time
+        table = cls.from_times(time[~is_leaf], np.count_nonzero(is_leaf), start=start)
+        table.time = time[tree.root]
+        return table
+
+def as_segment_table(tree):
+    """
+    Return tree (a TimeTree, TreeArrays, or SegmentTable) as a SegmentTable,
+    compiling it only if it is not one already.
+    """
+    if isinstance(tree, SegmentTable):
+        return tree
+    if isinstance(tree, TreeArrays):
+        return SegmentTable.from_arrays(tree)
+    return SegmentTable.from_tree(tree)
+
+class Forest:
+    """
+    Many segment tables packed into flat (ragged) arrays, so that per-tree
+    log likelihoods of a whole file of trees can be found in one vectorized
+    pass. Tree i owns the segments offsets[i]:offsets[i+1].
+
+    Attributes:
+      start, end, dist, k (ndarray): Concatenated segment arrays of every tree
+      offsets (ndarray): Index of the first segment of each tree, plus the total
+      tree_index (ndarray): Index of the tree each segment belongs to
+      time (ndarray): Time of the root of each tree
+    """
+    def __init__(self, tables):
+        tables = list(tables)
+        lengths = np.array([len(table) for table in tables], dtype=int)
+        self.offsets = np.concatenate(([0], np.cumsum(lengths)))
+        self.tree_index = np.repeat(np.arange(len(tables)), lengths)
+        self.time = np.array([table.time for table in tables], dtype=float)
+        for name in ["start", "end", "dist", "k"]:
+            arrays = [getattr(table, name) for table in tables]
+            setattr(self, name, np.concatenate(arrays) if arrays else np.array([]))
+
+    def __len__(self):
+        return len(self.time)
+
+    @classmethod
+    def from_flat(cls, start, end, dist, k, tree_index, time):
+        """
+        Build a forest from segment arrays that are already packed.
+
+        Parameters:
+          start, end, dist, k (ndarray): Segment arrays, grouped by tree
+          tree_index (ndarray): Index of the tree each segment belongs to, in
+            increasing order
+          time (ndarray): One time value for each tree
+
+        Returns:
+          forest (Forest): Forest sharing the given arrays
+        """
+        forest = cls([])
+        forest.start, forest.end, forest.dist, forest.k = start, end, dist, k
+        forest.tree_index = tree_index
+        forest.time = np.asarray(time, dtype=float)
+        forest.offsets = np.searchsorted(tree_index, np.arange(len(forest.time) + 1))
+        return forest
+
+    @classmethod
+    def from_times(cls, node_times, leaves, start=0):
+        """
+        Build a forest from the parent node times of many trees with the same
+        number of tips, like SegmentTable.from_times for each row.
+
+        Parameters:
+          node_times (ndarray): (trees, leaves-1) array of the times of every
+            node with children, each row for one tree
+          leaves (int): Number of tips in each tree, all at the same time
+          start (float, default 0): Initial time value
+
+        Returns:
+          forest (Forest): Segments of every tree
+        """
+        node_times = np.sort(np.asarray(node_times, dtype=float), axis=1)
+        trees, segments = node_times.shape
+        seg_start = np.concatenate((np.full((trees, 1), float(start)), node_times[:, :-1]), axis=1)
+        dist = np.round(node_times - seg_start, 5)
+        k = np.tile(leaves - np.arange(segments), trees)
+        tree_index = np.repeat(np.arange(trees), segments)
+        root_time = node_times[:, -1] if segments else np.full(trees, float(start))
+        return cls.from_flat(seg_start.ravel(), node_times.ravel(), dist.ravel(), k, tree_index, root_time)
+
+    @classmethod
+    def from_trees(cls, trees):
+        """
+        Compile a list of TimeTrees (or TreeArrays or SegmentTables) into a forest.
+        For a whole file, Forest.from_trees(read_newick(filename)) avoids ete3 entirely.
+        """
+        return cls(as_segment_table(tree) for tree in trees)
+
+    def table(self, i):
+        """
+        Return the segments of tree i as a SegmentTable (views, not copies).
+        """
+        low, high = self.offsets[i], self.offsets[i+1]
+        return SegmentTable(self.start[low:high], self.end[low:high], self.dist[low:high],
+                            self.k[low:high], self.time[i])
+
+    def subset(self, indices):
+        """
+        Return a new forest containing only the trees at the given indices.
+        """
+        return Forest(self.table(i) for i in indices)
+
+    def _per_segment(self, param):
+        """
+        Spread a parameter over the segments. Scalars are shared by every tree,
+        arrays must have one value per tree.
+        """
+        param = np.asarray(param, dtype=float)
+        if param.ndim == 0:
+            return param
+        return param[self.tree_index]
+
+    def _sum_trees(self, segment_lk):
+        return np.bincount(self.tree_index, weights=segment_lk, minlength=len(self))
+
+    def con_log_likelihood(self, N):
+        """
+        Log likelihood of every tree under a constant population model.
+
+        Parameters:
+          N (float or ndarray): Population size, shared or one per tree
+
+        Returns:
+          log_likelihood (ndarray): One log likelihood per tree
+        """
+        return self._sum_trees(con_log_probability(self.start, self.dist, self.k, self._per_segment(N)))
+
+    def lin_log_likelihood(self, a, b, I):
+        """
+        Log likelihood of every tree under a linear population model.
+
+        Parameters:
+          a (float or ndarray): Population at time of infection, shared or one per tree
+          b (float or ndarray): Linear rate of population increase, shared or one per tree
+          I (float or ndarray): Time of infection, shared or one per tree
+
+        Returns:
+          log_likelihood (ndarray): One log likelihood per tree
+        """
+        segment_lk = lin_log_probability(self.start, self.dist, self.k, self._per_segment(a),
+                                         self._per_segment(b), self._per_segment(I))
+        return self._sum_trees(segment_lk)
+
+    def exp_log_likelihood(self, a, r, I):
+        """
+        Log likelihood of every tree under an exponential population model.
+
+        Parameters:
+          a (float or ndarray): Population at time of infection, shared or one per tree
+          r (float or ndarray): Exponential rate of population growth, shared or one per tree
+          I (float or ndarray): Time of infection, shared or one per tree
+
+        Returns:
+          log_likelihood (ndarray): One log likelihood per tree
+        """
+        segment_lk = exp_log_probability(self.start, self.dist, self.k, self._per_segment(a),
+                                         self._per_segment(r), self._per_segment(I))
+        return self._sum_trees(segment_lk)
+
+    def con_log_nocoal_likelihood(self, N):
+        """
+        Log probability, for every tree, that none of its segments end in a
+        coalescence under a constant population model.
+
+        Parameters:
+          N (float or ndarray): Population size, shared or one per tree
+
+        Returns:
+          log_likelihood (ndarray): One log probability per tree
+        """
+        return self._sum_trees(con_log_nocoal_probability(self.start, self.dist, self.k, self._per_segment(N)))
+
+    def lin_log_nocoal_likelihood(self, a, b, I):
+        """
+        Log probability, for every tree, that none of its segments end in a
+        coalescence under a linear population model.
+
+        Parameters:
+          a (float or ndarray): Population at time of infection, shared or one per tree
+          b (float or ndarray): Linear rate of population increase, shared or one per tree
+          I (float or ndarray): Time of infection, shared or one per tree
+
+        Returns:
+          log_likelihood (ndarray): One log probability per tree
+        """
+        segment_lk = lin_log_nocoal_probability(self.start, self.dist, self.k, self._per_segment(a),
+                                                self._per_segment(b), self._per_segment(I))
+        return self._sum_trees(segment_lk)
+
+    def exp_log_nocoal_likelihood(self, a, r, I):
+        """
+        Log probability, for every tree, that none of its segments end in a
+        coalescence under an exponential population model.
+
+        Parameters:
+          a (float or ndarray): Population at time of infection, shared or one per tree
+          r (float or ndarray): Exponential rate of population growth, shared or one per tree
+          I (float or ndarray): Time of infection, shared or one per tree
+
+        Returns:
+          log_likelihood (ndarray): One log probability per tree
+        """
+        segment_lk = exp_log_nocoal_probability(self.start, self.dist, self.k, self._per_segment(a),
+                                                self._per_segment(r), self._per_segment(I))
+        return self._sum_trees(segment_lk)
+
+    def con_log_likelihood_derivatives(self, N):
+        """
+        First and second derivative of con_log_likelihood with respect to N.
+
+        Parameters:
+          N (float or ndarray): Population size, shared or one per tree
+
+        Returns:
+          gradient (ndarray): One derivative per tree
+          hessian (ndarray): One second derivative per tree
+        """
+        gradient, hessian = con_log_probability_derivatives(self.start, self.dist, self.k, self._per_segment(N))
+        return self._sum_trees(gradient), self._sum_trees(hessian)
+
+    def lin_log_likelihood_gradient(self, a, b, I):
+        """
+        Gradient of lin_log_likelihood with respect to (a, b).
+
+        Returns:
+          gradient (ndarray): (trees, 2) array of d/da and d/db for each tree
+        """
+        parts = lin_log_probability_gradient(self.start, self.dist, self.k, self._per_segment(a),
+                                             self._per_segment(b), self._per_segment(I))
+        return np.stack([self._sum_trees(part) for part in parts], axis=-1)
+
+    def lin_log_likelihood_hessian(self, a, b, I):
+        """
+        Hessian of lin_log_likelihood with respect to (a, b).
+
+        Returns:
+          hessian (ndarray): (trees, 2, 2) array, ordered (a, b), for each tree
+        """
+        d_aa, d_ab, d_bb = [self._sum_trees(part) for part in
+                            lin_log_probability_hessian(self.start, self.dist, self.k, self._per_segment(a),
+                                                        self._per_segment(b), self._per_segment(I))]
+        return np.stack((np.stack((d_aa, d_ab), axis=-1), np.stack((d_ab, d_bb), axis=-1)), axis=-2)
+
+    def exp_log_likelihood_gradient(self, a, r, I):
+        """
+        Gradient of exp_log_likelihood with respect to (a, r).
+
+        Returns:
+          gradient (ndarray): (trees, 2) array of d/da and d/dr for each tree
+        """
+        parts = exp_log_probability_gradient(self.start, self.dist, self.k, self._per_segment(a),
+                                             self._per_segment(r), self._per_segment(I))
+        return np.stack([self._sum_trees(part) for part in parts], axis=-1)
@@ -1,8 +1,16 @@
 import unittest
+import itertools
+import numpy as np
 from tree_likelihood import *
 from population_models import *
 from numpy import inf
+from scipy.stats import expon
 from time_tree import *
+from segment_table import *
+from new_optimization import *
+from newick import *
+from tree_generation import *
+from models import *
 
 #
 # population_models.py
@@ -43,6 +51,68 @@ class TestProbability(unittest.TestCase):
     def test_lin_prob_timelarge(self):
         self.assertAlmostEqual(lin_probability({"a": 5, "k": 20, "b": 3, "I": 30}, 0, 20), 1.8613728e-27)
 
+
+class TestLogLikelihood(unittest.TestCase):
+
+    def test_con_log_matches_probability(self):
+        self.assertAlmostEqual(con_log_likelihood(np.array([0.]), np.array([3.]), np.array([20]), 1000),
+                np.log(0.1074498), places=5)
+
+    def test_lin_log_matches_probability(self):
+        # The 1.86e-27 case, which is fine in log space
+        self.assertAlmostEqual(lin_log_likelihood(np.array([0.]), np.array([20.]), np.array([20]), 5, 3, 30),
+                np.log(1.8613728e-27), places=5)
+
+    def test_lin_log_no_underflow(self):
+        start, z, k = np.array([0.]), np.array([40.]), np.array([200])
+        self.assertEqual(lin_probability({"a": 5, "k": 200, "b": 1, "I": 50}, 0, 40), 0)
+        self.assertTrue(np.isfinite(lin_log_likelihood(start, z, k, 5, 1, 50)))
+
+    def test_con_log_batched(self):
+        start, z, k = np.array([0., 1.]), np.array([1., 2.]), np.array([3, 2])
+        actual = con_log_likelihood(start, z, k, np.array([10, 100, -1]))
+        self.assertEqual(actual.shape, (3,))
+        self.assertAlmostEqual(actual[1], con_log_likelihood(start, z, k, 100))
+        self.assertEqual(actual[2], -inf)
+
+    def test_lin_log_batched(self):
+        start, z, k = np.array([0., 1.]), np.array([1., 2.]), np.array([3, 2])
+        actual = lin_log_likelihood(start, z, k, 5, np.array([[1.], [2.]]), np.array([6, 7, 8]))
+        self.assertEqual(actual.shape, (2, 3))
+        self.assertAlmostEqual(actual[1, 2], lin_log_likelihood(start, z, k, 5, 2, 8))
+
+    def test_lin_log_invalid(self):
+        start, z, k = np.array([0.]), np.array([1.]), np.array([2])
+        self.assertEqual(lin_log_likelihood(start, z, k, 5, 0, 6), -inf)
+        self.assertEqual(lin_log_likelihood(start, z, k, -1, 1, 6), -inf)
+
+    def test_con_nocoal_matches_scipy(self):
+        for k, N, z in [(2, 1, 0.5), (20, 1000, 3), (5, 0.1, 2), (100, 50, 0.01)]:
+            params = {"k": k, "N": N, "I": 0}
+            self.assertAlmostEqual(con_nocoal_probability(params, 0, z),
+                    con_nocoal_probability_reference(params, 0, z), places=12)
+        z, k, N = np.array([0.5, 3, 40, 1e-4]), np.array([2, 20, 30, 100]), np.array([1, 1000, 0.5, 50])
+        np.testing.assert_allclose(con_log_nocoal_probability(0, z, k, N),
+                expon(scale=2*N/(k*(k-1))).logsf(z))
+
+    def test_nocoal_log_matches_probability(self):
+        con_params = {"k": 4, "N": 20, "I": 0}
+        lin_params = {"k": 4, "a": 5, "b": 2, "I": 30}
+        self.assertAlmostEqual(con_log_nocoal_probability(1., 2., 4, 20),
+                np.log(con_nocoal_probability(con_params, 1., 2.)))
+        self.assertAlmostEqual(lin_log_nocoal_probability(1., 2., 4, 5, 2, 30),
+                np.log(lin_nocoal_probability(lin_params, 1., 2.)))
+
+    def test_exp_log_matches_probability(self):
+        params = {"k": 4, "a": 5, "r": 0.5, "I": 30}
+        self.assertAlmostEqual(exp_log_likelihood(np.array([1.]), np.array([2.]), np.array([4]), 5, 0.5, 30),
+                np.log(exp_probability(params, 1., 2.)))
+        self.assertAlmostEqual(exp_log_nocoal_probability(1., 2., 4, 5, 0.5, 30),
+                np.log(exp_nocoal_probability(params, 1., 2.)))
+        # A slowly growing population is almost constant
+        start, z, k = np.array([0., 1.]), np.array([1., 2.]), np.array([3, 2])
+        self.assertAlmostEqual(exp_log_likelihood(start, z, k, 10, 1e-9, 5), con_log_likelihood(start, z, k, 10))
+
 #
 # time_tree.py
 #
@@ -57,7 +127,65 @@ class TestTimeTree(unittest.TestCase):
         t = TimeTree("((A:1, B:1):1, C:2);")
         self.assertTrue(all([n.time == 0 for n in t.iter_leaves()]))
 
-    # TODO I have not tested anything having to do with hosts.
+    def test_internal_times(self):
+        t = TimeTree("((((A:1.5, A:1.5):1.5, A:3):1.5, (A:1, A:1):3.5):0.5, A:5);")
+        self.assertEqual(sorted(n.time for n in t.traverse() if n.children), [1, 1.5, 3, 4.5, 5])
+
+    def test_lazy_times(self):
+        t = TimeTree("((A:1, B:1):1, C:2);", lazy_times=True)
+        self.assertNotIn("time", t.__dict__)
+        self.assertEqual(t.children[0].time, 1)
+        self.assertTrue(all([n.time == 0 for n in t.iter_leaves()]))
+
+    def test_split_keeps_times(self):
+        t = TimeTree("((A:1, B:1):2, C:3);")
+        before, after = t.split_at_time(2)
+        self.assertEqual(before.time, 3)
+        self.assertEqual(sorted(n.time for n in after), [0, 1])
+
+    def test_subtree_caches_cleared(self):
+        t = TimeTree("((D_1:1, D_2:1):3, (R_3:2, R_4:2):2);", hosts={"D": 0, "R": 1})
+        subtree = t.children[0]
+        self.assertEqual(subtree.get_k(0, 0.5), 2)
+        self.assertEqual(len(subtree.arrays().parent), 3)
+        # Changing the root must also refresh what was cached on the subtree
+        t.populate_hosts({"D": 1, "R": 0})
+        self.assertEqual(subtree.get_k(0, 0.5), 0)
+        subtree.children[0].dist = 3
+        t.populate_times()
+        self.assertEqual(subtree.get_k(1, 0.5), 1) # D_2 now starts at time 2
+        self.assertEqual(list(subtree.arrays().dist), [3, 3, 1])
+
+    def test_get_k_tips(self):
+        t = TimeTree("((D_1:1, D_2:1):3, (R_3:2, R_4:2):2);", hosts={"D": 0, "R": 1})
+        self.assertEqual(t.get_k(0, 0), 2)
+        self.assertEqual(t.get_k(1, 0.5), 2)
+
+    def test_get_k_after_coalescence(self):
+        t = TimeTree("((D_1:1, D_2:1):3, (R_3:2, R_4:2):2);", hosts={"D": 0, "R": 1})
+        self.assertEqual(t.get_k(0, 1), 1)
+        self.assertEqual(t.get_k(1, 2), 1)
+        self.assertEqual(t.get_k(0, 4), 0)
+
+    def test_get_k_vectorized(self):
+        t = TimeTree("((A:1, B:1):2, ((C:0.7, D:0.7):1.3, E:2):1);", hosts={"A": 0, "B": 0, "C": 0, "D": 0, "E": 0})
+        times = np.array([0, 0.8, 1, 2, 2.5, 3])
+        self.assertEqual(list(t.get_k(0, times)), [5, 4, 3, 2, 2, 0])
+        self.assertEqual(list(t.get_k(1, times)), [0]*6)
+
+    def test_mixed_nodes(self):
+        t = TimeTree("(((D_1:1, D_2:1):2.5, (R_3:2, R_4:2):1.5):2.5, R_5:6);", hosts={"D": 0, "R": 1})
+        self.assertEqual(sorted(n.time for n in t.get_mixed_nodes()), [3.5, 6])
+
+    def test_most_recent_mixed_node(self):
+        t = TimeTree("(((D_1:1, D_2:1):2.5, (R_3:2, R_4:2):1.5):2.5, R_5:6);", hosts={"D": 0, "R": 1})
+        self.assertEqual(t.most_recent_mixed_node().time, 3.5)
+
+    def test_hosts_change_clears_cache(self):
+        t = TimeTree("((D_1:1, D_2:1):3, (R_3:2, R_4:2):2);", hosts={"D": 0, "R": 1})
+        self.assertEqual(len(t.get_mixed_nodes()), 1)
+        t.populate_hosts({"D": 0, "R": 0})
+        self.assertEqual(t.get_mixed_nodes(), [])
 
 #
 # tree_likelihood.py
@@ -136,6 +264,89 @@ class TestTreeSegments(unittest.TestCase):
         actual = tree_segments_multihost(t, 3.)
         self.assertListsAlmostEqual([exp_coal_D, exp_coal_R, exp_none_D, exp_none_R], actual)
 
+    def test_multihost_from_arrays(self):
+        newick = "(((D_1:1, D_2:1):2.5, (R_3:2, R_4:2):1.5):2.5, R_5:6);"
+        expected = tree_segments_multihost(TimeTree(newick), 3.)
+        self.assertListsAlmostEqual(expected, tree_segments_multihost(parse_newick(newick), 3.))
+
+    def test_multihost_does_not_change_tree(self):
+        t = TimeTree("((D_1:1, D_2:1):3, (R_3:2, R_4:2):2);")
+        newick = t.write(format=1)
+        tree_segments_multihost(t, 3.)
+        self.assertEqual(t.write(format=1), newick)
+
+    def test_split_view(self):
+        t = TimeTree("((((R_4:1.5, R_5:1.5):1.5, R_6:3):1.5, (D_1:1, D_2:1):3.5):0.5, D_3:5);", hosts={"D": 0, "R": 1})
+        view = t.split_view(2.)
+        arrays = t.arrays()
+        self.assertEqual(sorted(arrays.time[view.crossing]), [0, 0, 1, 1.5])
+        self.assertEqual(sorted(view.host), [0, 0, 1, 1])
+        self.assertEqual(list(view.clipped_end), [2., 2., 2., 2.])
+        self.assertEqual(sorted(arrays.time[view.before]), [3, 4.5, 5])
+
+
+class TestMultihostIntervals(unittest.TestCase):
+
+    def intervals(self, forest, i=0):
+        table = forest.table(i)
+        return list(zip(table.start.tolist(), table.end.tolist(), table.k.tolist()))
+
+    def test_intervals_1(self):
+        t = TimeTree("((D_1:1, D_2:1):3, (R_3:2, R_4:2):2);")
+        actual = tree_intervals_multihost(t, 3.)
+        self.assertEqual(self.intervals(actual.coal_D), [(0, 1, 2), (3, 4, 2)])
+        self.assertEqual(self.intervals(actual.coal_R), [(0, 2, 2)])
+        self.assertEqual(self.intervals(actual.none_D), [(1, 3, 1)])
+        self.assertEqual(self.intervals(actual.none_R), [(2, 3, 1)])
+
+    def test_intervals_2(self):
+        t = TimeTree("((((R_4:1.5, R_5:1.5):1.5, R_6:3):1.5, (D_1:1, D_2:1):3.5):0.5, D_3:5);")
+        actual = tree_intervals_multihost(t, 2.)
+        self.assertEqual(self.intervals(actual.coal_D), [(0, 1, 3), (2, 3, 4), (3, 4.5, 3), (4.5, 5, 2)])
+        self.assertEqual(self.intervals(actual.coal_R), [(0, 1.5, 3)])
+        self.assertEqual(self.intervals(actual.none_D), [(1, 2, 2)])
+        self.assertEqual(self.intervals(actual.none_R), [(1.5, 2, 2)])
+
+    def test_mixed_fragment_invalid(self):
+        t = TimeTree("((D_2:1, D_3:1):2, (D_1:1.5, R_4:1.5):1.5);")
+        actual = tree_intervals_multihost(t, [1.4, 2.])
+        self.assertEqual(list(actual.valid), [True, False])
+
+    def test_batched_matches_single(self):
+        with open("tree_files/tree001.txt") as f:
+            t = TimeTree(f.readline())
+        T_values = np.linspace(0.1, t.time, 50)
+        batched = tree_intervals_multihost(t, T_values)
+        for i in [0, 17, 49]:
+            single = tree_intervals_multihost(t, T_values[i])
+            for name in ["coal_D", "coal_R", "none_D", "none_R"]:
+                self.assertEqual(self.intervals(getattr(batched, name), i), self.intervals(getattr(single, name)))
+
+class TestMultihostLikelihood(unittest.TestCase):
+
+    def test_con(self):
+        t = TimeTree("((D_1:1, D_2:1):3, (R_3:2, R_4:2):2);")
+        D, R = {"k": 2, "N": 10, "I": 0}, {"k": 2, "N": 5, "I": 0}
+        # The no-coalescence intervals have k=1, so they add nothing
+        expected = 2*np.log(con_probability(D, 0, 1)) + np.log(con_probability(R, 0, 2))
+        self.assertAlmostEqual(multihost_likelihood(t, 3., {"N": 10}, {"N": 5}), expected)
+
+    def test_lin_recipient_infected_at_T(self):
+        t = TimeTree("((D_1:1, D_2:1):3, (R_3:2, R_4:2):2);")
+        D, R = {"k": 2, "a": 5, "b": 2, "I": 10}, {"k": 2, "a": 1, "b": 1, "I": 3}
+        expected = (np.log(lin_probability(D, 0, 1)) + np.log(lin_probability(D, 3, 1))
+                    + np.log(lin_probability(R, 0, 2)))
+        actual = multihost_likelihood(t, 3., {"a": 5, "b": 2, "I": 10}, {"a": 1, "b": 1}, model="lin")
+        self.assertAlmostEqual(actual, expected)
+
+    def test_batched_T(self):
+        t = TimeTree("((D_1:1, D_2:1):3, (R_3:2, R_4:2):2);")
+        intervals = tree_intervals_multihost(t, [3., 2.5, 5.])
+        actual = multihost_likelihood(intervals, None, {"N": 10}, {"N": np.array([5, 5, 5])})
+        self.assertAlmostEqual(actual[0], multihost_likelihood(t, 3., {"N": 10}, {"N": 5}))
+        self.assertAlmostEqual(actual[1], multihost_likelihood(t, 2.5, {"N": 10}, {"N": 5}))
+        self.assertEqual(actual[2], -inf)
+
 
 class TestTreeLikelihood(unittest.TestCase):
 
@@ -181,6 +392,535 @@ class TestTreeLikelihood(unittest.TestCase):
         self.assertAlmostEqual(tree_likelihood(t, lin_population, lin_probability, {"a": 5, "b": 30, "I": 6}), \
                 -14.4146358)
 
+class TestGridLikelihood(unittest.TestCase):
+
+    def setUp(self):
+        self.t = TimeTree("((A:1, B:1):2, ((C:0.7, D:0.7):1.3, E:2):1);")
+        self.a_range = np.array([0, 1, 5, 10])
+        self.b_range = np.array([0.5, 10, 20])
+
+    def test_grid_matches_tree_likelihood(self):
+        values = grid_likelihood(self.t, self.a_range, self.b_range, 6)
+        self.assertEqual(values.shape, (4, 3))
+        for i, a in enumerate(self.a_range):
+            for j, b in enumerate(self.b_range):
+                self.assertAlmostEqual(values[i, j],
+                        tree_likelihood(self.t, lin_population, lin_probability, {"a": a, "b": b, "I": 6}))
+
+    def test_grid_chunked(self):
+        full = grid_likelihood(self.t, self.a_range, self.b_range, [6, 8])
+        chunked = grid_likelihood(self.t, self.a_range, self.b_range, [6, 8], chunk_size=3)
+        self.assertEqual(full.shape, (4, 3, 2))
+        self.assertTrue(np.array_equal(full, chunked))
+        self.assertAlmostEqual(full[2, 1, 1],
+                tree_likelihood(self.t, lin_population, lin_probability, {"a": 5, "b": 10, "I": 8}))
+
+#
+# segment_table.py
+#
+
+class TestSegmentTable(unittest.TestCase):
+
+    def test_matches_tree_segments(self):
+        t = TimeTree("((((A:1.5, A:1.5):1.5, A:3):1.5, (A:1, A:1):3.5):0.5, A:5);")
+        table = SegmentTable.from_tree(t)
+        actual = list(zip(table.start, table.end, table.dist))
+        self.assertEqual(actual, tree_segments(t))
+
+    def test_k_values(self):
+        t = TimeTree("((A:1, B:1):2, ((C:0.7, D:0.7):1.3, E:2):1);")
+        table = SegmentTable.from_tree(t)
+        self.assertEqual(list(table.k), [5, 4, 3, 2])
+        self.assertEqual(table.time, 3)
+
+    def test_con_likelihood_table(self):
+        t = TimeTree("((A:1, B:1):2, ((C:0.7, D:0.7):1.3, E:2):1);")
+        table = SegmentTable.from_tree(t)
+        params = {"N": 1000, "I": 5}
+        self.assertAlmostEqual(tree_likelihood(table, con_population, con_probability, params),
+                tree_likelihood(t, con_population, con_probability, params))
+
+    def test_lin_likelihood_table(self):
+        t = TimeTree("((A:1, B:1):2, ((C:0.7, D:0.7):1.3, E:2):1);")
+        table = SegmentTable.from_tree(t)
+        self.assertAlmostEqual(tree_likelihood(table, lin_population, lin_probability, {"a": 5, "b": 20, "I": 6}),
+                -12.9087445)
+
+
+class TestForest(unittest.TestCase):
+
+    def setUp(self):
+        self.trees = [TimeTree("((A:1, B:1):2, C:3);"),
+                      TimeTree("((A:1, B:1):2, ((C:0.7, D:0.7):1.3, E:2):1);"),
+                      TimeTree("((((A:1.5, A:1.5):1.5, A:3):1.5, (A:1, A:1):3.5):0.5, A:5);")]
+        self.forest = Forest.from_trees(self.trees)
+
+    def test_offsets(self):
+        self.assertEqual(len(self.forest), 3)
+        self.assertEqual(list(self.forest.offsets), [0, 2, 6, 11])
+
+    def test_con_shared_params(self):
+        actual = self.forest.con_log_likelihood(1000)
+        for lk, t in zip(actual, self.trees):
+            self.assertAlmostEqual(lk, tree_likelihood(t, con_population, con_probability, {"N": 1000, "I": 6}))
+
+    def test_lin_per_tree_params(self):
+        b = np.array([1, 10, 20])
+        actual = self.forest.lin_log_likelihood(5, b, 6)
+        for lk, t, b_i in zip(actual, self.trees, b):
+            self.assertAlmostEqual(lk, tree_likelihood(t, lin_population, lin_probability, {"a": 5, "b": b_i, "I": 6}))
+
+    def test_invalid_params(self):
+        actual = self.forest.lin_log_likelihood(5, np.array([1, -1, 1]), 6)
+        self.assertEqual(actual[1], -inf)
+        self.assertTrue(np.isfinite(actual[0]))
+
+#
+# new_optimization.py
+#
+
+class TestForestOptimization(unittest.TestCase):
+
+    def setUp(self):
+        self.I = 2*(365/1.5)
+        with open("erik-sim/a1_k20_b2/trees.tre") as f:
+            trees = [TimeTree(next(f)) for _ in range(10)]
+        self.trees = [t for t in trees if t.time <= self.I][:5]
+        self.forest = Forest.from_trees(self.trees)
+
+    def test_per_tree_b(self):
+        actual = optimize_b_forest(self.forest, 1, self.I)
+        for b, t in zip(actual, self.trees):
+            self.assertAlmostEqual(b, optimize_b(t, 1, self.I).x, places=4)
+
+    def test_pooled_b(self):
+        pooled = optimize_b_forest(self.forest, 1, self.I, pooled=True)
+        total = lambda b: np.sum(self.forest.lin_log_likelihood(1, b, self.I))
+        self.assertGreater(total(pooled), total(pooled*1.01))
+        self.assertGreater(total(pooled), total(pooled*0.99))
+
+class TestLikelihoodIntervals(unittest.TestCase):
+
+    def setUp(self):
+        self.I = 2*(365/1.5)
+        with open("erik-sim/a5_k20_b2/trees.tre") as f:
+            trees = [TimeTree(next(f)) for _ in range(10)]
+        self.forest = Forest.from_trees(t for t in trees if t.time <= self.I)
+
+    def check_roots(self, fun, peak, low, high, drop=1.92):
+        for i in range(len(peak)):
+            peak_val = fun(peak)[i]
+            if low[i] > 0:
+                self.assertAlmostEqual(fun(np.full(len(peak), low[i]))[i], peak_val - drop, places=6)
+            self.assertAlmostEqual(fun(np.full(len(peak), high[i]))[i], peak_val - drop, places=6)
+
+    def test_drop_roots_quadratic(self):
+        fun = lambda x: -(x - np.array([1., 5.]))**2
+        grad = lambda x: -2*(x - np.array([1., 5.]))
+        low, high = drop_roots(fun, grad, np.array([1., 5.]), drop=4)
+        np.testing.assert_allclose(low, [-1, 3])
+        np.testing.assert_allclose(high, [3, 7])
+
+    def test_drop_roots_bound(self):
+        fun = lambda x: -x
+        low, high = drop_roots(fun, lambda x: -np.ones_like(x), np.array([0.]), drop=1, bounds=(0, np.inf))
+        self.assertEqual(low[0], 0)
+        self.assertAlmostEqual(high[0], 1)
+
+    def test_con(self):
+        f = self.forest
+        # The constant model's best N is sum(k(k-1)/2 * z) / segments
+        N = np.bincount(f.tree_index, f.k*(f.k - 1)/2*f.dist) / np.bincount(f.tree_index)
+        low, high = con_confidence_intervals(f, N)
+        self.check_roots(f.con_log_likelihood, N, low, high)
+        self.assertTrue(np.all((low < N) & (N < high)))
+
+    def test_lin_b(self):
+        b = optimize_b_forest(self.forest, 5, self.I)
+        low, high = lin_confidence_intervals(self.forest, "b", 5, b, self.I)
+        self.check_roots(lambda x: self.forest.lin_log_likelihood(5, x, self.I), b, low, high)
+        self.assertTrue(np.all((low < b) & (b < high)))
+
+    def test_lin_a(self):
+        a = optimize_a_forest(self.forest, 2, self.I)
+        low, high = lin_confidence_intervals(self.forest, "a", a, 2, self.I)
+        self.check_roots(lambda x: self.forest.lin_log_likelihood(x, 2, self.I), a, low, high)
+        self.assertTrue(np.all((low <= a) & (a < high)))
+
+class TestProfileLikelihood(unittest.TestCase):
+
+    def setUp(self):
+        self.I = 2*(365/1.5)
+        with open("erik-sim/a5_k20_b2/trees.tre") as f:
+            trees = [TimeTree(next(f)) for _ in range(10)]
+        self.forest = Forest.from_trees(t for t in trees if t.time <= self.I)
+
+    def test_newton_max(self):
+        fun = lambda x: -(x - np.array([2., -1.]))**2
+        derivatives = lambda x: (-2*(x - np.array([2., -1.])), np.full(2, -2.))
+        x, f, iterations = newton_max(fun, derivatives, np.zeros(2), bounds=(0, np.inf))
+        np.testing.assert_allclose(x, [2, 0])
+        self.assertLessEqual(iterations, 3)
+
+    def test_profile_b_matches_brute_force(self):
+        grid = np.linspace(0.5, 6, 12)
+        profile, a = profile_likelihood(self.forest, "b", grid, self.I)
+        a_values = np.concatenate(([0], np.exp(np.linspace(-8, 8, 2001))))
+        for i in range(len(self.forest)):
+            table = self.forest.table(i)
+            brute = lin_log_likelihood(table.start, table.dist, table.k, a_values[:, np.newaxis], grid, self.I)
+            self.assertTrue(np.all(profile[:, i] >= brute.max(axis=0) - 1e-8))
+            np.testing.assert_allclose(profile[:, i], lin_log_likelihood(table.start, table.dist, table.k,
+                                                                         a[:, i], grid, self.I))
+
+    def test_profile_peak_is_joint_mle(self):
+        grid = np.linspace(0.5, 6, 111)
+        profile, _ = profile_likelihood(self.forest, "b", grid, self.I)
+        res = optimize_a_b(self.forest.table(0), (5, 2), self.I)
+        self.assertAlmostEqual(profile[:, 0].max(), -res.fun, places=2)
+        low, high = profile_interval(grid, profile)
+        self.assertTrue(low[0] < res.x[1] < high[0])
+
+    def test_profile_a(self):
+        grid = np.linspace(0, 50, 26)
+        profile, b = profile_likelihood(self.forest, "a", grid, self.I)
+        b_values = np.exp(np.linspace(-6, 4, 2001))
+        table = self.forest.table(0)
+        brute = lin_log_likelihood(table.start, table.dist, table.k, grid, b_values[:, np.newaxis], self.I)
+        np.testing.assert_allclose(profile[:, 0], brute.max(axis=0), atol=1e-4)
+
+class TestGradientOptimization(unittest.TestCase):
+
+    def setUp(self):
+        self.I = 2*(365/1.5)
+        with open("erik-sim/a5_k20_b2/trees.tre") as f:
+            self.table = SegmentTable.from_tree(TimeTree(f.readline()))
+        self.segments = (self.table.start, self.table.dist, self.table.k)
+
+    def test_lin_derivatives_match_finite_differences(self):
+        a, b, h = 3., 1.5, 1e-5
+        f = lambda a, b: lin_log_likelihood(*self.segments, a, b, self.I)
+        g = lambda a, b: lin_log_likelihood_gradient(*self.segments, a, b, self.I)
+        np.testing.assert_allclose(g(a, b), [(f(a+h, b) - f(a-h, b))/(2*h), (f(a, b+h) - f(a, b-h))/(2*h)], rtol=1e-6)
+        hessian = lin_log_likelihood_hessian(*self.segments, a, b, self.I)
+        np.testing.assert_allclose(hessian[0], (g(a+h, b) - g(a-h, b))/(2*h), rtol=1e-5)
+        np.testing.assert_allclose(hessian[1], (g(a, b+h) - g(a, b-h))/(2*h), rtol=1e-5)
+
+    def test_con_derivatives(self):
+        gradient, hessian = con_log_likelihood_derivatives(*self.segments, 50.)
+        f = lambda N: con_log_likelihood(*self.segments, N)
+        self.assertAlmostEqual(gradient, (f(50 + 1e-5) - f(50 - 1e-5))/2e-5, places=5)
+        self.assertAlmostEqual(hessian, (f(50 + 1e-3) - 2*f(50) + f(50 - 1e-3))/1e-6, places=3)
+
+    def test_optimize_a_b(self):
+        res = optimize_a_b(self.table, (5, 2), self.I)
+        nelder_mead = minimize(lambda x: -lin_log_likelihood(*self.segments, x[0], x[1], self.I)
+                               if x[0] >= 0 and x[1] > 0 else inf, (5, 2), method="Nelder-Mead")
+        self.assertLessEqual(res.fun, nelder_mead.fun + 1e-6)
+        self.assertLess(res.nfev, nelder_mead.nfev)
+        self.assertTrue(np.isfinite(res.stderr[1]))
+
+    def test_optimize_a_b_far_start(self):
+        # optimize_linear's default start. Trees that go past I are skipped,
+        # since their likelihood grows without bound as the root population goes to 0.
+        for filename in ["erik-sim/a1_k20_b3/trees.tre", "erik-sim/a5_k20_b2/trees.tre"]:
+            forest = Forest.from_trees(itertools.islice(read_newick(filename), 8))
+            for i in np.flatnonzero(forest.time <= self.I):
+                far = optimize_a_b(forest.table(i), (100, 1), self.I)
+                near = optimize_a_b(forest.table(i), (5, 2), self.I)
+                self.assertAlmostEqual(far.fun, near.fun, places=6)
+
+class TestMaxLikelihood(unittest.TestCase):
+
+    def setUp(self):
+        self.I = 1.01
+        forest = Forest.from_trees(itertools.islice(read_newick("tree_files/linear-latest.tre"), 30))
+        self.forest = forest.subset(np.flatnonzero(forest.time <= self.I))
+
+    def brute_force(self, a, b):
+        return np.array([lin_log_likelihood(table.start, table.dist, table.k, a, b, self.I).max()
+                         for table in (self.forest.table(i) for i in range(len(self.forest)))])
+
+    def test_con_mle_is_exact(self):
+        N = max_likelihood_forest(self.forest, "N")
+        gradient, hessian = self.forest.con_log_likelihood_derivatives(N)
+        np.testing.assert_allclose(gradient*N, 0, atol=1e-8)
+        self.assertTrue(np.all(hessian < 0))
+
+    def test_con_exact_intervals(self):
+        N, low, high = con_exact_intervals(self.forest)
+        np.testing.assert_allclose(N, max_likelihood_forest(self.forest, "N"))
+        num_low, num_high = con_confidence_intervals(self.forest, N)
+        np.testing.assert_allclose(low, num_low, rtol=1e-8)
+        np.testing.assert_allclose(high, num_high, rtol=1e-8)
+
+    def test_con_standard_errors(self):
+        N = con_mle(self.forest)
+        _, hessian = self.forest.con_log_likelihood_derivatives(N)
+        np.testing.assert_allclose(con_standard_errors(self.forest), 1/np.sqrt(-hessian))
+
+    def test_a_matches_brute_force(self):
+        a_values = np.concatenate(([0], np.exp(np.linspace(-10, 10, 20001))))[:, np.newaxis]
+        for b in [0.5, 2]:
+            a = max_likelihood_forest(self.forest, "a", {"b": b, "I": self.I})
+            found = self.forest.lin_log_likelihood(a, b, self.I)
+            self.assertTrue(np.all(found >= self.brute_force(a_values, b) - 1e-8))
+
+    def test_b_matches_brute_force(self):
+        b_values = np.exp(np.linspace(-10, 10, 20001))[:, np.newaxis]
+        b = max_likelihood_forest(self.forest, "b", {"a": 0.5, "I": self.I})
+        found = self.forest.lin_log_likelihood(0.5, b, self.I)
+        self.assertTrue(np.all(found >= self.brute_force(0.5, b_values) - 1e-8))
+
+    def test_warm_start(self):
+        cold = max_likelihood_forest(self.forest, "b", {"a": 0.5, "I": self.I})
+        warm = max_likelihood_forest(self.forest, "b", {"a": 0.5, "I": self.I}, start=cold*1.1)
+        np.testing.assert_allclose(warm, cold, rtol=1e-6)
+
+    def test_bad_warm_start(self):
+        # b = 1e4 has no finite likelihood for trees past I, and the rest are far away
+        forest = generate_trees({"a": 0.5, "b": 2, "I": self.I, "k": 30}, 50, lin_population, Generator(PCG64(0)))
+        cold = max_likelihood_forest(forest, "b", {"a": 0.5, "I": self.I})
+        for start in [1e4, 100, 0]:
+            warm = max_likelihood_forest(forest, "b", {"a": 0.5, "I": self.I}, start=start)
+            np.testing.assert_allclose(warm, cold, rtol=1e-6)
+        cold = max_likelihood_forest(forest, "a", {"b": 0.5, "I": self.I})
+        for start in [1e4, 0]:
+            warm = max_likelihood_forest(forest, "a", {"b": 0.5, "I": self.I}, start=start)
+            np.testing.assert_allclose(warm, cold, rtol=1e-6, atol=1e-9)
+
+    def test_warm_start_a(self):
+        cold = max_likelihood_forest(self.forest, "a", {"b": 0.5, "I": self.I})
+        warm = max_likelihood_forest(self.forest, "a", {"b": 0.5, "I": self.I}, start=np.where(cold > 0, cold*1.2, 0))
+        np.testing.assert_allclose(warm, cold, rtol=1e-6, atol=1e-9)
+
+#
+# models.py
+#
+
+class TestModels(unittest.TestCase):
+
+    def setUp(self):
+        self.table = SegmentTable.from_times([0.1, 0.3, 0.35, 0.8], 5)
+
+    def test_log_likelihood_matches_kernels(self):
+        t = self.table
+        theta = {"con": [3.], "lin": [5, 2, 1], "exp": [3, 2, 1]}
+        expected = {"con": con_log_likelihood(t.start, t.dist, t.k, 3.),
+                    "lin": lin_log_likelihood(t.start, t.dist, t.k, 5, 2, 1),
+                    "exp": exp_log_likelihood(t.start, t.dist, t.k, 3, 2, 1)}
+        for name, model in MODELS.items():
+            self.assertAlmostEqual(model.log_likelihood(t, model.vector(model.as_dict(theta[name]))), expected[name])
+
+    def test_gradients_match_finite_differences(self):
+        theta = {"con": [3.], "lin": [5, 2, 1], "exp": [3, 2, 1]}
+        for name, model in MODELS.items():
+            x = np.array(theta[name], dtype=float)
+            for i in range(len(model.fitted)):
+                step = np.zeros_like(x)
+                step[i] = 1e-6
+                numerical = (model.log_likelihood(self.table, x + step)
+                             - model.log_likelihood(self.table, x - step)) / 2e-6
+                self.assertAlmostEqual(model.gradient(self.table, x)[i], numerical, places=5)
+
+    def test_forest_matches_tables(self):
+        model = get_model("exp")
+        forest = model.sample(model.vector({"a": 10, "r": 0.05, "I": 100}), 10, 5, Generator(PCG64(1)))
+        theta = np.column_stack((np.linspace(5, 15, 5), np.full(5, 0.1), np.full(5, 100.)))
+        per_tree = [model.log_likelihood(forest.table(i), theta[i]) for i in range(5)]
+        np.testing.assert_allclose(model.log_likelihood(forest, theta), per_tree)
+        np.testing.assert_allclose(forest.exp_log_likelihood(theta[:, 0], 0.1, 100), per_tree)
+
+    def test_exp_sampler_survival(self):
+        params = {"k": 2, "a": 2., "r": 1.5, "I": 3.}
+        times = coalescence_times(params, 100000, pop_model=exp_population, generator=Generator(PCG64(2)))
+        for z in [0.5, 1.5]:
+            self.assertAlmostEqual(np.mean(times[:, 0] > z), exp_nocoal_probability(params, 0, z), places=2)
+
+    def test_hessians_match_finite_differences(self):
+        theta = {"con": [3.], "lin": [5, 2, 1]}
+        for name, values in theta.items():
+            model = MODELS[name]
+            theta0 = np.array(values, dtype=float)
+            for i in range(len(model.fitted)):
+                step = np.zeros_like(theta0)
+                step[i] = 1e-6
+                numeric = (model.gradient(self.table, theta0 + step) - model.gradient(self.table, theta0 - step))/2e-6
+                np.testing.assert_allclose(model.hessian(self.table, theta0)[i], numeric, rtol=1e-5, atol=1e-6)
+
+    def test_lin_fit_far_start(self):
+        # optimize_linear's default start, where L-BFGS-B used to stop early
+        I = 2*(365/1.5)
+        model = get_model("lin")
+        trees = [tree for d in ["a1_k20_b3", "a5_k20_b2"]
+                 for tree in itertools.islice(read_newick(f"erik-sim/{d}/trees.tre"), 8)]
+        for tree in [tree for tree in trees if SegmentTable.from_arrays(tree).time <= I]:
+            far = model.fit(tree, {"a": 100, "b": 1, "I": I})
+            near = model.fit(tree, {"a": 5, "b": 2, "I": I})
+            self.assertTrue(far.success)
+            self.assertTrue(model.converged(tree, model.vector(far.params)))
+            np.testing.assert_allclose(far.x, near.x, rtol=1e-4, atol=1e-5)
+            self.assertEqual(far.params["I"], I)
+
+    def test_fit_without_maximum(self):
+        # The third tree is older than I, so the likelihood grows without bound
+        with open("erik-sim/a5_k20_b2/trees.tre") as f:
+            tree = TimeTree(f.readlines()[2])
+        with self.assertWarns(UserWarning):
+            res = get_model("lin").fit(tree, {"a": 100, "b": 1, "I": 2*(365/1.5)})
+        self.assertFalse(res.success)
+
+#
+# newick.py and tree_arrays.py
+#
+
+class TestNewick(unittest.TestCase):
+
+    def test_parse_structure(self):
+        arrays = parse_newick("((A:1, B:1):2, C:3);")
+        self.assertEqual(list(arrays.parent), [-1, 0, 1, 1, 0])
+        self.assertEqual(list(arrays.dist), [0, 2, 1, 1, 3])
+        self.assertEqual(arrays.names, ["", "", "A", "B", "C"])
+
+    def test_unnamed_leaves(self):
+        arrays = parse_newick("(,(A,B)x:1);")
+        self.assertEqual(list(arrays.parent), [-1, 0, 0, 2, 2])
+        self.assertEqual(arrays.names[2], "x")
+
+    def test_times_match_time_tree(self):
+        newick = "((((A:1.5, A:1.5):1.5, A:3):1.5, (A:1, A:1):3.5):0.5, A:5);"
+        arrays = parse_newick(newick)
+        expected = sorted(n.time for n in TimeTree(newick).traverse())
+        self.assertEqual(sorted(arrays.time), expected)
+
+    def test_segment_table_from_arrays(self):
+        newick = "((A:1, B:1):2, ((C:0.7, D:0.7):1.3, E:2):1);"
+        from_arrays = SegmentTable.from_arrays(parse_newick(newick))
+        from_tree = SegmentTable.from_tree(TimeTree(newick))
+        self.assertEqual(list(from_arrays.dist), list(from_tree.dist))
+        self.assertEqual(list(from_arrays.k), list(from_tree.k))
+        self.assertEqual(from_arrays.time, from_tree.time)
+
+    def test_to_newick(self):
+        arrays = parse_newick("((A:1, B:1):2, C:3);")
+        self.assertEqual(arrays.to_newick(), "((A:1.0,B:1.0):2.0,C:3.0);")
+        self.assertEqual(arrays.to_time_tree().time, 3)
+
+    def test_read_file(self):
+        forest = Forest.from_trees(read_newick("tree_files/linear-latest.tre"))
+        self.assertEqual(len(forest), 100)
+        with open("tree_files/linear-latest.tre") as f:
+            t = TimeTree(f.readline())
+        self.assertAlmostEqual(forest.lin_log_likelihood(5, 1, 6)[0],
+                tree_likelihood(t, lin_population, lin_probability, {"a": 5, "b": 1, "I": 6}))
+
+#
+# tree_generation.py
+#
+
+class TestTreeGeneration(unittest.TestCase):
+
+    def test_random_merges(self):
+        parent = random_merges(6, replicates=50)
+        self.assertEqual(parent.shape, (50, 11))
+        for row in parent:
+            # Every node but the root has a later parent, and every parent has two children
+            self.assertTrue(np.all(row[:-1] > np.arange(10)))
+            self.assertEqual(row[-1], -1)
+            self.assertEqual(list(np.bincount(row[:-1], minlength=11)[6:]), [2]*5)
+
+    def test_coalescence_times(self):
+        times = coalescence_times({"N0": 1000, "k": 20}, replicates=20000)
+        self.assertEqual(times.shape, (20000, 19))
+        self.assertTrue(np.all(np.diff(times, axis=1) > 0))
+        # Expected time to the root is 2N(1 - 1/k)
+        self.assertAlmostEqual(times[:, -1].mean() / 1900, 1, places=1)
+
+    def test_generate_tree(self):
+        t = TimeTree(generate_tree({"N0": 1000, "k": 10}))
+        self.assertEqual(sorted(leaf.name for leaf in t.iter_leaves()), sorted(str(i) for i in range(1, 11)))
+        self.assertEqual(len(SegmentTable.from_tree(t)), 9)
+
+    def test_generate_trees(self):
+        trees = generate_trees({"N0": 1000, "k": 10}, 200)
+        self.assertEqual(len(trees), 200)
+        self.assertEqual(list(trees.table(3).k), list(range(10, 1, -1)))
+        self.assertTrue(np.allclose(trees.table(3).end[-1], trees.time[3]))
+        # The same times give the same table as the single-tree path
+        table = trees.table(5)
+        expected = SegmentTable.from_times(table.end, 10)
+        self.assertEqual(list(table.dist), list(expected.dist))
+        self.assertAlmostEqual(tree_likelihood(table, con_population, con_probability, {"N": 1000, "I": inf}),
+                trees.con_log_likelihood(1000)[5])
+
+    def test_lin_waiting_time_inverts_survival(self):
+        params = {"k": 5, "a": 2, "b": 3, "I": 100}
+        for start, u in [(0, 0.5), (10, 0.01), (50, 0.99)]:
+            z = lin_waiting_time(start, 5, 2, 3, 100, u)
+            self.assertAlmostEqual(lin_nocoal_probability(params, start, z), u)
+
+    def test_lin_waiting_time_no_population(self):
+        # Population at start is 1 + 1*(5 - 10) < 0
+        self.assertEqual(lin_waiting_time(10., 3, 1., 1., 5., 0.5), np.inf)
+        z = lin_waiting_time(np.array([0., 6., 10.]), 3, 1., 1., 5., 0.5)
+        self.assertTrue(0 < z[0] < 6)
+        self.assertEqual(list(z[1:]), [np.inf, np.inf])
+
+    def test_lin_trees(self):
+        params = {"k": 20, "a": 1, "b": 2, "I": 2*(365/1.5)}
+        trees = generate_trees(params, 20000, pop_model=lin_population)
+        self.assertTrue(np.all(np.diff(trees.table(0).end) > 0))
+        # About 91% of the erik-sim a1_k20_b2 trees are within I
+        self.assertAlmostEqual(np.mean(trees.time <= params["I"]), 0.91, places=1)
+
+    def test_multihost(self):
+        for _ in range(20):
+            t = simulate_tree_multihost({"k": 5, "N0": 10}, {"k": 4, "N0": 3}, 5.)
+            self.assertEqual(sorted(t.names[i][0] for i in np.flatnonzero(t.is_leaf)), ["D"]*5 + ["R"]*4)
+            self.assertTrue(np.all(t.parent < np.arange(len(t))))
+            intervals = tree_intervals_multihost(t, 5.)
+            self.assertTrue(intervals.valid[0])
+            self.assertTrue(np.all(intervals.coal_R.end <= 5.))
+
+    def test_multihost_lin(self):
+        t = simulate_tree_multihost({"k": 5, "a": 1, "b": 2, "I": 500}, {"k": 4, "a": 1, "b": 1}, 30., model="lin")
+        self.assertTrue(tree_intervals_multihost(t, 30.).valid[0])
+        self.assertTrue(np.isfinite(multihost_likelihood(t, 30., {"a": 1, "b": 2, "I": 500}, {"a": 1, "b": 1}, model="lin")))
+
+    def test_multisample(self):
+        t = parse_newick(generate_tree_multisample({"k": 5, "N0": 10}, 3., 3))
+        leaves = np.flatnonzero(t.is_leaf)
+        self.assertEqual(sorted(t.names[i] for i in leaves), ["D_1", "D_2", "D_3", "D_4", "D_5", "R_6", "R_7", "R_8"])
+        for i in leaves:
+            expected = 3. if t.names[i].startswith("R") else 0.
+            self.assertAlmostEqual(t.time[i], expected)
+
+    def test_to_preorder(self):
+        t = TreeArrays([4, 4, 3, 5, 5, -1], [1, 1, 2, 1, 2, 0], ["A", "B", "C", "", "", ""])
+        preorder = t.to_preorder()
+        self.assertEqual(list(preorder.parent), [-1, 0, 1, 0, 3, 3])
+        self.assertEqual(preorder.to_newick(), t.to_newick())
+
+    def test_seeded_shards_match_single_run(self):
+        params = {"k": 10, "N0": 100}
+        full = generate_trees_seeded(params, 1000, SimulationSeed(42, block_size=300))
+        shards = [generate_trees_seeded(params, 1000, SimulationSeed(42, block_size=300),
+                                        blocks=SimulationSeed(42, block_size=300).shard(1000, i, 3))
+                  for i in range(3)]
+        self.assertEqual(len(full), 1000)
+        self.assertTrue(np.array_equal(full.end, np.concatenate([shard.end for shard in shards])))
+
+    def test_seed_generator_matches_spawn(self):
+        seed = SimulationSeed(7)
+        expected = Generator(PCG64(np.random.SeedSequence(7).spawn(4)[2]))
+        self.assertEqual(seed.generator(2).random(), expected.random())
+        self.assertNotEqual(seed.generator(1).random(), seed.generator(2).random())
+
+    def test_simulate_tree_times(self):
+        arrays = simulate_tree({"N0": 1000, "k": 10})
+        from_newick = parse_newick(arrays.to_newick())
+        self.assertTrue(np.allclose(sorted(arrays.time), sorted(from_newick.time)))
+
 
 if __name__ == "__main__":
     unittest.main()
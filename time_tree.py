@@ -1,30 +1,63 @@
 from ete3 import Tree
+import numpy as np
 import warnings
+from tree_arrays import TreeArrays
 
 class TimeTree(Tree):
     def __init__(self, *args, **kwargs):
-        # We need to take hosts out of kwargs before doing super.
+        # We need to take hosts and lazy_times out of kwargs before doing super.
         if "hosts" in kwargs:
             hosts = kwargs["hosts"]
             kwargs.pop("hosts")
         else:
             hosts = {}
+        lazy_times = kwargs.pop("lazy_times", False)
 
         super(TimeTree, self).__init__(*args, **kwargs)
 
-        self.populate_times()
+        # Nodes made without a newick string are the children the parser creates
+        # one by one. Their times are filled in by the root once it is complete.
+        has_newick = bool(args and args[0]) or bool(kwargs.get("newick"))
+        if has_newick and not lazy_times:
+            self.populate_times()
         if hosts:
             self.populate_hosts(hosts)
 
+    def __getattr__(self, name):
+        """
+        Only called when normal attribute lookup fails. If the time of a node
+        is asked for before it was computed (lazy_times=True), compute the
+        times of the whole tree now.
+        """
+        if name == "time":
+            self.get_tree_root().populate_times()
+            return self.__dict__["time"]
+        raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+
+    def clear_caches(self):
+        """
+        Forget any cached indexes built from this tree. Called whenever times
+        or hosts change. Caches live on whichever node was queried, and a
+        change to any part of the tree can make them stale, so they are
+        cleared from every node of the tree this node belongs to.
+        """
+        for node in self.get_tree_root().traverse():
+            for cache in ["_k_index", "_host_masks", "_mixed_nodes", "_all_infected", "_arrays"]:
+                node.__dict__.pop(cache, None)
+
     def populate_times(self):
         """
         Add a time attribute to each node based on its distance from the tips
         of the tree (lower is more recent)
         """
-        tree_max = self.get_farthest_node()[1]
-        for node in self.traverse():
-            node_dist = self.get_distance(node)
+        # Distance from self to each node, accumulated from the root down in one pass
+        depth = {self: 0.}
+        for node in self.iter_descendants("preorder"):
+            depth[node] = depth[node.up] + node.dist
+        tree_max = max(depth.values())
+        for node, node_dist in depth.items():
             node.add_feature("time", tree_max - node_dist)
+        self.clear_caches()
 
     def populate_hosts(self, hostnames):
         """
@@ -46,6 +79,31 @@ class TimeTree(Tree):
             except KeyError:
                 warnings.warn(f"Could not find a host for name_prefix {name_prefix} in {hostnames}")
                 leaf.host = -1
+        self.clear_caches()
+        self._hostnames = dict(hostnames)
+
+    def arrays(self):
+        """
+        Return the tree as TreeArrays in preorder, with the same times and
+        hosts as the nodes of this tree. The result is cached until the times
+        or hosts change, so it must not be modified.
+        """
+        if "_arrays" not in self.__dict__:
+            nodes = list(self.traverse("preorder"))
+            index = {node: i for i, node in enumerate(nodes)}
+            parent = [-1] + [index[node.up] for node in nodes[1:]]
+            self._arrays = TreeArrays(parent,
+                                      [node.dist for node in nodes],
+                                      [node.name for node in nodes],
+                                      time=[node.time for node in nodes],
+                                      hosts=[getattr(node, "host", -1) for node in nodes])
+        return self._arrays
+
+    def split_view(self, T):
+        """
+        Split the tree around T without copying it. See TreeArrays.split_at_time.
+        """
+        return self.arrays().split_at_time(T)
 
     def get_leaf_hosts(self):
         """
@@ -57,28 +115,60 @@ class TimeTree(Tree):
                 leaf_hosts.append(node.host)
         return leaf_hosts
 
+    def populate_host_masks(self):
+        """
+        Add a host_mask attribute to each node in one bottom-up pass. Each
+        host gets one bit, and a node's mask has the bits of every host among
+        the leaves below it.
+
+        Returns:
+          bits (dict): The bit given to each host
+        """
+        bits = {}
+        for node in self.traverse("postorder"):
+            if node.is_leaf():
+                if node.host not in bits:
+                    bits[node.host] = 1 << len(bits)
+                node.host_mask = bits[node.host]
+            else:
+                mask = 0
+                for child in node.children:
+                    mask |= child.host_mask
+                node.host_mask = mask
+        self._host_masks = bits
+        return bits
+
     def all_hosts_infected_node(self):
         """
         Return the earliest node where all hosts have been infected.
+        The result is cached until the times or hosts change.
         """
-        hosts_overall = set(self.get_leaf_hosts())
-        hosts_so_far = set()
+        if "_all_infected" in self.__dict__:
+            return self._all_infected
+        if "_host_masks" not in self.__dict__:
+            self.populate_host_masks()
+
+        hosts_overall = self.host_mask
+        hosts_so_far = 0
         # check from the closest (oldest) leaf to the newest one
         for leaf in sorted(self.get_leaves(), key=lambda x: x.time, reverse=True):
-            hosts_so_far.add(leaf.host)
+            hosts_so_far |= leaf.host_mask
             if hosts_overall == hosts_so_far:
+                self._all_infected = leaf
                 return leaf
         raise Exception("Could not find any point where all hosts were infected.")
 
     def get_mixed_nodes(self):
         """
         Return a list of all nodes in the tree with children that have multiple hosts.
+        The result is cached until the times or hosts change.
         """
-        mixed = []
-        for node in self.traverse():
-            if len(set(node.get_leaf_hosts())) > 1: # TODO: instead of leaf names must be leaf hosts
-                mixed.append(node)
-        return mixed
+        if "_mixed_nodes" not in self.__dict__:
+            if "_host_masks" not in self.__dict__:
+                self.populate_host_masks()
+            # More than one bit set means more than one host
+            self._mixed_nodes = [node for node in self.traverse() if node.host_mask & (node.host_mask - 1)]
+        return list(self._mixed_nodes)
 
     def most_recent_mixed_node(self):
         """
@@ -88,7 +178,7 @@ class TimeTree(Tree):
         recent = self
         mixed_nodes = self.get_mixed_nodes()
         if mixed_nodes:
-            for node in self.get_mixed_nodes():
+            for node in mixed_nodes:
                 if node.time < recent.time and node.time > latest_possible.time:
                     recent = node
             return recent
@@ -107,6 +197,7 @@ class TimeTree(Tree):
           after (list): All branches after T. There can be multiple branches separated.
         """
         before = self.copy()
+        before.clear_caches()
 
         after = []
         for node in before.iter_descendants():
@@ -123,10 +214,37 @@ class TimeTree(Tree):
                 after.append(after_T)
 
                 # Clean up the parent so the distances still match
-                parent.add_child(dist=end-T)
+                parent.add_child(dist=end-T).add_feature("time", T)
 
         return before, after
 
+    def build_k_index(self):
+        """
+        Precompute, for each host, the sorted start and end times of every branch
+        so get_k can count the branches crossing a time with a binary search.
+        A branch belongs to the host of its first leaf, the same way
+        tree_likelihood.tree_segments_multihost assigns fragments to hosts.
+
+        Returns:
+          index (dict): For each host, a tuple of (sorted starts, sorted ends)
+        """
+        first_host = {}
+        branches = {}
+        for node in self.traverse("postorder"):
+            if node.is_leaf():
+                first_host[node] = getattr(node, "host", None)
+            else:
+                first_host[node] = first_host[node.children[0]]
+            if node is not self:
+                branches.setdefault(first_host[node], []).append((node.time, node.up.time))
+
+        index = {}
+        for host, intervals in branches.items():
+            starts, ends = np.array(intervals).T
+            index[host] = (np.sort(starts), np.sort(ends))
+        self._k_index = index
+        return index
+
     def get_k(self, host, time):
         """
         Determine the value of k for a certain host at a specific point in time.
@@ -136,30 +254,26 @@ class TimeTree(Tree):
         At any other point, k is equal to the number of branches that pass through
         that time.
 
+        The first call builds an index (see build_k_index), after which each
+        query is a binary search.
+
         Parameters:
           tree (TimeTree): Representation of tree
           host (int): Integer representation of host, usually 0 or 1.
-          time (float): Time to count k.
+          time (float or array): Time to count k. An array gives k at every time.
 
         Returns:
-          k (int): k at that time
+          k (int or ndarray): k at that time
         """
-        # Earliest coalescence in the tree. Host shouldn't matter, as we just want
-        # a small time value that's appropriate to the tree.
-        # TODO this will *REALLY* break if we have tips at different times. Be careful about that.
-        node_times = [node.time for node in self.traverse() if node.children]
-        cutoff_time = min(node_times)
-
-        if time < cutoff_time:
-            # k is the number of leaves if we're before the first coalescence event
-            k = len([leaf for leaf in self.get_leaves() if leaf.host == host])
-        else:
-            # k is the number of branches that cross the time at any other point
-            k = 0
-            for node in self.iter_descendants():
-                start = node.time
-                end = node.up.time
-                if end <= time <= start:
-                    k += 1
-        return k
+        index = self.__dict__.get("_k_index")
+        if index is None:
+            index = self.build_k_index()
+        if host not in index:
+            return np.zeros(np.shape(time), dtype=int)[()]
 
+        starts, ends = index[host]
+        # TODO this will *REALLY* break if we have tips at different times. Be careful about that.
+        time = np.maximum(time, starts[0]) # Before the tips, count the tips
+        # Branches with start <= time < end
+        k = np.searchsorted(starts, time, side="right") - np.searchsorted(ends, time, side="right")
+        return k[()]
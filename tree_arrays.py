@@ -0,0 +1,244 @@
+import numpy as np
+import warnings
+
+class TreeArrays:
+    """
+    Compact representation of a tree as flat arrays, one entry per node.
+    This is all the likelihood code needs, so it avoids building an ete3
+    object graph. A TimeTree can still be made on demand with to_time_tree.
+
+    Trees from newick.parse_newick and TimeTree.arrays are in preorder (every
+    parent comes before its children, and a node's first child comes right
+    after it), which split_at_time relies on.
+
+    Attributes:
+      parent (ndarray): Index of the parent of each node, -1 for the root
+      dist (ndarray): Branch length from each node to its parent
+      names (list): Name of each node ("" if it has none)
+      newick (str or None): Newick string the arrays were parsed from, if any
+      hosts (ndarray or None): Host of each leaf, see populate_hosts
+    """
+    def __init__(self, parent, dist, names=None, newick=None, time=None, hosts=None):
+        self.parent = np.asarray(parent, dtype=int)
+        self.dist = np.asarray(dist, dtype=float)
+        self.names = names if names is not None else [""]*len(self.parent)
+        self.newick = newick
+        self._time = None if time is None else np.asarray(time, dtype=float)
+        self.hosts = None if hosts is None else np.asarray(hosts, dtype=int)
+        self._subtree_size = None
+
+    def __len__(self):
+        return len(self.parent)
+
+    @property
+    def is_leaf(self):
+        """
+        Boolean array, True for nodes without children.
+        """
+        has_children = np.zeros(len(self), dtype=bool)
+        has_children[self.parent[self.parent >= 0]] = True
+        return ~has_children
+
+    @property
+    def root(self):
+        return int(np.flatnonzero(self.parent < 0)[0])
+
+    @property
+    def time(self):
+        """
+        Time of each node based on its distance from the tips of the tree
+        (lower is more recent), matching TimeTree.populate_times.
+        """
+        if self._time is None:
+            if np.all(self.parent < np.arange(len(self))):
+                # Parents come first, so add up branch lengths from the root down
+                # in the same order as TimeTree.populate_times
+                depth = [0.]*len(self)
+                parent, dist = self.parent.tolist(), self.dist.tolist()
+                for node in range(1, len(self)):
+                    depth[node] = depth[parent[node]] + dist[node]
+                depth = np.array(depth)
+            else:
+                # Pointer jumping: after each step, depth[i] is the distance from i up
+                # to ancestor[i], and ancestor[i] is twice as far up as before.
+                depth = np.where(self.parent >= 0, self.dist, 0.)
+                ancestor = self.parent.copy()
+                while np.any(ancestor >= 0):
+                    has_ancestor = ancestor >= 0
+                    up = np.where(has_ancestor, ancestor, 0)
+                    depth = np.where(has_ancestor, depth + depth[up], depth)
+                    ancestor = np.where(has_ancestor, ancestor[up], -1)
+            self._time = depth.max() - depth
+        return self._time
+
+    @property
+    def subtree_size(self):
+        """
+        Number of nodes in the subtree below (and including) each node. In
+        preorder, the subtree of node i is i:i+subtree_size[i].
+        """
+        if self._subtree_size is None:
+            size = np.ones(len(self), dtype=int)
+            for node in range(len(self) - 1, 0, -1):
+                size[self.parent[node]] += size[node]
+            self._subtree_size = size
+        return self._subtree_size
+
+    @property
+    def first_leaf(self):
+        """
+        Index of the first leaf (in preorder) below each node.
+        """
+        leaf_index = np.where(self.is_leaf, np.arange(len(self)), len(self))
+        return np.minimum.accumulate(leaf_index[::-1])[::-1]
+
+    def to_preorder(self):
+        """
+        Return a copy of the tree with its nodes renumbered in preorder (every
+        parent before its children, and a node's first child right after it),
+        which split_at_time needs. Children keep their original order.
+
+        Returns:
+          tree (TreeArrays): The same tree in preorder
+        """
+        children = [[] for _ in range(len(self))]
+        for node, parent in enumerate(self.parent.tolist()):
+            if parent >= 0:
+                children[parent].append(node)
+        order = []
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            order.append(node)
+            stack.extend(reversed(children[node]))
+        order = np.array(order)
+
+        new_index = np.empty(len(self), dtype=int)
+        new_index[order] = np.arange(len(self))
+        parent = np.where(self.parent[order] >= 0, new_index[self.parent[order]], -1)
+        return TreeArrays(parent, self.dist[order], [self.names[node] for node in order],
+                          time=None if self._time is None else self._time[order],
+                          hosts=None if self.hosts is None else self.hosts[order])
+
+    def populate_hosts(self, hostnames):
+        """
+        Set the host of each leaf from the first part of its name, like
+        TimeTree.populate_hosts. Unknown prefixes get host -1 with a warning.
+
+        Parameters:
+          hostnames (dict): A dict associating the first part of a
+          leaf's name and the number of its host.
+            ex. {"D": 0, "R": 1} gives the node with name="R_5" host=1
+        """
+        hosts = np.full(len(self), -1)
+        for node in np.flatnonzero(self.is_leaf):
+            name_prefix = self.names[node].split('_')[0]
+            try:
+                hosts[node] = hostnames[name_prefix]
+            except KeyError:
+                warnings.warn(f"Could not find a host for name_prefix {name_prefix} in {hostnames}")
+        self.hosts = hosts
+        self._hostnames = dict(hostnames)
+
+    def split_at_time(self, T):
+        """
+        Split the tree around T without copying or changing it.
+
+        Parameters:
+          T (float): Time to split around
+
+        Returns:
+          view (SplitView): Index ranges of the fragments after T and the
+          nodes before T
+        """
+        return SplitView(self, T)
+
+    def to_newick(self):
+        """
+        Return the Newick representation of the tree, with internal node
+        names (like ete3's format=1).
+        """
+        children = [[] for _ in range(len(self))]
+        for node, parent in enumerate(self.parent):
+            if parent >= 0:
+                children[parent].append(node)
+
+        # Build each node's string after its children's (iterative postorder)
+        text = [None]*len(self)
+        stack = [(self.root, False)]
+        while stack:
+            node, expanded = stack.pop()
+            if children[node] and not expanded:
+                stack.append((node, True))
+                stack.extend((child, False) for child in reversed(children[node]))
+                continue
+            label = self.names[node]
+            if children[node]:
+                label = "(" + ",".join(text[child] for child in children[node]) + ")" + label
+            if node != self.root:
+                label += ":" + repr(float(self.dist[node]))
+            text[node] = label
+        return text[self.root] + ";"
+
+    def to_time_tree(self, hosts=None):
+        """
+        Build the full TimeTree for these arrays.
+
+        Parameters:
+          hosts (dict, optional): Passed on to TimeTree.populate_hosts
+
+        Returns:
+          tree (TimeTree): ete3 representation of the tree
+        """
+        from time_tree import TimeTree # time_tree imports this module
+        if self.newick is not None:
+            return TimeTree(self.newick, hosts=hosts or {})
+        return TimeTree(self.to_newick(), format=1, hosts=hosts or {})
+
+class SplitView:
+    """
+    The parts of a tree before and after a time T, given as indexes into the
+    tree's arrays rather than as copies of the tree (compare
+    TimeTree.split_at_time). Fragment i after T is the preorder range
+    crossing[i]:stop[i], and its root branch is clipped to end at T.
+
+    Attributes:
+      T (float): Time of the split
+      crossing (ndarray): Index of the root of each fragment after T
+      stop (ndarray): One past the last index of each fragment
+      host (ndarray): Host of each fragment (the host of its first leaf)
+      clipped_start (ndarray): Start of the clipped root branch of each fragment
+      clipped_end (ndarray): End of the clipped root branch of each fragment (T)
+      in_fragment (ndarray): Boolean mask of the nodes after T
+      node_host (ndarray): Host of the fragment each node is in (0 outside fragments)
+      before (ndarray): Indexes of the nodes with children that are before T
+    """
+    def __init__(self, tree, T):
+        n = len(tree)
+        time = tree.time
+        up_time = np.where(tree.parent >= 0, time[tree.parent], -np.inf)
+
+        self.T = T
+        self.crossing = np.flatnonzero((time < T) & (T <= up_time))
+        self.stop = self.crossing + tree.subtree_size[self.crossing]
+        self.clipped_start = time[self.crossing]
+        self.clipped_end = np.full(len(self.crossing), float(T))
+        if tree.hosts is None:
+            self.host = np.zeros(len(self.crossing), dtype=int)
+        else:
+            self.host = tree.hosts[tree.first_leaf[self.crossing]]
+
+        # Fragments are disjoint ranges, so mark where each starts and stops
+        marks = np.zeros(n + 1, dtype=int)
+        marks[self.crossing] += 1
+        marks[self.stop] -= 1
+        self.in_fragment = np.cumsum(marks)[:n] > 0
+        marks[:] = 0
+        marks[self.crossing] += self.host
+        marks[self.stop] -= self.host
+        self.node_host = np.cumsum(marks)[:n]
+
+        self.before = np.flatnonzero(~tree.is_leaf & ~self.in_fragment)
+
+    def __len__(self):
+        return len(self.crossing)
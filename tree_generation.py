@@ -2,9 +2,12 @@
 
 import numpy as np
 from ete3 import TreeNode
-from numpy.random import Generator, PCG64
-from population_models import con_population
+from numpy.random import Generator, PCG64, SeedSequence
+from population_models import con_population, lin_population, exp_population
+from tree_arrays import TreeArrays
+from segment_table import Forest
 
+# Used by every simulation unless another generator is given, e.g. from SimulationSeed
 rng = Generator(PCG64())
 
 def generate_nodes(number, start=0, host=""):
@@ -15,7 +18,7 @@ def generate_nodes(number, start=0, host=""):
     nodes = []
     for i in range(start, start+number):
         if host:
-            name = prefix + "_" + str(i)
+            name = host + "_" + str(i+1)
             node = TreeNode(dist=0, name=name)
             # It's not useful to set node.host since it gets exported to text
         else:
@@ -23,14 +26,81 @@ def generate_nodes(number, start=0, host=""):
         nodes.append(node)
     return nodes
 
-def next_coalescence_time(params, pop_model=con_population):
+def lin_waiting_time(start, k, a, b, I, u):
+    """
+    Invert the survival function of population_models.lin_nocoal_probability,
+    giving the waiting time z from start with probability u of no
+    coalescence happening before it. Works elementwise on arrays.
+
+    Parameters
+      start (float or ndarray): time the wait starts (measured from the tips)
+      k (int or ndarray): number of lineages
+      a, b, I (float): linear population parameters (see lin_population)
+      u (float or ndarray): uniform random numbers in (0, 1]
+
+    Output
+      z (float or ndarray): waiting time until the next coalescence. inf where
+      the population at start is not positive (start beyond I + a/b), since
+      the model has no lineages there to coalesce.
+    """
+    lmd = k*(k - 1)/2
+    end_pop = a + b*(I - start) # Population at start, since time runs towards the root
+    # Solve u = ((end_pop - b*z) / end_pop) ** (lmd/b) for z
+    z = -end_pop * np.expm1(b*np.log(u)/lmd) / b
+    return np.where(end_pop > 0, z, np.inf)[()]
+
+def exp_waiting_time(start, k, a, r, I, u):
+    """
+    Invert the survival function of population_models.exp_nocoal_probability,
+    giving the waiting time z from start with probability u of no
+    coalescence happening before it. Works elementwise on arrays.
+
+    Parameters
+      start (float or ndarray): time the wait starts (measured from the tips)
+      k (int or ndarray): number of lineages
+      a, r, I (float): exponential population parameters (see exp_population)
+      u (float or ndarray): uniform random numbers in (0, 1]
+
+    Output
+      z (float or ndarray): waiting time until the next coalescence
+    """
+    lmd = k*(k - 1)/2
+    end_pop = a*np.exp(r*(I - start)) # Population at start, since time runs towards the root
+    # Solve -log(u)/lmd = (exp(r*z) - 1) / (r*end_pop) for z
+    return np.log1p(-r*end_pop*np.log(u)/lmd) / r
+
+def next_coalescence_time(params, pop_model=con_population, start=0, generator=None):
+    return waiting_time(params, params["k"], start, pop_model=pop_model, generator=generator)
+
+def waiting_time(params, k, start, pop_model=con_population, generator=None):
+    """
+    Draw the time from start until the next coalescence among k lineages.
+    Both models are memoryless in the sense that a new wait can be drawn from
+    any point, so a wait that is cut short (e.g. by a sampling event) can
+    simply be drawn again.
+
+    Parameters
+      params (dict): population parameters (N0 for con_population, a, b, and I for
+        lin_population, a, r, and I for exp_population)
+      k (int): number of lineages
+      start (float): time the wait starts (measured from the tips)
+      pop_model (function): a function that gives the population at a certain time
+      generator (Generator, optional): random number generator, the module's rng by default
+
+    Output
+      z (float): waiting time, inf if there are fewer than two lineages
+    """
+    generator = rng if generator is None else generator
+    if k < 2:
+        return np.inf
     if pop_model == con_population:
-        scale = (2*params["N0"]) / (params["k"]*(params["k"]-1))
-        return rng.exponential(scale=scale)
+        return generator.exponential(scale=(2*params["N0"]) / (k*(k-1)))
+    elif pop_model == lin_population:
+        return lin_waiting_time(start, k, params["a"], params["b"], params["I"], 1 - generator.random())
+    elif pop_model == exp_population:
+        return exp_waiting_time(start, k, params["a"], params["r"], params["I"], 1 - generator.random())
     else:
-        # The rest of it should be general enough, but I have no way to do the rest
-        # right now.
-        raise Exception("The generator only works on constant population right now.")
+        raise Exception("The generator only works on constant, linear, and exponential population right now.")
 
 def coalescence(nodes, coal_time, params, pop_model=con_population): # TODO expand with linear and exponential later
     # Add distance to all existing nodes
@@ -54,25 +124,346 @@ def coalescence(nodes, coal_time, params, pop_model=con_population): # TODO expa
 
     return nodes
 
-def generate_tree(params, pop_model=con_population):
+#
+# Reproducible random streams
+#
+
+class SimulationSeed:
+    """
+    Root seed of a simulation study. Replicates are simulated in blocks, and
+    each block gets its own independent stream derived from the root seed,
+    the same streams SeedSequence.spawn would give. Block i always gets the
+    same stream whichever process simulates it, so splitting the blocks
+    between workers gives exactly the same trees as one process running them
+    all in order.
+
+    Attributes:
+      seed_sequence (SeedSequence): The root of every stream
+      block_size (int): Number of replicates in each block
+    """
+    def __init__(self, seed=None, block_size=1000):
+        self.seed_sequence = SeedSequence(seed)
+        self.block_size = block_size
+
+    @property
+    def entropy(self):
+        """
+        The root seed. Record it to reproduce a study started with seed=None.
+        """
+        return self.seed_sequence.entropy
+
+    def generator(self, block):
+        """
+        Return a new random number generator for one block. Equal to
+        Generator(PCG64(seed_sequence.spawn(n)[block])) for any n > block,
+        without spawning the earlier blocks.
+        """
+        child = SeedSequence(self.entropy, spawn_key=self.seed_sequence.spawn_key + (block,))
+        return Generator(PCG64(child))
+
+    def block_sizes(self, replicates):
+        """
+        Number of replicates in each block needed for a number of replicates.
+        Every block is full except possibly the last.
+        """
+        full, rest = divmod(replicates, self.block_size)
+        return [self.block_size]*full + ([rest] if rest else [])
+
+    def shard(self, replicates, shard, shards):
+        """
+        Return the blocks one worker should simulate when the replicates are
+        split between several. Shards get consecutive blocks, so putting the
+        results of shard 0, 1, ... together gives the blocks in order.
+
+        Parameters:
+          replicates (int): Total number of replicates in the study
+          shard (int): Index of this worker, from 0 to shards-1
+          shards (int): Number of workers
+
+        Returns:
+          blocks (list): Indexes of the blocks for this worker
+        """
+        blocks = np.arange(len(self.block_sizes(replicates)))
+        return np.array_split(blocks, shards)[shard].tolist()
+
+def generate_trees_seeded(params, replicates, seed, blocks=None, pop_model=con_population):
+    """
+    Simulate trees like generate_trees, drawing each block of replicates from
+    its own stream of seed.
+
+    Parameters
+      params (dict):  a dictionary with run parameters (see coalescence_times)
+      replicates (int): total number of trees in the study
+      seed (SimulationSeed): root seed of the study
+      blocks (list, optional): only simulate these blocks (see SimulationSeed.shard).
+        All of them by default.
+      pop_model (function): a function that gives the population at a certain time
+
+    Output
+      trees (Forest): segments of every tree in the chosen blocks, in block order
+    """
+    sizes = seed.block_sizes(replicates)
+    if blocks is None:
+        blocks = range(len(sizes))
+    times = [coalescence_times(params, replicates=sizes[block], pop_model=pop_model,
+                               generator=seed.generator(block))
+             for block in blocks]
+    if not times:
+        times = [np.empty((0, params["k"] - 1))]
+    return Forest.from_times(np.concatenate(times), params["k"])
+
+#
+# Array-based simulation. Instead of building TreeNodes one coalescence at a
+# time, draw every waiting time and every merged pair with NumPy and store the
+# tree as parent/branch length arrays (see tree_arrays.TreeArrays).
+#
+
+def coalescence_times(params, replicates=1, pop_model=con_population, generator=None):
+    """
+    Draw the times of all k-1 coalescences for a number of replicate trees.
+
+    Parameters
+      params (dict): a dictionary with run parameters (k and N0 for
+        con_population, k, a, b, and I for lin_population, k, a, r, and I
+        for exp_population)
+      replicates (int): number of trees to draw times for
+      pop_model (function): a function that gives the population at a certain time
+      generator (Generator, optional): random number generator, the module's rng by default
+
+    Output
+      times (ndarray): (replicates, k-1) array of coalescence times (measured
+        from the tips), increasing along each row
+    """
+    generator = rng if generator is None else generator
+    k = params["k"]
+    if pop_model == con_population:
+        # With a constant population the waiting time while there are j lineages
+        # is exponential with rate j(j-1)/2N, independent of everything else
+        lineages = np.arange(k, 1, -1)
+        scale = (2*params["N0"]) / (lineages*(lineages-1))
+        waiting = generator.exponential(size=(replicates, k-1)) * scale
+        return np.cumsum(waiting, axis=1)
+    elif pop_model == lin_population or pop_model == exp_population:
+        # Each waiting time depends on when the last one ended, so step through
+        # the coalescences, but draw every replicate at once
+        if pop_model == lin_population:
+            wait = lambda start, lineages, u: lin_waiting_time(start, lineages, params["a"], params["b"], params["I"], u)
+        else:
+            wait = lambda start, lineages, u: exp_waiting_time(start, lineages, params["a"], params["r"], params["I"], u)
+        times = np.empty((replicates, k-1))
+        start = np.zeros(replicates)
+        for j, lineages in enumerate(range(k, 1, -1)):
+            u = 1 - generator.random(replicates) # In (0, 1], so log(u) is finite
+            start = start + wait(start, lineages, u)
+            times[:, j] = start
+        return times
+    else:
+        raise Exception("The generator only works on constant, linear, and exponential population right now.")
+
+def random_merges(k, replicates=1, generator=None):
+    """
+    Choose which lineages merge at each coalescence, for a number of replicate
+    trees at once. Tips are nodes 0..k-1 and the j-th coalescence creates node
+    k+j, so the root is node 2k-2.
+
+    Parameters
+      k (int): number of tips
+      replicates (int): number of trees
+      generator (Generator, optional): random number generator, the module's rng by default
+
+    Output
+      parent (ndarray): (replicates, 2k-1) array with the parent of each node,
+        -1 for the root
+    """
+    generator = rng if generator is None else generator
+    rows = np.arange(replicates)
+    parent = np.full((replicates, 2*k - 1), -1)
+    live = np.tile(np.arange(k), (replicates, 1))
+    for j in range(k - 1):
+        m = k - j # Number of live lineages
+        first = generator.integers(m, size=replicates)
+        second = generator.integers(m - 1, size=replicates)
+        second += second >= first # Uniform over the other m-1 lineages
+        low, high = np.minimum(first, second), np.maximum(first, second)
+
+        parent[rows, live[rows, low]] = k + j
+        parent[rows, live[rows, high]] = k + j
+        # The new node takes one slot, the last live lineage fills the other
+        live[rows, low] = k + j
+        live[rows, high] = live[rows, m - 1]
+    return parent
+
+def tree_from_merges(parent, coal_times, names=None):
+    """
+    Build TreeArrays from the output of random_merges and coalescence_times
+    for a single tree.
+
+    Parameters
+      parent (ndarray): parent of each node, with tips first
+      coal_times (ndarray): time of each coalescence, in order
+      names (list, optional): names of the tips, "1".."k" by default
+
+    Output
+      tree (TreeArrays): the simulated tree, with node times filled in
+    """
+    k = len(coal_times) + 1
+    time = np.concatenate((np.zeros(k), coal_times))
+    dist = np.where(parent >= 0, time[parent] - time, 0.)
+    if names is None:
+        names = [str(i+1) for i in range(k)]
+    return TreeArrays(parent, dist, list(names) + [""]*(k - 1), time=time)
+
+def simulate_tree(params, pop_model=con_population, generator=None):
+    """
+    Simulate a tree based on the provided parameters without building any
+    ete3 objects.
+
+    Parameters
+      params (dict):  a dictionary with run parameters (k, N0)
+      pop_model (function): a function that gives the population at a certain time
+
+    Output
+      tree (TreeArrays): the simulated tree. Use tree.to_newick() for text.
+    """
+    coal_times = coalescence_times(params, pop_model=pop_model, generator=generator)[0]
+    parent = random_merges(params["k"], generator=generator)[0]
+    return tree_from_merges(parent, coal_times)
+
+def generate_trees(params, replicates, pop_model=con_population, generator=None):
+    """
+    Simulate many trees with the same parameters in one pass. The likelihood
+    of a single-host tree only depends on its coalescence times, so no
+    topology or Newick is made.
+
+    Parameters
+      params (dict):  a dictionary with run parameters (see coalescence_times)
+      replicates (int): number of trees to simulate
+      pop_model (function): a function that gives the population at a certain time
+
+    Output
+      trees (Forest): segments of every tree. trees.table(i) is the
+        SegmentTable of tree i, which tree_likelihood takes directly.
+    """
+    times = coalescence_times(params, replicates=replicates, pop_model=pop_model, generator=generator)
+    return Forest.from_times(times, params["k"])
+
+def write_sim_trees(filename, params, replicates, pop_model=lin_population, generator=None):
+    """
+    Simulate trees and write them to a file with one Newick tree per line,
+    with tips named D_1..D_k like the trees in erik-sim.
+
+    Parameters
+      filename (str): where to write the trees
+      params (dict): a dictionary with run parameters (see coalescence_times)
+      replicates (int): number of trees to write
+      pop_model (function): a function that gives the population at a certain time
+    """
+    k = params["k"]
+    times = coalescence_times(params, replicates=replicates, pop_model=pop_model, generator=generator)
+    parents = random_merges(k, replicates=replicates, generator=generator)
+    names = [f"D_{i+1}" for i in range(k)]
+    with open(filename, "w") as treefile:
+        for parent, coal_times in zip(parents, times):
+            treefile.write(tree_from_merges(parent, coal_times, names=names).to_newick() + "\n")
+
+def generate_tree(params, pop_model=con_population, generator=None):
     """
     Create a tree based on the provided parameters.
 
     Parameters
-      params (dict):  a dictionary with run parameters (k, N0, and sometimes n or b)
+      params (dict):  a dictionary with run parameters (k, N0)
       pop_model (function): a function that gives the population at a certain time
 
     Output
       tree (str): the newick representation of a tree
     """
-    run_params = params.copy() # Create a single use copy in case we run multiple times
-    nodes = generate_nodes(run_params["k"])
-    while len(nodes) > 1:
-        coal_time = next_coalescence_time(run_params, pop_model=pop_model)
-        nodes = coalescence(nodes, coal_time, run_params, pop_model=pop_model)
-    return nodes[0].write(format=1)
+    return simulate_tree(params, pop_model=pop_model, generator=generator).to_newick()
 
-def generate_tree_multisample(start_params, sample_time, lineages_added, pop_model=con_population):
+def simulate_hosts(samples, host_models, transmission_time=np.inf, generator=None):
+    """
+    Simulate a tree with tips sampled at different times in one or two hosts,
+    going back in time from the most recent sample. Each host coalesces with
+    its own population model. At transmission_time (looking back), every
+    lineage left in host 1 (the recipient) moves into host 0 (the donor).
+
+    Nodes are stored in flat lists while simulating, and the result is
+    returned as TreeArrays, so no ete3 objects are made.
+
+    Parameters
+      samples (list): (name, host, sample_time) for every tip
+      host_models (list): (params, pop_model) for each host, see waiting_time
+      transmission_time (float): time of transmission from host 0 to host 1
+      generator (Generator, optional): random number generator, the module's rng by default
+
+    Output
+      tree (TreeArrays): the simulated tree in preorder, with node times
+    """
+    generator = rng if generator is None else generator
+    samples = sorted(samples, key=lambda sample: sample[2])
+    parent, time, names = [], [], []
+    live = [[] for _ in host_models]
+    t = samples[0][2]
+    next_sample = 0
+    while True:
+        # Add every tip sampled by now
+        while next_sample < len(samples) and samples[next_sample][2] <= t:
+            name, host, sample_time = samples[next_sample]
+            if host != 0 and sample_time >= transmission_time:
+                raise Exception(f"Tip {name} was sampled at {sample_time}, before its host was infected at {transmission_time}.")
+            parent.append(-1)
+            time.append(sample_time)
+            names.append(name)
+            live[host].append(len(parent) - 1)
+            next_sample += 1
+
+        next_time = samples[next_sample][2] if next_sample < len(samples) else np.inf
+        boundary = min(next_time, transmission_time)
+        waits = [waiting_time(params, len(nodes), t, pop_model=pop_model, generator=generator)
+                 for (params, pop_model), nodes in zip(host_models, live)]
+        host = waits.index(min(waits))
+
+        if t + waits[host] < boundary:
+            # Coalesce two random lineages of that host
+            t += waits[host]
+            nodes = live[host]
+            first = generator.integers(len(nodes))
+            second = generator.integers(len(nodes) - 1)
+            second += second >= first
+            parent.append(-1)
+            time.append(t)
+            names.append("")
+            for index in sorted((first, second), reverse=True):
+                parent[nodes[index]] = len(parent) - 1
+                nodes[index] = nodes[-1]
+                nodes.pop()
+            nodes.append(len(parent) - 1)
+        elif boundary < np.inf:
+            t = boundary
+            if boundary == transmission_time:
+                for nodes in live[1:]:
+                    live[0].extend(nodes)
+                    nodes.clear()
+                transmission_time = np.inf
+        else:
+            break
+
+    parent, time = np.array(parent), np.array(time)
+    dist = np.where(parent >= 0, time[parent] - time, 0.)
+    return TreeArrays(parent, dist, names, time=time).to_preorder()
+
+def host_pop_model(model):
+    """
+    Return the population model function for "con", "lin", or "exp".
+    """
+    if model == "con":
+        return con_population
+    elif model == "lin":
+        return lin_population
+    elif model == "exp":
+        return exp_population
+    raise Exception(f"Can only take model of lin, exp, or con, not {model}")
+
+def generate_tree_multisample(start_params, sample_time, lineages_added, pop_model=con_population, generator=None):
     """
     Generate a tree with the specified start parameters, adding in a certain number
     of lineages from a different host at a certain sample time.
@@ -82,79 +473,63 @@ def generate_tree_multisample(start_params, sample_time, lineages_added, pop_mod
       sample_time (float): the time that additional lineages should be added
       lineages_added (int): the number of additional lineages to add
       pop_model (function): a function that returns the population at a certain time
-    """
-    run_params = start_params.copy() # Don't overwrite the original
-
-    # Initial node generation
-    nodes = generate_nodes(run_params["k"], prefix="D")
-
-    # Run until we have one node left
-    time = 0
-    while len(nodes) > 1:
-        coal_time = next_coalescence_time(run_params, pop_model=pop_model)
-        # Coalescence at this exact time 
-        if time == sample_time: 
-            print(f"Adding in {lineages_added} nodes at {time}")
-            # TODO even though we give them a new name, we don't treat them differently atm 
-            new_nodes = generate_nodes(lineages_added, prefix="R")
-            nodes += new_nodes
-            run_params["k"] += lineages_added
-        # Coalescence occured during coal_time
-        elif time < sample_time < time + coal_time:
-            # Fast forward to the coalescence time
-            print(f"Passed over sample time, fast-forwarding model from {time} to {sample_time}")
-            diff = sample_time - time
-            time = sample_time
-            for node in nodes:
-                node.dist += diff
-            continue
-        # Normal coalescence
-        else:
-            nodes = coalescence(nodes, time, run_params, pop_model=pop_model)
-
-        time += coal_time
 
-    # Return text version of the tree
-    return nodes[0].write(format=1)
+    Returns:
+      t (str): Newick representation of tree
+    """
+    k = start_params["k"]
+    # TODO even though we give them a new name, we don't treat them differently atm
+    samples = ([(f"D_{i+1}", 0, 0.) for i in range(k)]
+               + [(f"R_{i+1}", 0, sample_time) for i in range(k, k + lineages_added)])
+    return simulate_hosts(samples, [(start_params, pop_model)], generator=generator).to_newick()
 
-def generate_tree_multihost(host1_params, host2_params, transmission_time, model="con"):
+def simulate_tree_multihost(host1_params, host2_params, transmission_time, model="con", generator=None):
     """
-    Generate a tree with two hosts, each with their own parameters.
+    Simulate a tree with two hosts, each with their own parameters. Looking back
+    in time, the lineages of each host coalesce separately until the
+    transmission time, when the lineages left in the recipient (host 2) move
+    into the donor (host 1). With a linear model, the recipient's population
+    is a at the transmission, which is the bottleneck.
 
     Params:
-      host1_params (dict):
-        N0 (int): population size
-        k (int): starting nodes
-      host2_params (dict):
-        N0 (int): population size
+      host1_params (dict): Donor parameters
         k (int): starting nodes
+        N0 (float): population size, for "con"
+        a, b, I (float): linear population parameters, for "lin"
+        sample_time (float, optional): time the tips were sampled, 0 by default
+      host2_params (dict): Recipient parameters, like host1_params. For "lin",
+        I defaults to the transmission time.
       transmission_time (real): time of transmission
-      model (str): Type of model to use - "con", "lin", or "exp"
+      model (str or tuple): Type of model to use - "con" or "lin", or one for each host
+      generator (Generator, optional): random number generator, the module's rng by default
 
     Returns:
-      t (str): Newick representation of tree
+      tree (TreeArrays): The tree in preorder with tips named D_1..D_k for the
+        donor and R_k+1.. for the recipient, ready for
+        tree_likelihood.tree_segments_multihost and populate_hosts
     """
-    h1_run = host1_params.copy()
-    h2_run = host2_params.copy()
+    models = (model, model) if isinstance(model, str) else model
+    donor = dict(host1_params)
+    recipient = dict(host2_params)
+    if models[1] == "lin":
+        recipient.setdefault("I", transmission_time)
 
-    if model == "con":
-        pop_model = con_population
-    else:
-        raise Exception("I can only run this on a constant model right now.")
+    k_D, k_R = donor["k"], recipient["k"]
+    samples = ([(f"D_{i+1}", 0, donor.get("sample_time", 0.)) for i in range(k_D)]
+               + [(f"R_{i+1}", 1, recipient.get("sample_time", 0.)) for i in range(k_D, k_D + k_R)])
+    host_models = [(donor, host_pop_model(models[0])), (recipient, host_pop_model(models[1]))]
+    return simulate_hosts(samples, host_models, transmission_time=transmission_time, generator=generator)
 
-    # Generate nodes for each host, keeping them separate for now
-    h1_nodes = generate_nodes(h1_run["k"], host="D")
-    h2_nodes = generate_nodes(h2_run["k"], host="R", start=h1_run["k"])
+def generate_tree_multihost(host1_params, host2_params, transmission_time, model="con", generator=None):
+    """
+    Generate a tree with two hosts, each with their own parameters.
+    See simulate_tree_multihost.
 
-    # Run until we have one node left
-    while len(h1_nodes + h2_nodes) > 1:
-        for nodes in [h1_nodes, h2_nodes]:
-            # Do coalescences...?
-            # Need to make sure every time whether we've passed over the transmission time
-            # And handle it if so
-            # But I can't handle it right now
-            pass
-        coal_time = next_coalescence_time()
+    Returns:
+      t (str): Newick representation of tree
+    """
+    return simulate_tree_multihost(host1_params, host2_params, transmission_time, model=model,
+                                   generator=generator).to_newick()
 
 
 def out():
@@ -168,9 +543,8 @@ def read():
         nwk = treefile.readline()
         return TimeTree(nwk)
 
-from display_tree import display_tree
 if __name__ == "__main__":
-    pass
+    from display_tree import display_tree
     #out()
     #t = read()
 
@@ -1,6 +1,8 @@
 import numpy as np
 import warnings
 from time_tree import TimeTree
+from tree_arrays import TreeArrays
+from segment_table import SegmentTable, Forest, as_segment_table
 from population_models import *
 
 def tree_segments(tree, start=0):
@@ -26,13 +28,38 @@ def tree_segments(tree, start=0):
         segments.append((start, end, round(end-start, 5)))
     return segments
 
+# Host numbers used for the donor and recipient in multihost trees
+MULTIHOST_NAMES = {"D": 0, "R": 1}
+
+def segment_list(starts, ends):
+    """
+    Turn arrays of segment starts and ends into the (start, end, dist) tuples
+    returned by tree_segments.
+    """
+    return [(start, end, round(end-start, 5)) for start, end in zip(starts.tolist(), ends.tolist())]
+
+def multihost_arrays(tree):
+    """
+    Return the TreeArrays of a tree with donor and recipient hosts set from
+    the leaf names (see MULTIHOST_NAMES). Hosts are only rewritten if they were
+    last set some other way.
+    """
+    if getattr(tree, "_hostnames", None) != MULTIHOST_NAMES:
+        tree.populate_hosts(MULTIHOST_NAMES) # Overwrite any existing host data for what we'll use here
+    if isinstance(tree, TreeArrays):
+        return tree
+    return tree.arrays()
+
 def tree_segments_multihost(tree, T):
     """
     Divide a tree into three types of segments: Those that occur entirely in either 
     the donor or the recipient and those that occur across the transmission time.
 
+    The tree is split with TreeArrays.split_at_time, so it is never copied and
+    repeated calls with different T only do array work.
+
     Parameters:
-      tree (TimeTree): ete3 representation of a tree with time values.
+      tree (TimeTree or TreeArrays): Representation of a tree with time values.
       T (float): Time of transmission between donor and recipient. 
         Also can be written As I_R (I sub R)
 
@@ -42,57 +69,206 @@ def tree_segments_multihost(tree, T):
       none_D (list): Segments without a coalescence in the donor
       none_R (list): Segments without a coalescence in the recipient
     """
-    tree.populate_hosts({"D": 0, "R": 1}) # Overwrite any existing host data for what we'll use here
-    before, after = tree.split_at_time(T)
-    
-    coalescence = {0: [], 1: []} # Start, end, and dist for each segment
-    no_coalescence = {0: [], 1: []}
-    parents = {0: set(), 1: set()} # For coalescing nodes, which parents have we already seen?
-
-    def add_coalescence(node, host, start, end):
-        """Add a coalescence event to the relevant list, but only if there
-        is not already one with the same host."""
-        if node.up not in parents[host]:
-            coalescence[host].append((start, end, round(end-start, 5)))
-            parents[host].add(node.up)
-
-    for fragment in after:
-        try:
-            if fragment.children:
-                host = fragment.get_leaves()[0].host
-            else:
-                host = fragment.host
-        except AttributeError:
-            print("Could not find a host for one of the tree fragments. Please check that all tree tips have hosts.")
-            raise
-
-        frag_start = fragment.time
-        frag_end = fragment.time + fragment.dist
-        no_coalescence[host].append((frag_start, frag_end, round(frag_end-frag_start, 5)))
-
-        for node in fragment.iter_descendants():
-            start = node.time
-            end = node.up.time
-            add_coalescence(node, host, start, end)
-
-    # Sort segments by start time 
-    coal_D = coalescence[0] + tree_segments(before, start=T)
-    coal_R = coalescence[1]
-    none_D = no_coalescence[0]
-    none_R = no_coalescence[1]
+    arrays = multihost_arrays(tree)
+    view = arrays.split_at_time(T)
+    if np.any((view.host != 0) & (view.host != 1)):
+        raise Exception("Could not find a host for one of the tree fragments. Please check that all tree tips have hosts.")
+
+    time = arrays.time
+    # Each node with children after T coalesces at its own time. Its segment starts
+    # at the time of its first child, which comes right after it in preorder.
+    coal_nodes = np.flatnonzero(~arrays.is_leaf & view.in_fragment)
+    coal_host = view.node_host[coal_nodes]
+
+    coal_D = segment_list(time[coal_nodes + 1][coal_host == 0], time[coal_nodes][coal_host == 0])
+    coal_R = segment_list(time[coal_nodes + 1][coal_host == 1], time[coal_nodes][coal_host == 1])
+    none_D = segment_list(view.clipped_start[view.host == 0], view.clipped_end[view.host == 0])
+    none_R = segment_list(view.clipped_start[view.host == 1], view.clipped_end[view.host == 1])
+
+    # Everything before T is in the donor
+    before_times = np.sort(np.concatenate(([T], time[view.before])))
+    coal_D += segment_list(before_times[:-1], before_times[1:])
+
+    # Sort segments by start time, breaking ties by end time
     for l in [coal_D, coal_R, none_D, none_R]:
-        l.sort(key = lambda x: x[0])
+        l.sort(key = lambda x: x[:2])
 
     return coal_D, coal_R, none_D, none_R
 
+class MultihostIntervals:
+    """
+    Coalescent intervals of a donor/recipient tree for many transmission
+    times at once, from tree_intervals_multihost.
+
+    Unlike tree_segments_multihost, every interval carries the number of
+    lineages k in its host, so there is one no-coalescence interval per host
+    (ending at T or at a sampling time) rather than one per lineage.
+
+    Attributes:
+      T (ndarray): Transmission times
+      valid (ndarray): False where a fragment after T has tips from both hosts,
+        which cannot happen if transmission was at T
+      coal_D, coal_R (Forest): Intervals ending in a coalescence in each host.
+        Everything before T counts as the donor.
+      none_D, none_R (Forest): Intervals ending without a coalescence
+      Tree i of each forest holds the intervals for T[i].
+    """
+    def __init__(self, T, valid, coal_D, coal_R, none_D, none_R):
+        self.T = T
+        self.valid = valid
+        self.coal_D = coal_D
+        self.coal_R = coal_R
+        self.none_D = none_D
+        self.none_R = none_R
+
+    def __len__(self):
+        return len(self.T)
+
+def _event_intervals(mask, sorted_time, delta, is_coal, k_start, start_time, end_time):
+    """
+    Turn the events picked out by mask (one row per T, columns sorted by time)
+    into intervals. Returns row, start, end, k, and whether each interval ends
+    in a coalescence.
+
+    If start_time is given, each row also has an interval from start_time to its
+    first event with k_start lineages. If end_time is given, the last event of
+    each row gets an interval up to end_time without a coalescence.
+    """
+    m, n = mask.shape
+    k_after = k_start[:, np.newaxis] + np.cumsum(np.where(mask, delta, 0), axis=1)
+
+    # Index of the next masked event after each column (n if there is none)
+    candidates = np.where(mask, np.arange(n), n)
+    next_event = np.minimum.accumulate(candidates[:, ::-1], axis=1)[:, ::-1]
+    first_event = next_event[:, 0]
+    next_event = np.concatenate((next_event[:, 1:], np.full((m, 1), n)), axis=1)
+
+    padded_time = np.append(sorted_time, np.nan)
+    padded_coal = np.append(is_coal, False)
+
+    rows, cols = np.nonzero(mask)
+    following = next_event[rows, cols]
+    start = sorted_time[cols]
+    k = k_after[rows, cols]
+    if end_time is not None:
+        end = np.where(following < n, padded_time[following], end_time[rows])
+        keep = np.ones(len(rows), dtype=bool)
+    else:
+        end = padded_time[following]
+        keep = following < n
+    coal = padded_coal[following]
+
+    if start_time is not None:
+        has_event = first_event < n
+        first_rows = np.flatnonzero(has_event)
+        rows = np.concatenate((first_rows, rows))
+        start = np.concatenate((start_time[first_rows], start))
+        end = np.concatenate((padded_time[first_event[first_rows]], end))
+        k = np.concatenate((k_start[first_rows], k))
+        coal = np.concatenate((padded_coal[first_event[first_rows]], coal))
+        keep = np.concatenate((np.ones(len(first_rows), dtype=bool), keep))
+
+    keep &= k >= 1
+    return rows[keep], start[keep], end[keep], k[keep], coal[keep]
+
+def _interval_forest(parts, T):
+    """
+    Pack (row, start, end, k) arrays from several calls into one Forest,
+    sorted by row and then by start time.
+    """
+    rows, start, end, k = [np.concatenate(arrays) for arrays in zip(*parts)]
+    order = np.lexsort((end, start, rows))
+    rows, start, end, k = rows[order], start[order], end[order], k[order]
+    return Forest.from_flat(start, end, np.round(end - start, 5), k, rows, T)
+
+def tree_intervals_multihost(tree, T):
+    """
+    Find the donor and recipient coalescent intervals of a tree for every
+    transmission time in T in one pass of array operations.
+
+    Before T (more recent than the transmission), each lineage belongs to the
+    host of the first tip below it, as in tree_segments_multihost. At T every
+    remaining lineage joins the donor. T is allowed to be older than the root,
+    in which case the whole tree is after T.
+
+    Parameters:
+      tree (TimeTree or TreeArrays): Representation of a tree with time values.
+      T (float or array): Candidate times of transmission
+
+    Returns:
+      intervals (MultihostIntervals): Intervals of each class for each T
+    """
+    arrays = multihost_arrays(tree)
+    leaf_hosts = arrays.hosts[arrays.is_leaf]
+    if np.any((leaf_hosts != 0) & (leaf_hosts != 1)):
+        raise Exception("Could not find a host for one of the tree fragments. Please check that all tree tips have hosts.")
+
+    T = np.atleast_1d(np.asarray(T, dtype=float))
+    m, n = len(T), len(arrays)
+    time = arrays.time
+    is_leaf = arrays.is_leaf
+    up_time = np.where(arrays.parent >= 0, time[arrays.parent], np.inf)
+    host = arrays.hosts[arrays.first_leaf]
+
+    # Fragment roots for every T, then mark their preorder ranges
+    rows, cols = np.nonzero((time < T[:, np.newaxis]) & (T[:, np.newaxis] <= up_time))
+    stops = cols + arrays.subtree_size[cols]
+    marks = np.zeros((m, n + 1), dtype=int)
+    marks[rows, cols] += 1
+    marks[rows, stops] -= 1
+    in_fragment = np.cumsum(marks, axis=1)[:, :n] > 0
+    marks[:] = 0
+    marks[rows, cols] += host[cols]
+    marks[rows, stops] -= host[cols]
+    node_host = np.cumsum(marks, axis=1)[:, :n]
+    k_at_T = np.bincount(rows, minlength=m)
+
+    # A fragment with tips from both hosts had a coalescence between hosts after T
+    tips_R = np.concatenate(([0], np.cumsum(is_leaf & (arrays.hosts == 1))))
+    tips_D = np.concatenate(([0], np.cumsum(is_leaf & (arrays.hosts == 0))))
+    mixed = (tips_R[stops] > tips_R[cols]) & (tips_D[stops] > tips_D[cols])
+    valid = np.bincount(rows, weights=mixed, minlength=m) == 0
+
+    # Tips add a lineage and parents remove one
+    order = np.argsort(time, kind="stable")
+    sorted_time = time[order]
+    delta = np.where(is_leaf, 1, -1)[order]
+    is_coal = ~is_leaf[order]
+    no_lineages = np.zeros(m, dtype=int)
+
+    classes = {"coal_D": [], "coal_R": [], "none_D": [], "none_R": []}
+    for h, name in [(0, "D"), (1, "R")]:
+        mask = (in_fragment & (node_host == h))[:, order]
+        rows, start, end, k, coal = _event_intervals(mask, sorted_time, delta, is_coal, no_lineages, None, T)
+        # A no-coalescence interval of length 0 has probability 1, so leave it out
+        keep = coal | (end > start)
+        classes["coal_" + name].append((rows[coal], start[coal], end[coal], k[coal]))
+        classes["none_" + name].append((rows[keep & ~coal], start[keep & ~coal], end[keep & ~coal], k[keep & ~coal]))
+
+    # Before T, all lineages are in the donor
+    mask = (~in_fragment)[:, order]
+    rows, start, end, k, coal = _event_intervals(mask, sorted_time, delta, is_coal, k_at_T, T, None)
+    keep = coal | (end > start)
+    classes["coal_D"].append((rows[coal], start[coal], end[coal], k[coal]))
+    classes["none_D"].append((rows[keep & ~coal], start[keep & ~coal], end[keep & ~coal], k[keep & ~coal]))
+
+    forests = {name: _interval_forest(parts, T) for name, parts in classes.items()}
+    return MultihostIntervals(T, valid, **forests)
+
 def tree_likelihood(tree, population, probability, params):
     """
     Return the log likelihood of a tree existing based
     on the given population model and probability function.
+
+    The tree can be given as a TimeTree or as a SegmentTable. When the same
+    tree is evaluated many times (e.g. inside an optimizer), compile it
+    once with SegmentTable.from_tree and pass the table instead.
     """
+    table = as_segment_table(tree)
+
     # Make sure the tree starts at or after I. If not, warn the user.
-    if params['I'] < tree.time:
-        warnings.warn(f"Tree time {tree.time} was further back than transmission time {params['I']}")
+    if params['I'] < table.time:
+        warnings.warn(f"Tree time {table.time} was further back than transmission time {params['I']}")
 
     # Check params are valid, return -inf if they are not.
     # Does not raise warnings, as it is meant to work with an optimizer.
@@ -101,27 +277,125 @@ def tree_likelihood(tree, population, probability, params):
             return -np.inf
         if params['a'] < 0:
             return -np.inf
+    elif 'r' in params: # Exponential model
+        if params['r'] <= 0:
+            return -np.inf
+        if params['a'] <= 0:
+            return -np.inf
     elif 'N' in params: # Constant model
         if params['N'] <= 0:
             return -np.inf
     else: # Neither model fits -> raise an error
-        raise Exception("params contained neither b nor N, so a population model could not be determined.")
+        raise Exception("params contained none of b, r, or N, so a population model could not be determined.")
+
+    if np.any(table.k == 1): # TODO is this check still necessary?
+        warnings.warn(f"Only one node in some segments. Not sure what's happening.")
+    if np.any(table.end > params["I"]):
+        warnings.warn(f"Tree node at {table.end.max()} was beyond I {params['I']}. We should have 2 hosts but don't.")
+
+    # If we've not had any issues yet, find the probability of every segment at once.
+    # The known models have log-space kernels, which do not underflow on deep segments.
+    if probability is con_probability:
+        return con_log_likelihood(table.start, table.dist, table.k, params["N"])[()]
+    elif probability is lin_probability:
+        return lin_log_likelihood(table.start, table.dist, table.k, params["a"], params["b"], params["I"])[()]
+    elif probability is exp_probability:
+        return exp_log_likelihood(table.start, table.dist, table.k, params["a"], params["r"], params["I"])[()]
 
-    # If we've not had any issues yet, find the probability step by step
     params_now = params.copy()
-    log_likelihood = 0
-    params_now["k"] = len(tree.get_leaves()) # TODO this will not work when we have multiple hosts
-
-    for (start, end, dist) in tree_segments(tree):
-        segment_lk = np.log(probability(params_now, start, dist))
-        if params_now["k"] == 1: # TODO is this check still necessary?
-            warnings.warn(f"Only one node from {start} to {end}. Not sure what's happening.")
-        if end > params_now["I"]:
-            warnings.warn(f"Tree node at {end} was beyond I {params_now['I']}. We should have 2 hosts but don't.")
-        if np.isnan(segment_lk):
-            warnings.warn(f"Segment likelihood was nan from {start} to {end}. This didn't get caught already.") # TODO should no longer be necessary
-        log_likelihood += segment_lk
-        params_now["k"] -= 1
-
-    return log_likelihood
+    params_now["k"] = table.k # TODO this will not work when we have multiple hosts
+    segment_lk = np.log(probability(params_now, table.start, table.dist))
+    if np.any(np.isnan(segment_lk)):
+        warnings.warn(f"Segment likelihood was nan for some segments. This didn't get caught already.") # TODO should no longer be necessary
+
+    return np.sum(segment_lk)
+
+def grid_likelihood(tree, a_range, b_range, I, chunk_size=None):
+    """
+    Return the log likelihood of a tree under a linear population model for
+    every combination of a, b, and I in one NumPy evaluation.
+
+    Parameters:
+      tree (TimeTree or SegmentTable): Tree with a single host and tips at the same time
+      a_range (array): Values of a (population at time of infection)
+      b_range (array): Values of b (linear rate of population increase)
+      I (float or array): Time of infection. If an array is given, it is
+        used as a third axis of the grid.
+      chunk_size (int, optional): Number of a values to evaluate at once. Each
+        chunk needs chunk_size * len(b_range) * len(I) * (number of segments)
+        floats of memory. By default the whole grid is done at once.
+
+    Returns:
+      values (ndarray): Log likelihoods with shape (len(a_range), len(b_range))
+        or (len(a_range), len(b_range), len(I)) if I was an array.
+    """
+    table = as_segment_table(tree)
+    a_range = np.asarray(a_range, dtype=float)
+    b_range = np.asarray(b_range, dtype=float)
+    I_range = np.atleast_1d(np.asarray(I, dtype=float))
+
+    if chunk_size is None:
+        chunk_size = len(a_range)
+    chunk_size = max(int(chunk_size), 1)
+
+    values = np.empty((len(a_range), len(b_range), len(I_range)))
+    b_grid = b_range[np.newaxis, :, np.newaxis]
+    I_grid = I_range[np.newaxis, np.newaxis, :]
+    for low in range(0, len(a_range), chunk_size):
+        a_grid = a_range[low:low+chunk_size, np.newaxis, np.newaxis]
+        values[low:low+chunk_size] = lin_log_likelihood(table.start, table.dist, table.k, a_grid, b_grid, I_grid)
+
+    if np.ndim(I) == 0:
+        return values[:, :, 0]
+    return values
+
+def multihost_likelihood(tree, T, donor_params, recipient_params, model="con"):
+    """
+    Return the log likelihood of a donor/recipient tree with transmission at T.
+    Coalescent intervals in each host use that host's population parameters,
+    and intervals that end without a coalescence use the closed-form
+    no-coalescence probabilities.
+
+    Parameters:
+      tree (TimeTree, TreeArrays, or MultihostIntervals): The tree. Pass the
+        result of tree_intervals_multihost to reuse it across many calls, for
+        example inside an optimizer over the population parameters.
+      T (float or array): Time(s) of transmission. Ignored if tree is already
+        a MultihostIntervals.
+      donor_params (dict): Population parameters of the donor. N for "con",
+        a, b, and I for "lin", a, r, and I for "exp".
+      recipient_params (dict): Population parameters of the recipient, like
+        donor_params. For "lin" and "exp", I defaults to the transmission time.
+        Any parameter can be an array with one value per T.
+      model (str): Type of model to use - "con", "lin", or "exp"
+
+    Returns:
+      log_likelihood (float or ndarray): Log likelihood for each T. -inf where
+      T is not possible for the tree or the parameters are invalid.
+    """
+    if isinstance(tree, MultihostIntervals):
+        intervals = tree
+    else:
+        intervals = tree_intervals_multihost(tree, T)
+
+    if model == "con":
+        N_D, N_R = donor_params["N"], recipient_params["N"]
+        log_lk = (intervals.coal_D.con_log_likelihood(N_D) + intervals.none_D.con_log_nocoal_likelihood(N_D)
+                  + intervals.coal_R.con_log_likelihood(N_R) + intervals.none_R.con_log_nocoal_likelihood(N_R))
+    elif model == "lin":
+        donor = (donor_params["a"], donor_params["b"], donor_params["I"])
+        recipient = (recipient_params["a"], recipient_params["b"], recipient_params.get("I", intervals.T))
+        log_lk = (intervals.coal_D.lin_log_likelihood(*donor) + intervals.none_D.lin_log_nocoal_likelihood(*donor)
+                  + intervals.coal_R.lin_log_likelihood(*recipient) + intervals.none_R.lin_log_nocoal_likelihood(*recipient))
+    elif model == "exp":
+        donor = (donor_params["a"], donor_params["r"], donor_params["I"])
+        recipient = (recipient_params["a"], recipient_params["r"], recipient_params.get("I", intervals.T))
+        log_lk = (intervals.coal_D.exp_log_likelihood(*donor) + intervals.none_D.exp_log_nocoal_likelihood(*donor)
+                  + intervals.coal_R.exp_log_likelihood(*recipient) + intervals.none_R.exp_log_nocoal_likelihood(*recipient))
+    else:
+        raise Exception(f"Can only take model of lin, exp, or con, not {model}")
 
+    log_lk = np.where(intervals.valid, log_lk, -np.inf)
+    if not isinstance(tree, MultihostIntervals) and np.ndim(T) == 0:
+        return log_lk[0]
+    return log_lk